@@ -0,0 +1,470 @@
+# Micro-benchmarks for the rendering and rules hot paths of main.py.
+#
+#   python bench.py run                      # run everything, print results
+#   python bench.py run --save baseline      # ...and store them in benchmarks/baseline.json
+#   python bench.py run -k render_post       # only benchmarks whose name contains "render_post"
+#   python bench.py compare baseline         # run now and compare against benchmarks/baseline.json
+#   python bench.py compare baseline other   # compare two stored result files
+#   python bench.py wire                     # bytes on the wire and gzip CPU cost for feed responses
+#   python bench.py ttfb --posts 1000        # time to first byte and peak memory of the index, buffered vs streamed
+#   python bench.py votes --threads 16       # sustained votes per second, one commit per vote vs batched
+#
+# `compare` exits with status 1 when any benchmark got slower than --threshold percent,
+# so it can gate a deploy.
+import argparse
+import atexit
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+_bench_db_dir = tempfile.mkdtemp(prefix='anonn-bench-')
+atexit.register(shutil.rmtree, _bench_db_dir, ignore_errors=True)
+# main.py reads DATABASE_URL at import time, so point it at a throwaway database first
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_bench_db_dir, 'bench.db')
+
+import main  # noqa: E402
+from main import app, db, User, Post, Reply, Vote, Tag  # noqa: E402
+from flask import render_template_string  # noqa: E402
+from flask_login import login_user  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return decorator
+
+
+# --- Inputs, from small to pathological ---
+SHORT_TEXT = 'Привет всем! <b>Жирный</b> и <i>курсив</i>.\nВторая строка.'
+LONG_TEXT = ('Очень длинный пост с <b>разметкой</b> & спецсимволами <script>alert(1)</script>\n' * 2000)
+FONT_TAGS_TEXT = ''.join(f'<font color="#{n % 0xffffff:06x}">цвет {n}</font> <font color="red">x</font>\n'
+                         for n in range(2000))
+PLAIN_LONG_TEXT = 'a < b && c > d "quoted" \'single\'\n' * 5000
+
+
+class Fixtures:
+    def __init__(self):
+        db.create_all()
+        main.seed_achievements()
+        now = datetime.utcnow()
+        self.viewer = User(username='bench_viewer', about_me='')
+        self.viewer.password_hash = 'x'
+        self.author = User(username='bench_author', about_me='')
+        self.author.password_hash = 'x'
+        db.session.add_all([self.viewer, self.author])
+        db.session.commit()
+
+        tags = [Tag(name=f'bench-tag-{n}') for n in range(5)]
+        db.session.add_all(tags)
+        self.small_post = Post(content=SHORT_TEXT, author=self.author, date=now)
+        self.long_post = Post(content=LONG_TEXT, author=self.author, date=now)
+        self.font_post = Post(content=FONT_TAGS_TEXT, author=self.author, date=now)
+        self.thread_post = Post(content=SHORT_TEXT, author=self.author, date=now)
+        self.voted_post = Post(content=SHORT_TEXT, author=self.author, date=now)
+        for post in (self.small_post, self.long_post, self.font_post, self.thread_post, self.voted_post):
+            post.tags.extend(tags[:3])
+        db.session.add_all([self.small_post, self.long_post, self.font_post, self.thread_post, self.voted_post])
+        db.session.commit()
+
+        db.session.execute(Reply.__table__.insert(), [
+            {'content': f'Ответ номер {n}\nс переносом', 'post_id': self.thread_post.id,
+             'user_id': self.author.id if n % 2 else self.viewer.id, 'date': now + timedelta(seconds=n)}
+            for n in range(500)])
+
+        # 1000 voters on one post, the rest of the votes spread over the feed
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'bench_voter_{n}', 'password_hash': 'x', 'about_me': '', 'is_admin': False,
+             'is_banned': False} for n in range(1000)])
+        voter_ids = [uid for (uid,) in db.session.query(User.id).filter(User.username.like('bench_voter_%'))]
+        db.session.execute(Vote.__table__.insert(), [
+            {'user_id': uid, 'post_id': self.voted_post.id, 'vote_type': 1 if n % 4 else -1, 'date': now}
+            for n, uid in enumerate(voter_ids)])
+        db.session.execute(Vote.__table__.insert(), [
+            {'user_id': self.viewer.id, 'post_id': post.id, 'vote_type': 1, 'date': now}
+            for post in (self.small_post, self.long_post, self.font_post, self.thread_post)])
+
+        # A realistic feed page: 50 ordinary posts with a few replies and votes each
+        self.feed_tag = Tag(name='bench-feed')
+        feed_posts = [Post(content=SHORT_TEXT * 3, author=self.author, date=now - timedelta(minutes=n),
+                           tags=[self.feed_tag])
+                      for n in range(50)]
+        db.session.add_all(feed_posts)
+        db.session.commit()
+        db.session.execute(Reply.__table__.insert(), [
+            {'content': 'Короткий ответ', 'post_id': post.id, 'user_id': self.viewer.id, 'date': now}
+            for post in feed_posts for _ in range(3)])
+        db.session.execute(Vote.__table__.insert(), [
+            {'user_id': uid, 'post_id': post.id, 'vote_type': 1, 'date': now}
+            for post in feed_posts for uid in voter_ids[:10]])
+        db.session.execute(main.vote_score_update())
+        db.session.commit()
+        self.feed_posts = feed_posts
+        self.all_tags = Tag.query.order_by(Tag.name).all()
+
+
+def _render_post_bench(fixtures, post_attr):
+    def run():
+        return main.render_post(getattr(fixtures, post_attr))
+    return run
+
+
+@benchmark('escape_html/short')
+def _(fixtures):
+    return lambda: main.escape_html(SHORT_TEXT)
+
+
+@benchmark('escape_html/long')
+def _(fixtures):
+    return lambda: main.escape_html(PLAIN_LONG_TEXT)
+
+
+@benchmark('render_formatted_post_content/short')
+def _(fixtures):
+    return lambda: main.render_formatted_post_content(SHORT_TEXT)
+
+
+@benchmark('render_formatted_post_content/long')
+def _(fixtures):
+    return lambda: main.render_formatted_post_content(LONG_TEXT)
+
+
+@benchmark('render_formatted_post_content/many_font_tags')
+def _(fixtures):
+    return lambda: main.render_formatted_post_content(FONT_TAGS_TEXT)
+
+
+@benchmark('render_post/small')
+def _(fixtures):
+    return _render_post_bench(fixtures, 'small_post')
+
+
+@benchmark('render_post/long')
+def _(fixtures):
+    return _render_post_bench(fixtures, 'long_post')
+
+
+@benchmark('render_post/many_font_tags')
+def _(fixtures):
+    return _render_post_bench(fixtures, 'font_post')
+
+
+@benchmark('render_post/500_replies')
+def _(fixtures):
+    return _render_post_bench(fixtures, 'thread_post')
+
+
+@benchmark('post_score/1000_votes')
+def _(fixtures):
+    return lambda: fixtures.voted_post.score
+
+
+@benchmark('check_and_award_achievements/new_vote')
+def _(fixtures):
+    return lambda: main.check_and_award_achievements(fixtures.viewer, event_type='new_vote')
+
+
+@benchmark('check_and_award_achievements/vote_on_my_post')
+def _(fixtures):
+    context = {'post_id': fixtures.voted_post.id, 'post_user_id': fixtures.author.id,
+               'post_author_id': fixtures.author.id}
+    return lambda: main.check_and_award_achievements(fixtures.author, event_type='vote_on_my_post',
+                                                     event_context=context)
+
+
+@benchmark('base_template/small_page')
+def _(fixtures):
+    content = '<h2>Профиль</h2><p>Немного текста.</p>'
+    return lambda: render_template_string(main.BASE_HTML_TEMPLATE, content=content, all_tags=fixtures.all_tags)
+
+
+@benchmark('base_template/feed_50_posts')
+def _(fixtures):
+    content = ''.join(main.render_post(post) for post in fixtures.feed_posts)
+    return lambda: render_template_string(main.BASE_HTML_TEMPLATE, content=content, all_tags=fixtures.all_tags,
+                                          sort_by='date_desc', tag_filters=[],
+                                          new_post_form_html_for_bottom_panel='<form></form>')
+
+
+def measure(func, repeat, min_time):
+    func()  # warm up caches, lazy loads and one-off achievement awards
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - started) / loops)
+    return {'min': min(timings), 'median': statistics.median(timings), 'loops': loops, 'repeat': repeat}
+
+
+def wire_report(levels=(1, 6, 9)):
+    app.config['RATE_LIMIT_ENABLED'] = False
+    with app.app_context():
+        fixtures = Fixtures()
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(fixtures.viewer.id)
+            session['_fresh'] = True
+        first_feed_id = min(post.id for post in fixtures.feed_posts)
+        payloads = {
+            'index, 50 posts': client.get(f'/?tag={fixtures.feed_tag.name}').data,
+            'get_new_posts, 50 new': client.get(f'/get_new_posts/{first_feed_id - 1}').data,
+            'get_new_posts, none new': client.get(f'/get_new_posts/{first_feed_id + 100}').data,
+        }
+        wire = {name: len(client.get(path, headers={'Accept-Encoding': 'gzip'}).data) for name, path in (
+            ('index, 50 posts', f'/?tag={fixtures.feed_tag.name}'),
+            ('get_new_posts, 50 new', f'/get_new_posts/{first_feed_id - 1}'),
+            ('get_new_posts, none new', f'/get_new_posts/{first_feed_id + 100}'))}
+
+    print(f"{'payload':<26}{'identity':>10}{'served':>10}" + ''.join(f'{"gzip-" + str(level):>10}{"ms":>8}'
+                                                                  for level in levels))
+    for name, body in payloads.items():
+        row = f'{name:<26}{len(body):>10}{wire[name]:>10}'
+        for level in levels:
+            timing = measure(lambda: gzip.compress(body, level, mtime=0), repeat=3, min_time=0.05)
+            row += f'{len(gzip.compress(body, level, mtime=0)):>10}{timing["min"] * 1000:>8.2f}'
+        print(row)
+    print(f"\n'served' is what the app sends with Accept-Encoding: gzip "
+          f"(COMPRESSION_LEVEL={app.config['COMPRESSION_LEVEL']}, min size {app.config['COMPRESSION_MIN_SIZE']} B).")
+
+
+def seed_large_feed(post_count):
+    db.create_all()
+    main.seed_achievements()
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'username': f'bench_feed_{n}', 'password_hash': 'x', 'about_me': '', 'is_admin': False, 'is_banned': False}
+        for n in range(11)])
+    user_ids = [uid for (uid,) in db.session.query(User.id).filter(User.username.like('bench_feed_%'))]
+    db.session.execute(Post.__table__.insert(), [
+        {'content': SHORT_TEXT * 3, 'user_id': user_ids[0], 'date': now - timedelta(minutes=n), 'pinned': False,
+         'edit_count': 0} for n in range(post_count)])
+    post_ids = [pid for (pid,) in db.session.query(Post.id)]
+    db.session.execute(Reply.__table__.insert(), [
+        {'content': 'Короткий ответ', 'post_id': pid, 'user_id': user_ids[1], 'date': now}
+        for pid in post_ids for _ in range(3)])
+    db.session.execute(Vote.__table__.insert(), [
+        {'user_id': uid, 'post_id': pid, 'vote_type': 1, 'date': now} for pid in post_ids for uid in user_ids[1:]])
+    db.session.execute(main.vote_score_update())
+    db.session.commit()
+
+
+def fetch_index(client):
+    started = time.perf_counter()
+    response = client.get('/', buffered=False)
+    chunks = iter(response.response)
+    first = next(chunks, b'')
+    first_byte = time.perf_counter() - started
+    size = len(first) + sum(len(chunk) for chunk in chunks)
+    response.close()
+    return first_byte, time.perf_counter() - started, size
+
+
+def ttfb_report(post_count, repeat):
+    app.config['RATE_LIMIT_ENABLED'] = False
+    app.config['PAGE_CACHE_ENABLED'] = False  # Measure rendering, not the anonymous page cache
+    with app.app_context():
+        seed_large_feed(post_count)
+    client = app.test_client()
+    client.get('/?tag=bench-no-such-tag').close()  # Compile the template and warm the connection pool
+
+    print(f'index page with {post_count} posts, best of {repeat}')
+    print(f"{'mode':<12}{'TTFB':>12}{'total':>12}{'bytes':>12}{'peak heap':>14}")
+    for mode in ('buffered', 'streamed'):
+        app.config['INDEX_STREAMING'] = mode == 'streamed'
+        runs = [fetch_index(client) for _ in range(repeat)]
+        # ru_maxrss is useless here: building the brotli assets at import already set a higher mark.
+        # Trace the Python heap on a separate, untimed request instead.
+        tracemalloc.start()
+        fetch_index(client)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{mode:<12}{format_time(min(r[0] for r in runs)):>12}{format_time(min(r[1] for r in runs)):>12}'
+              f'{runs[0][2]:>12}{peak / 2 ** 20:>11.1f} MB')
+
+
+def votes_report(threads, votes_per_thread):
+    # Every thread is a user clicking like on random posts as fast as the writes complete
+    with app.app_context():
+        db.create_all()
+        now = datetime.utcnow()
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'bench_clicker_{n}', 'password_hash': 'x', 'about_me': '', 'is_admin': False,
+             'is_banned': False} for n in range(threads)])
+        db.session.execute(Post.__table__.insert(), [
+            {'content': SHORT_TEXT, 'user_id': 1, 'date': now, 'pinned': False, 'edit_count': 0} for _ in range(200)])
+        db.session.commit()
+        user_ids = [uid for (uid,) in db.session.query(User.id).filter(User.username.like('bench_clicker_%'))]
+        post_ids = [pid for (pid,) in db.session.query(Post.id)]
+
+    def clicker(user_id, seed):
+        rng = random.Random(seed)
+        with app.app_context():
+            for _ in range(votes_per_thread):
+                main.submit_vote(user_id, rng.choice(post_ids), 1)
+
+    print(f'{threads} threads x {votes_per_thread} votes on a file SQLite database')
+    print(f"{'mode':<12}{'votes/s':>10}{'total':>10}")
+    for mode in ('per-vote', 'batched'):
+        app.config['VOTE_BATCHING'] = mode == 'batched'
+        workers = [threading.Thread(target=clicker, args=(uid, n)) for n, uid in enumerate(user_ids)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        print(f'{mode:<12}{threads * votes_per_thread / elapsed:>10.0f}{format_time(elapsed):>10}')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(name_filter=None, repeat=5, min_time=0.2):
+    results = {}
+    with app.app_context():
+        fixtures = Fixtures()
+        with app.test_request_context('/'):
+            login_user(fixtures.viewer)
+            for name, setup in BENCHMARKS.items():
+                if name_filter and name_filter not in name:
+                    continue
+                results[name] = measure(setup(fixtures), repeat, min_time)
+                print(f'{name:<52}{format_time(results[name]["min"]):>12}', flush=True)
+    return {'meta': {'revision': git_revision(), 'python': platform.python_version(),
+                     'machine': platform.machine(), 'created_at': datetime.utcnow().isoformat()},
+            'results': results}
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def result_path(name):
+    if os.sep in name or name.endswith('.json'):
+        return name
+    return os.path.join(BENCH_DIR, f'{name}.json')
+
+
+def save_results(data, name):
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    path = result_path(name)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    print(f'Saved {path}')
+
+
+def load_results(name):
+    with open(result_path(name)) as f:
+        return json.load(f)
+
+
+def compare_results(base, current, threshold):
+    print(f"{'benchmark':<52}{'base':>12}{'current':>12}{'change':>10}")
+    regressions = []
+    for name in sorted(set(base['results']) | set(current['results'])):
+        old = base['results'].get(name)
+        new = current['results'].get(name)
+        if not old or not new:
+            print(f'{name:<52}{format_time(old["min"]) if old else "-":>12}'
+                  f'{format_time(new["min"]) if new else "-":>12}{"n/a":>10}')
+            continue
+        change = (new['min'] - old['min']) / old['min'] * 100 if old['min'] else 0.0
+        marker = ''
+        if change > threshold:
+            marker = '  SLOWER'
+            regressions.append(name)
+        elif change < -threshold:
+            marker = '  faster'
+        print(f'{name:<52}{format_time(old["min"]):>12}{format_time(new["min"]):>12}{change:>+9.1f}%{marker}')
+    if regressions:
+        print(f'\n{len(regressions)} benchmark(s) slower than +{threshold:.0f}%: {", ".join(regressions)}')
+    return regressions
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description='AnonN hot path micro-benchmarks.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run_parser = sub.add_parser('run', help='Run the benchmarks.')
+    run_parser.add_argument('-k', dest='name_filter', default=None, help='Only run benchmarks containing this text.')
+    run_parser.add_argument('--save', default=None, help='Store results as benchmarks/<name>.json.')
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--min-time', type=float, default=0.2, help='Seconds per timing round.')
+    compare_parser = sub.add_parser('compare', help='Compare results against a stored baseline.')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('current', nargs='?', default=None,
+                                help='Stored results to compare; runs the suite now when omitted.')
+    compare_parser.add_argument('-k', dest='name_filter', default=None)
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help='Allowed slowdown in percent.')
+    compare_parser.add_argument('--repeat', type=int, default=5)
+    compare_parser.add_argument('--min-time', type=float, default=0.2)
+    sub.add_parser('wire', help='Show response sizes and gzip cost for typical feed pages.')
+    ttfb_parser = sub.add_parser('ttfb', help='Time to first byte and peak memory of a large index page.')
+    ttfb_parser.add_argument('--posts', type=int, default=1000)
+    ttfb_parser.add_argument('--repeat', type=int, default=3)
+    votes_parser = sub.add_parser('votes', help='Sustained vote writes per second, per-vote commits vs batched.')
+    votes_parser.add_argument('--threads', type=int, default=16)
+    votes_parser.add_argument('--votes', type=int, default=200, help='Votes per thread.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'wire':
+        wire_report()
+        return 0
+
+    if args.command == 'ttfb':
+        ttfb_report(args.posts, args.repeat)
+        return 0
+
+    if args.command == 'votes':
+        votes_report(args.threads, args.votes)
+        return 0
+
+    if args.command == 'run':
+        data = run_benchmarks(args.name_filter, args.repeat, args.min_time)
+        if args.save:
+            save_results(data, args.save)
+        return 0
+
+    base = load_results(args.base)
+    if args.current:
+        current = load_results(args.current)
+    else:
+        current = run_benchmarks(args.name_filter, args.repeat, args.min_time)
+        print()
+    return 1 if compare_results(base, current, args.threshold) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,274 @@
+# Local load driver for AnonN (main.py).
+#
+# Replays a browser-like traffic mix against a running instance:
+#   - index page views
+#   - the 3 s /get_new_posts poll of an open feed tab
+#   - votes
+#   - the 3.5 s DM poll of an open chat, conversation list refreshes and DM sends
+# and reports p50/p95/p99 latency and throughput per endpoint.
+#
+# Typical run against a seeded database:
+#   FLASK_APP=main.py flask seed-load --users 500 --posts 20000
+#   python main.py
+#   python loadtest.py --url http://127.0.0.1:5000 --clients 50 --duration 60
+#
+# All virtual clients share one IP, so start the server with RATE_LIMIT_ENABLED=0 unless the
+# per-IP limits are what you want to measure.
+import argparse
+import http.cookiejar
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+POST_ID_RE = re.compile(r'data-post-id="(\d+)"')
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, seconds, status):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+            if status == 0 or status >= 400:
+                self.errors[endpoint] += 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class VirtualBrowser:
+    def __init__(self, base_url, username, password, stats, rng, mix):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.stats = stats
+        self.rng = rng
+        self.mix = mix
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.user_id = None
+        self.post_ids = []
+        self.latest_post_id = 0
+        self.dm_partner_ids = []
+        self.active_chat_id = None
+        self.last_dm_id = None
+
+    def request(self, endpoint, path, method='GET', data=None, json_body=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        started = time.perf_counter()
+        status, payload = 0, b''
+        try:
+            with self.opener.open(req, timeout=30) as response:
+                payload = response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+            payload = e.read()
+        except (urllib.error.URLError, OSError):
+            status = 0
+        self.stats.record(endpoint, time.perf_counter() - started, status)
+        return status, payload
+
+    def login(self):
+        status, _ = self.request('login', '/login', method='POST',
+                                 data={'username': self.username, 'password': self.password})
+        if status >= 400 or status == 0:
+            return False
+        search_prefix = self.username.rsplit('_', 1)[0] + '_'
+        status, payload = self.request('dm_search', '/api/users/search_for_dm?q=' + urllib.parse.quote(search_prefix))
+        if status == 200:
+            self.dm_partner_ids = [u['id'] for u in json.loads(payload).get('users', [])]
+        return True
+
+    def view_index(self):
+        sort_by = self.rng.choice(('date_desc', 'date_desc', 'date_desc', 'score_desc', 'hot', 'activity', 'date_asc'))
+        status, payload = self.request('index', f'/?sort_by={sort_by}')
+        if status == 200:
+            ids = [int(i) for i in POST_ID_RE.findall(payload.decode('utf-8', 'replace'))]
+            if ids:
+                self.post_ids = sorted(set(ids))
+                self.latest_post_id = max(self.latest_post_id, max(ids))
+
+    def poll_posts(self):
+        status, payload = self.request('get_new_posts', f'/get_new_posts/{self.latest_post_id}')
+        if status == 200:
+            for post in json.loads(payload).get('posts_html', []):
+                self.latest_post_id = max(self.latest_post_id, post['id'])
+
+    def vote(self):
+        if not self.post_ids:
+            return
+        post_id = self.rng.choice(self.post_ids)
+        vote_type = 'like' if self.rng.random() < 0.75 else 'dislike'
+        self.request('vote', f'/vote/{post_id}/{vote_type}', method='POST',
+                     headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    def load_conversations(self):
+        self.request('dm_conversations', '/api/direct_messages/conversations')
+
+    def open_chat(self):
+        if not self.dm_partner_ids:
+            return
+        self.active_chat_id = self.rng.choice(self.dm_partner_ids)
+        self.last_dm_id = None
+        self.poll_dm()
+
+    def poll_dm(self):
+        if not self.active_chat_id:
+            return
+        path = f'/api/direct_messages/with/{self.active_chat_id}'
+        if self.last_dm_id is not None:
+            path += f'?after_id={self.last_dm_id}'
+        status, payload = self.request('dm_poll', path)
+        if status == 200:
+            messages = json.loads(payload).get('messages', [])
+            if messages:
+                self.last_dm_id = messages[-1]['id']
+            elif self.last_dm_id is None:
+                self.last_dm_id = 0
+
+    def send_dm(self):
+        if not self.active_chat_id:
+            self.open_chat()
+        if not self.active_chat_id:
+            return
+        self.request('dm_send', '/api/direct_messages/send', method='POST',
+                     json_body={'receiver_id': self.active_chat_id, 'content': f'load test {time.time():.3f}'},
+                     headers={'X-Requested-With': 'XMLHttpRequest'})
+
+    def run(self, deadline):
+        actions = [(self.view_index, self.mix['index']), (self.vote, self.mix['vote']),
+                   (self.send_dm, self.mix['dm_send']), (self.open_chat, self.mix['dm_open']),
+                   (self.load_conversations, self.mix['dm_conversations'])]
+        funcs = [a for a, _ in actions]
+        weights = [w for _, w in actions]
+        self.view_index()
+        self.load_conversations()
+        now = time.monotonic()
+        # Stagger timers so clients do not poll in lockstep
+        next_post_poll = now + self.rng.uniform(0, 3.0)
+        next_dm_poll = now + self.rng.uniform(0, 3.5)
+        next_action = now + self.rng.expovariate(1.0 / self.mix['think_time'])
+        while time.monotonic() < deadline:
+            now = time.monotonic()
+            if now >= next_post_poll:
+                self.poll_posts()
+                next_post_poll += 3.0
+            if now >= next_dm_poll:
+                self.poll_dm()
+                next_dm_poll += 3.5
+            if now >= next_action:
+                self.rng.choices(funcs, weights)[0]()
+                next_action = time.monotonic() + self.rng.expovariate(1.0 / self.mix['think_time'])
+            time.sleep(max(0.0, min(next_post_poll, next_dm_poll, next_action, deadline) - time.monotonic()))
+
+
+def print_report(stats, elapsed):
+    header = f"{'endpoint':<18}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print('-' * len(header))
+    total = 0
+    for endpoint in sorted(stats.latencies):
+        values = sorted(stats.latencies[endpoint])
+        total += len(values)
+        print(f'{endpoint:<18}{len(values):>8}{stats.errors[endpoint]:>8}{len(values) / elapsed:>9.1f}'
+              f'{percentile(values, 0.50) * 1000:>10.1f}{percentile(values, 0.95) * 1000:>10.1f}'
+              f'{percentile(values, 0.99) * 1000:>10.1f}{values[-1] * 1000:>10.1f}')
+    print('-' * len(header))
+    print(f'{"total":<18}{total:>8}{sum(stats.errors.values()):>8}{total / elapsed:>9.1f}')
+
+
+def report_as_json(stats, elapsed):
+    result = {}
+    for endpoint, values in stats.latencies.items():
+        values = sorted(values)
+        result[endpoint] = {'count': len(values), 'errors': stats.errors[endpoint],
+                            'throughput': len(values) / elapsed,
+                            'p50_ms': percentile(values, 0.50) * 1000, 'p95_ms': percentile(values, 0.95) * 1000,
+                            'p99_ms': percentile(values, 0.99) * 1000,
+                            'statuses': {str(k): v for k, v in stats.statuses[endpoint].items()}}
+    return {'elapsed': elapsed, 'endpoints': result}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a browser traffic mix against a running AnonN instance.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=20, help='Concurrent virtual browser tabs.')
+    parser.add_argument('--duration', type=float, default=60.0, help='Seconds to run.')
+    parser.add_argument('--prefix', default='load', help='Username prefix used by `flask seed-load`.')
+    parser.add_argument('--password', default='loadtest')
+    parser.add_argument('--first-user-id', type=int, default=1,
+                        help='Suffix of the first generated username (load_<id>).')
+    parser.add_argument('--users', type=int, default=None,
+                        help='Number of generated users to log in as (defaults to --clients).')
+    parser.add_argument('--think-time', type=float, default=5.0, help='Mean seconds between user actions.')
+    parser.add_argument('--index-weight', type=float, default=4)
+    parser.add_argument('--vote-weight', type=float, default=3)
+    parser.add_argument('--dm-send-weight', type=float, default=1)
+    parser.add_argument('--dm-open-weight', type=float, default=1)
+    parser.add_argument('--dm-conversations-weight', type=float, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', dest='json_path', default=None, help='Also write the report to this JSON file.')
+    args = parser.parse_args(argv)
+
+    mix = {'index': args.index_weight, 'vote': args.vote_weight, 'dm_send': args.dm_send_weight,
+           'dm_open': args.dm_open_weight, 'dm_conversations': args.dm_conversations_weight,
+           'think_time': args.think_time}
+    stats = Stats()
+    master_rng = random.Random(args.seed)
+    user_pool = args.users or args.clients
+    browsers = []
+    for n in range(args.clients):
+        username = f'{args.prefix}_{args.first_user_id + (n % user_pool)}'
+        browser = VirtualBrowser(args.url, username, args.password, stats,
+                                 random.Random(master_rng.random()), mix)
+        if browser.login():
+            browsers.append(browser)
+        else:
+            print(f'login failed for {username}', file=sys.stderr)
+    if not browsers:
+        print('No virtual browsers could log in; did you run `flask seed-load`?', file=sys.stderr)
+        return 1
+
+    print(f'{len(browsers)} clients, {args.duration:.0f}s against {args.url}')
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=b.run, args=(deadline,), daemon=True) for b in browsers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    print_report(stats, elapsed)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report_as_json(stats, elapsed), f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,161 @@
 from flask import Flask, request, redirect, url_for, render_template_string, flash, jsonify, \
-    get_flashed_messages
+    get_flashed_messages, g, abort, Response, send_file, session, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from werkzeug.http import parse_accept_header
+from datetime import datetime, timedelta
+from collections import defaultdict, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import click
+import contextlib
+import gzip
+import hashlib
 import html
+import itertools
+import json
+import math
 import os
+import queue
+import random
 import re
-from sqlalchemy import func, or_
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from sqlalchemy import func, or_, and_, event, case, select, text, literal_column, MetaData, create_engine, \
+    inspect as sa_inspect
+from sqlalchemy.schema import AddConstraint, CreateColumn, CreateIndex, CreateTable
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.engine import Engine
+
+try:
+    import brotli
+except ImportError:  # Optional: without it assets are served gzip-compressed only
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: there scheduled jobs run without the cross-process lock
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # Optional: without it the feed API serializes with the json module
+    orjson = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a-very-secret-key-change-me-in-prod')
 # Changed DB name for this major feature
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///forum_v17_reports_design.db' # Updated DB name
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///forum_v17_reports_design.db') # Updated DB name
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Shared directory for per-worker metric snapshots (gunicorn); unset = single process
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # Optional bearer token for /metrics
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', '1.0'))
+app.config['POLL_CLIENT_WINDOW'] = 15  # Seconds a polling client counts as active
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+# SQLite file shared by all workers for token buckets; unset = in-memory buckets (single process)
+app.config['RATE_LIMIT_DB'] = os.environ.get('RATE_LIMIT_DB')
+# endpoint -> {scope: (tokens per second, burst)}; 'methods' restricts which HTTP methods are throttled
+app.config['RATE_LIMITS'] = {
+    'login': {'methods': ('POST',), 'ip': (1, 20)},
+    'register': {'methods': ('POST',), 'ip': (1 / 30, 5)},
+    'index': {'methods': ('POST',), 'user': (1 / 10, 5), 'ip': (1 / 2, 20)},
+    'reply': {'user': (1 / 5, 5), 'ip': (1, 20)},
+    'vote': {'user': (2, 10), 'ip': (10, 50)},
+    'send_direct_message': {'user': (1, 10), 'ip': (5, 30)},
+    'report_user': {'user': (1 / 60, 3), 'ip': (1 / 10, 10)},
+    'get_new_posts': {'user': (1, 5), 'ip': (10, 50)},
+    'get_conversations': {'user': (1, 5), 'ip': (10, 50)},
+    'get_messages_with_user': {'user': (1, 5), 'ip': (10, 50)},
+    'api_posts': {'user': (2, 10), 'ip': (10, 50)},
+    'api_post_replies': {'user': (2, 10), 'ip': (10, 50)},
+}
+
+# Password hashing runs on a small bounded pool so login bursts cannot starve the threads serving polls
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+app.config['PASSWORD_HASH_QUEUE_DEPTH'] = int(os.environ.get('PASSWORD_HASH_QUEUE_DEPTH', '8'))
+app.config['PASSWORD_HASH_TIMEOUT'] = 10  # Seconds a request waits for its hash before giving up
+app.config['LOGIN_FAILURE_LIMIT'] = (1 / 60, 5)  # Failed logins per username: (refill per second, burst)
+
+# Gzip for dynamic responses (HTML feed, JSON polls); static assets are precompressed and skipped
+app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+app.config['COMPRESSION_LEVEL'] = int(os.environ.get('COMPRESSION_LEVEL', '6'))
+app.config['COMPRESSION_MIN_SIZE'] = int(os.environ.get('COMPRESSION_MIN_SIZE', '500'))  # Bytes
+app.config['COMPRESSION_MIMETYPES'] = ('text/html', 'application/json', 'text/plain', 'text/css', 'text/javascript')
+
+# Send the index page shell right away and stream the posts from a DB cursor instead of building the page in memory
+app.config['INDEX_STREAMING'] = os.environ.get('INDEX_STREAMING', '1') == '1'
+app.config['INDEX_STREAM_CHUNK'] = 25  # Posts rendered per streamed chunk
+app.config['TAG_FILTER_MAX'] = 5  # Tags one feed filter may combine
+app.config['TAG_LIST_SIZE'] = 100  # Most used tags offered in the filter dropdown
+app.config['PROFILE_POSTS_PAGE_SIZE'] = 20
+app.config['API_PAGE_SIZE'] = 50  # /api/v1 listings without ?limit=
+app.config['API_MAX_PAGE_SIZE'] = 200
+
+# Rendered index pages for logged-out visitors, reused until the 'feed' data version changes
+app.config['PAGE_CACHE_ENABLED'] = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+# Directory shared by all workers for cached pages; unset = per-process memory cache
+app.config['PAGE_CACHE_DIR'] = os.environ.get('PAGE_CACHE_DIR')
+app.config['PAGE_CACHE_MAX_ENTRIES'] = 256  # Pages kept per process, or files in PAGE_CACHE_DIR
+app.config['PAGE_CACHE_WAIT'] = 5  # Seconds a request waits for another one rendering the same page
+
+app.config['DM_PAGE_SIZE'] = 50  # Messages returned when a chat is opened or scrolled back
+app.config['DM_MAX_PAGE_SIZE'] = 200
+app.config['ADMIN_REPORTS_PAGE_SIZE'] = 50  # Reported users per moderation queue page
+# Bulk moderation commits every batch and pauses between them so regular writers get the database in between
+app.config['MODERATION_BATCH_SIZE'] = 500
+app.config['MODERATION_BATCH_PAUSE'] = 0.05  # Seconds
+# Votes from concurrent requests are written by one thread per process, everything queued in one transaction
+app.config['VOTE_BATCHING'] = os.environ.get('VOTE_BATCHING', '1') == '1'
+app.config['VOTE_BATCH_MAX'] = 200
+app.config['VOTE_WRITE_TIMEOUT'] = 10  # Seconds a request waits for its vote to be written
+# sort_by=hot: a post needs ten times the points to rank level with one HOT_DECAY_SECONDS newer
+app.config['HOT_DECAY_SECONDS'] = 45000
+app.config['HOT_REPLY_WEIGHT'] = 1  # A reply counts as this many votes
+# Full rebuild of post_rank every this many seconds; 0 = only `flask rebuild-hot-ranks`
+app.config['HOT_RANK_INTERVAL'] = int(os.environ.get('HOT_RANK_INTERVAL', '0'))
+
+# Old threads and read DMs move to the archive_* tables (`flask archive`, or every ARCHIVE_INTERVAL seconds)
+app.config['ARCHIVE_POST_AGE_DAYS'] = int(os.environ.get('ARCHIVE_POST_AGE_DAYS', '180'))  # No reply newer either
+app.config['ARCHIVE_DM_AGE_DAYS'] = int(os.environ.get('ARCHIVE_DM_AGE_DAYS', '365'))
+app.config['ARCHIVE_INTERVAL'] = int(os.environ.get('ARCHIVE_INTERVAL', '0'))  # Seconds; 0 = CLI only
+app.config['ARCHIVE_PAGE_SIZE'] = 50
+# Online SQLite backups (`flask backup`, or every BACKUP_INTERVAL seconds), copied BACKUP_PAGES_PER_STEP pages at a
+# time with a pause after each step so writers never wait for more than one step
+app.config['BACKUP_DIR'] = os.environ.get('BACKUP_DIR', os.path.join(app.instance_path, 'backups'))
+app.config['BACKUP_KEEP'] = int(os.environ.get('BACKUP_KEEP', '7'))  # Newest backups kept; 0 = keep all
+app.config['BACKUP_INTERVAL'] = int(os.environ.get('BACKUP_INTERVAL', '0'))  # Seconds; 0 = CLI only
+app.config['BACKUP_PAGES_PER_STEP'] = 1024
+app.config['BACKUP_STEP_SLEEP'] = 0.05  # Seconds
+app.config['BACKUP_MAX_RESTARTS'] = 5  # Then the rest is copied in one step
+# Scheduled jobs hold a lock file here while they run so only one worker runs each job per round
+app.config['SCHEDULER_LOCK_DIR'] = os.environ.get('SCHEDULER_LOCK_DIR', tempfile.gettempdir())
+
+# Number of reverse proxies (load balancer) in front of the app whose X-Forwarded-For is trusted
+_trusted_proxy_count = int(os.environ.get('TRUSTED_PROXY_COUNT', '0'))
+if _trusted_proxy_count:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=_trusted_proxy_count, x_proto=_trusted_proxy_count)
 
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys, and with them ON DELETE CASCADE, unless enabled on every connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -24,17 +163,19 @@ login_manager.login_message = "Пожалуйста, войдите, чтобы
 login_manager.login_message_category = "info"
 
 # --- Models ---
+CONVERSATION_PREVIEW_LENGTH = 100
 
 post_tags = db.Table('post_tags',
-                     db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
-                     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+                     db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True),
+                     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+                     db.Index('ix_post_tags_tag_post', 'tag_id', 'post_id')  # A tag's posts; see tagged_post_ids()
                      )
 
 
 class UserAchievement(db.Model):
     __tablename__ = 'user_achievement'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
-    achievement_id = db.Column(db.Integer, db.ForeignKey('achievement.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    achievement_id = db.Column(db.Integer, db.ForeignKey('achievement.id', ondelete='CASCADE'), primary_key=True)
     awarded_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     user = db.relationship('User', back_populates='user_achievements_association')
@@ -50,7 +191,8 @@ class Achievement(db.Model):
     condition_type = db.Column(db.String(50), nullable=False)
     condition_value = db.Column(db.Integer, nullable=False)
 
-    user_associations = db.relationship('UserAchievement', back_populates='achievement', cascade="all, delete-orphan")
+    user_associations = db.relationship('UserAchievement', back_populates='achievement', cascade="all, delete-orphan",
+                                        passive_deletes=True)
 
     def __repr__(self):
         return f'<Achievement {self.name}>'
@@ -65,22 +207,26 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     is_banned = db.Column(db.Boolean, default=False)
 
-    posts = db.relationship('Post', backref='author', lazy='dynamic')
-    replies = db.relationship('Reply', backref='author', lazy='dynamic')
-    votes = db.relationship('Vote', backref='voter', lazy='dynamic', cascade="all, delete-orphan")
+    # passive_deletes: the foreign keys cascade in the database, so deleting a user does not load these first
+    posts = db.relationship('Post', backref='author', lazy='dynamic', cascade="all, delete-orphan",
+                            passive_deletes=True)
+    replies = db.relationship('Reply', backref='author', lazy='dynamic', cascade="all, delete-orphan",
+                              passive_deletes=True)
+    votes = db.relationship('Vote', backref='voter', lazy='dynamic', cascade="all, delete-orphan",
+                            passive_deletes=True)
 
     user_achievements_association = db.relationship('UserAchievement', back_populates='user',
-                                                    cascade="all, delete-orphan")
+                                                    cascade="all, delete-orphan", passive_deletes=True)
 
     # Relationships for direct messages
     sent_messages = db.relationship('DirectMessage', foreign_keys='DirectMessage.sender_id', backref='sender',
-                                    lazy='dynamic', cascade="all, delete-orphan")
+                                    lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
     received_messages = db.relationship('DirectMessage', foreign_keys='DirectMessage.receiver_id', backref='receiver',
-                                        lazy='dynamic', cascade="all, delete-orphan")
+                                        lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
 
     # Relationships for reports (new)
-    reported_by_others = db.relationship('Report', foreign_keys='Report.reported_user_id', backref='reported_user', lazy='dynamic', cascade="all, delete-orphan")
-    reports_made = db.relationship('Report', foreign_keys='Report.reporter_id', backref='reporter', lazy='dynamic', cascade="all, delete-orphan")
+    reported_by_others = db.relationship('Report', foreign_keys='Report.reported_user_id', backref='reported_user', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
+    reports_made = db.relationship('Report', foreign_keys='Report.reporter_id', backref='reporter', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True)
 
 
     @property
@@ -88,10 +234,14 @@ class User(UserMixin, db.Model):
         return [ua.achievement for ua in self.user_achievements_association]
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+    @property
+    def password_needs_rehash(self):
+        return self.password_hash.split('$', 1)[0] != password_hash_prefix()
 
     @property
     def is_active(self):
@@ -105,6 +255,7 @@ class Tag(db.Model):
     __tablename__ = 'tag'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)  # See tag_count_update()
 
     def __repr__(self):
         return f'<Tag {self.name}>'
@@ -115,21 +266,32 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     date = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     pinned = db.Column(db.Boolean, default=False)
     last_edited_at = db.Column(db.DateTime, nullable=True)
     edit_count = db.Column(db.Integer, default=0)
-
-    replies = db.relationship('Reply', backref='post', lazy='dynamic', cascade="all, delete-orphan")
-    tags = db.relationship('Tag', secondary=post_tags, lazy='subquery',
-                           backref=db.backref('posts', lazy='dynamic'))
-    votes = db.relationship('Vote', backref='post', lazy='dynamic', cascade="all, delete-orphan")
+    vote_score = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Likes - dislikes
+    # Kept by reply() and delete_reply(); post_activity_update() recounts them
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_activity_at = db.Column(db.DateTime, default=datetime.utcnow)  # Newest reply, or the post itself
+
+    # sqlite_autoincrement: ids of deleted and archived posts are never handed out again (see ARCHIVED_ID_TABLES)
+    __table_args__ = (db.Index('ix_post_user_recent', 'user_id', 'id'),  # A profile's posts, newest first
+                      db.Index('ix_post_pinned_activity', 'pinned', 'last_activity_at'),  # sort_by=activity
+                      {'sqlite_autoincrement': True})
+
+    # passive_deletes: replies, votes and tag links go with the post via ON DELETE CASCADE, in one statement
+    replies = db.relationship('Reply', backref='post', lazy='dynamic', cascade="all, delete-orphan",
+                              passive_deletes=True)
+    tags = db.relationship('Tag', secondary=post_tags, lazy='subquery', passive_deletes=True,
+                           backref=db.backref('posts', lazy='dynamic', passive_deletes=True))
+    votes = db.relationship('Vote', backref='post', lazy='dynamic', cascade="all, delete-orphan",
+                            passive_deletes=True)
 
     @property
     def score(self):
-        likes = self.votes.filter_by(vote_type=1).count()
-        dislikes = self.votes.filter_by(vote_type=-1).count()
-        return likes - dislikes
+        # Kept in step with the vote table by apply_votes(); `flask rebuild-vote-scores` recomputes it
+        return self.vote_score or 0
 
     def __repr__(self):
         return f'<Post {self.id} by User {self.user_id}>'
@@ -140,8 +302,9 @@ class Reply(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     date = db.Column(db.DateTime, default=datetime.utcnow)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    __table_args__ = {'sqlite_autoincrement': True}
 
     def __repr__(self):
         return f'<Reply {self.id} to Post {self.post_id} by User {self.user_id}>'
@@ -150,12 +313,13 @@ class Reply(db.Model):
 class Vote(db.Model):
     __tablename__ = 'vote'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False, index=True)
     vote_type = db.Column(db.Integer, nullable=False)  # 1 for like, -1 for dislike
     date = db.Column(db.DateTime, default=datetime.utcnow)
 
-    __table_args__ = (db.UniqueConstraint('user_id', 'post_id', name='uq_user_post_vote'),)
+    __table_args__ = (db.UniqueConstraint('user_id', 'post_id', name='uq_user_post_vote'),
+                      {'sqlite_autoincrement': True})
 
     def __repr__(self):
         return f'<Vote {self.vote_type} by User {self.user_id} for Post {self.post_id}>'
@@ -164,29 +328,1067 @@ class Vote(db.Model):
 class DirectMessage(db.Model):
     __tablename__ = 'direct_message'
     id = db.Column(db.Integer, primary_key=True)
-    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     is_read = db.Column(db.Boolean, default=False)
+    # One range scan per direction of a conversation, already in id order (keyset pagination)
+    __table_args__ = (db.Index('ix_direct_message_pair_id', 'sender_id', 'receiver_id', 'id'),
+                      {'sqlite_autoincrement': True})
 
     def __repr__(self):
         return f'<DirectMessage from {self.sender_id} to {self.receiver_id} at {self.timestamp}>'
 
+
+# One row per pair of users who exchanged messages (user_low_id < user_high_id), kept in step with
+# direct_message by the send and mark-read handlers so the conversation list is a plain indexed read
+class Conversation(db.Model):
+    __tablename__ = 'conversation'
+    id = db.Column(db.Integer, primary_key=True)
+    user_low_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    user_high_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('direct_message.id', ondelete='SET NULL'), nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    last_sender_id = db.Column(db.Integer, nullable=True)
+    last_message_preview = db.Column(db.String(CONVERSATION_PREVIEW_LENGTH), nullable=True)
+    unread_low = db.Column(db.Integer, nullable=False, default=0)  # Unread by user_low_id
+    unread_high = db.Column(db.Integer, nullable=False, default=0)  # Unread by user_high_id
+    __table_args__ = (db.UniqueConstraint('user_low_id', 'user_high_id', name='uq_conversation_pair'),
+                      db.Index('ix_conversation_low_last', 'user_low_id', 'last_message_at'),
+                      db.Index('ix_conversation_high_last', 'user_high_id', 'last_message_at'))
+
+    def __repr__(self):
+        return f'<Conversation {self.user_low_id}<->{self.user_high_id} last {self.last_message_id}>'
+
 # New Report Model
 class Report(db.Model):
     __tablename__ = 'report'
     id = db.Column(db.Integer, primary_key=True)
-    reporter_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    reported_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    reporter_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    reported_user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     reason = db.Column(db.Text, nullable=True) # Reason can be optional
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     is_resolved = db.Column(db.Boolean, default=False) # To track if admin has reviewed
+    __table_args__ = (db.Index('ix_report_resolved_timestamp', 'is_resolved', 'timestamp'),
+                      # Also finds a user's latest report: the newest entry of its (is_resolved, reported_user_id) range
+                      db.Index('ix_report_resolved_reported_user_latest', 'is_resolved', 'reported_user_id',
+                               'timestamp', 'id'))
 
     def __repr__(self):
         return f'<Report {self.id} by {self.reporter_id} on {self.reported_user_id}>'
 
 
+# Counters bumped in the same transaction as the writes they describe ('feed', 'profile:<id>', 'dm:<id>');
+# conditional GETs compare them instead of re-querying and re-rendering
+class DataVersion(db.Model):
+    __tablename__ = 'data_version'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DataVersion {self.name}={self.version}>'
+
+
+# Profile counters, archived rows included; see update_user_stats()
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    votes_cast = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    karma = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Sum of the votes on their posts
+    last_active_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<UserStats {self.user_id}>'
+
+
+# Precomputed sort_by=hot order, one row per post; see refresh_hot_ranks()
+class PostRank(db.Model):
+    __tablename__ = 'post_rank'
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True)
+    hot_score = db.Column(db.Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<PostRank {self.post_id}={self.hot_score:.3f}>'
+
+
+# Progress of resumable copies from other databases (`flask migrate-anonn`): last copied source id per table
+class MigrationCheckpoint(db.Model):
+    __tablename__ = 'migration_checkpoint'
+    name = db.Column(db.String(64), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<MigrationCheckpoint {self.name} at {self.last_id}>'
+
+
+# Archive tables: the live columns (ids included) of old threads and read DMs, moved out of post, reply, vote
+# and direct_message so the hot tables and their indexes only hold the recent working set
+class ArchivedPost(db.Model):
+    __tablename__ = 'archived_post'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    content = db.Column(db.Text, nullable=False)
+    date = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    pinned = db.Column(db.Boolean, default=False)
+    last_edited_at = db.Column(db.DateTime, nullable=True)
+    edit_count = db.Column(db.Integer, default=0)
+    tags = db.Column(db.Text, nullable=True)  # Tag names, comma-separated
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ArchivedPost {self.id} by User {self.user_id}>'
+
+
+class ArchivedReply(db.Model):
+    __tablename__ = 'archived_reply'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    content = db.Column(db.Text, nullable=False)
+    date = db.Column(db.DateTime)
+    post_id = db.Column(db.Integer, db.ForeignKey('archived_post.id', ondelete='CASCADE'), nullable=False,
+                        index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<ArchivedReply {self.id} to Post {self.post_id} by User {self.user_id}>'
+
+
+class ArchivedVote(db.Model):
+    __tablename__ = 'archived_vote'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('archived_post.id', ondelete='CASCADE'), nullable=False,
+                        index=True)
+    vote_type = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<ArchivedVote {self.vote_type} by User {self.user_id} for Post {self.post_id}>'
+
+
+class ArchivedDirectMessage(db.Model):
+    __tablename__ = 'archived_direct_message'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime)
+    is_read = db.Column(db.Boolean, default=True)
+    __table_args__ = (db.Index('ix_archived_direct_message_pair_id', 'sender_id', 'receiver_id', 'id'),)
+
+    def __repr__(self):
+        return f'<ArchivedDirectMessage from {self.sender_id} to {self.receiver_id} at {self.timestamp}>'
+
+
+# Live tables whose rows keep their ids in the archive. New live ids have to stay above both: the live tables
+# are AUTOINCREMENT on SQLite (PostgreSQL sequences never go back), and after a rebuild or an import the
+# sequences are moved past the archived ids, which the live table no longer holds.
+ARCHIVED_ID_TABLES = ((Post.__table__, ArchivedPost.__table__), (Reply.__table__, ArchivedReply.__table__),
+                      (Vote.__table__, ArchivedVote.__table__),
+                      (DirectMessage.__table__, ArchivedDirectMessage.__table__))
+
+
+def raise_sqlite_sequences(connection):
+    for live, archive in ARCHIVED_ID_TABLES:
+        top = connection.execute(select(func.max(archive.c.id))).scalar()
+        if top is None:
+            continue
+        params = {'name': live.name, 'top': top}
+        connection.execute(text('UPDATE sqlite_sequence SET seq = :top WHERE name = :name AND seq < :top'), params)
+        connection.execute(text('INSERT INTO sqlite_sequence (name, seq) SELECT :name, :top '
+                                'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)'), params)
+
+
+# --- Metrics ---
+# Prometheus text format. Every worker keeps its own counters in memory and, when METRICS_DIR is set,
+# periodically snapshots them to METRICS_DIR/metrics-<pid>-<start>.json; /metrics merges all snapshots.
+HTTP_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+METRIC_HELP = {
+    'anonn_http_requests_total': ('counter', 'HTTP requests by route, method and status.'),
+    'anonn_http_request_duration_seconds': ('histogram', 'HTTP request latency by route.'),
+    'anonn_db_statement_duration_seconds': ('histogram', 'Database statement count and time by kind.'),
+    'anonn_active_polling_clients': ('gauge', 'Distinct clients that polled an endpoint recently.'),
+    'anonn_cache_requests_total': ('counter', 'Cache lookups by cache and result.'),
+    'anonn_cache_hit_ratio': ('gauge', 'Cache hits / lookups since start.'),
+    'anonn_achievements_awarded_total': ('counter', 'Achievements awarded.'),
+    'anonn_rate_limited_total': ('counter', 'Requests rejected with 429 by route and limit scope.'),
+    'anonn_password_hash_duration_seconds': ('histogram', 'Time spent hashing or verifying passwords.'),
+    'anonn_password_hash_rejected_total': ('counter', 'Password hash jobs rejected because the pool was full.'),
+    'anonn_compression_bytes_total': ('counter', 'Response bytes before (in) and after (out) compression.'),
+    'anonn_archived_rows_total': ('counter', 'Rows moved to the archive tables by table.'),
+    'anonn_backup_duration_seconds': ('histogram', 'Time taken by online database backups.'),
+    'anonn_vote_batch_size': ('histogram', 'Votes written per transaction.'),
+}
+POLL_ENDPOINTS = {'get_new_posts', 'get_messages_with_user', 'get_conversations'}
+
+_metrics_lock = threading.Lock()
+_metrics_counters = defaultdict(float)  # (name, labels) -> value
+_metrics_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_metrics_buckets = {}  # name -> bucket bounds
+_poll_clients = defaultdict(dict)  # endpoint -> {client key: last seen}
+_metrics_process_id = f'{os.getpid()}-{int(time.time())}'
+_metrics_last_flush = 0.0
+
+
+def _metric_labels(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def metrics_inc(name, labels=None, value=1):
+    with _metrics_lock:
+        _metrics_counters[(name, _metric_labels(labels))] += value
+
+
+def metrics_observe(name, value, labels=None, buckets=HTTP_LATENCY_BUCKETS):
+    key = (name, _metric_labels(labels))
+    with _metrics_lock:
+        _metrics_buckets.setdefault(name, buckets)
+        series = _metrics_histograms.get(key)
+        if series is None:
+            series = _metrics_histograms[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(buckets)] += 1
+        series[-1] += value
+
+
+def metrics_cache(cache_name, hit):
+    metrics_inc('anonn_cache_requests_total', {'cache': cache_name, 'result': 'hit' if hit else 'miss'})
+
+
+def _metrics_snapshot():
+    with _metrics_lock:
+        return {
+            'counters': [[name, labels, value] for (name, labels), value in _metrics_counters.items()],
+            'histograms': [[name, labels, list(series)] for (name, labels), series in _metrics_histograms.items()],
+            'buckets': dict(_metrics_buckets),
+            'poll_clients': {endpoint: dict(clients) for endpoint, clients in _poll_clients.items()},
+        }
+
+
+def _prune_poll_clients():
+    # Drop clients that went quiet so the per-process maps stay bounded
+    cutoff = time.time() - app.config['POLL_CLIENT_WINDOW']
+    with _metrics_lock:
+        for clients in _poll_clients.values():
+            for client in [c for c, last_seen in clients.items() if last_seen < cutoff]:
+                del clients[client]
+
+
+def _metrics_flush(force=False):
+    global _metrics_last_flush
+    now = time.time()
+    if not force and now - _metrics_last_flush < app.config['METRICS_FLUSH_INTERVAL']:
+        return
+    _metrics_last_flush = now
+    _prune_poll_clients()
+    metrics_dir = app.config['METRICS_DIR']
+    if not metrics_dir:
+        return
+    path = os.path.join(metrics_dir, f'metrics-{_metrics_process_id}.json')
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(_metrics_snapshot(), f)
+        os.replace(tmp_path, path)  # Atomic, so readers never see a half-written snapshot
+    except OSError as e:
+        app.logger.warning(f"Could not write metrics snapshot {path}: {e}")
+
+
+def _metrics_collect():
+    _metrics_flush(force=True)
+    snapshots = [_metrics_snapshot()]
+    metrics_dir = app.config['METRICS_DIR']
+    if metrics_dir and os.path.isdir(metrics_dir):
+        own_file = f'metrics-{_metrics_process_id}.json'
+        for filename in os.listdir(metrics_dir):
+            if not filename.startswith('metrics-') or not filename.endswith('.json') or filename == own_file:
+                continue
+            try:
+                with open(os.path.join(metrics_dir, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # Worker is mid-replace or the file is gone; next scrape picks it up
+
+    counters = defaultdict(float)
+    histograms = {}
+    buckets = {}
+    poll_clients = defaultdict(dict)
+    for snapshot in snapshots:
+        buckets.update(snapshot['buckets'])
+        for name, labels, value in snapshot['counters']:
+            counters[(name, tuple(map(tuple, labels)))] += value
+        for name, labels, series in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], series)]
+            else:
+                histograms[key] = list(series)
+        for endpoint, clients in snapshot['poll_clients'].items():
+            merged = poll_clients[endpoint]
+            for client, last_seen in clients.items():
+                merged[client] = max(last_seen, merged.get(client, 0))
+    return counters, histograms, buckets, poll_clients
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_metrics():
+    counters, histograms, buckets, poll_clients = _metrics_collect()
+    now = time.time()
+    gauges = defaultdict(float)
+    for endpoint in POLL_ENDPOINTS:
+        active = sum(1 for last_seen in poll_clients.get(endpoint, {}).values()
+                     if now - last_seen <= app.config['POLL_CLIENT_WINDOW'])
+        gauges[('anonn_active_polling_clients', (('endpoint', endpoint),))] = active
+    cache_totals = defaultdict(lambda: [0.0, 0.0])
+    for (name, labels), value in counters.items():
+        if name == 'anonn_cache_requests_total':
+            label_dict = dict(labels)
+            cache_totals[label_dict['cache']][0 if label_dict['result'] == 'hit' else 1] += value
+    for cache_name, (hits, misses) in cache_totals.items():
+        gauges[('anonn_cache_hit_ratio', (('cache', cache_name),))] = hits / (hits + misses) if hits + misses else 0.0
+
+    series_by_name = defaultdict(list)
+    for (name, labels), value in list(counters.items()) + list(gauges.items()):
+        series_by_name[name].append(f'{name}{_format_labels(labels)} {value:g}')
+    for (name, labels), series in histograms.items():
+        bounds = buckets[name]
+        cumulative = 0
+        lines = series_by_name[name]
+        for bound, count in zip(bounds, series):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", f"{bound:g}"),))} {cumulative}')
+        cumulative += series[len(bounds)]
+        lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {series[-1]:g}')
+        lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+
+    output = []
+    for name in sorted(series_by_name):
+        metric_type, help_text = METRIC_HELP.get(name, ('untyped', name))
+        output.append(f'# HELP {name} {help_text}')
+        output.append(f'# TYPE {name} {metric_type}')
+        output.extend(sorted(series_by_name[name]))
+    return '\n'.join(output) + '\n'
+
+
+# The start time lives on the statement's execution context rather than on the connection, so a statement
+# that raises (and never reaches after_cursor_execute) leaves nothing behind to pair with the next one
+@event.listens_for(Engine, 'before_cursor_execute')
+def _metrics_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _metrics_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'metrics_query_start', None)
+    if started is None:
+        return
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    metrics_observe('anonn_db_statement_duration_seconds', time.perf_counter() - started,
+                    {'kind': kind}, buckets=DB_LATENCY_BUCKETS)
+
+
+@app.before_request
+def _metrics_start_timer():
+    g.metrics_request_started = time.perf_counter()
+
+
+@app.after_request
+def _metrics_record_request(response):
+    started = g.pop('metrics_request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics_observe('anonn_http_request_duration_seconds', time.perf_counter() - started,
+                        {'route': route, 'method': request.method})
+        metrics_inc('anonn_http_requests_total',
+                    {'route': route, 'method': request.method, 'status': str(response.status_code)})
+        if request.endpoint in POLL_ENDPOINTS:
+            client = f'user:{current_user.id}' if current_user.is_authenticated else f'ip:{request.remote_addr}'
+            with _metrics_lock:
+                _poll_clients[request.endpoint][client] = time.time()
+    _metrics_flush()
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+# --- Rate Limiting ---
+def token_bucket_take(tokens, updated, rate, burst, now, cost=1):
+    # Returns (tokens left, seconds until a token is available); 0 means the request may proceed.
+    # cost=0 only checks the bucket without consuming from it.
+    if tokens is None:
+        tokens, updated = burst, now
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - cost, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryTokenBucketStore:
+    MAX_KEYS = 50000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (None, None))
+            tokens, retry_after = token_bucket_take(tokens, updated, rate, burst, now, cost)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.MAX_KEYS:
+                # Idle buckets have refilled completely; forgetting them changes nothing
+                cutoff = now - 3600
+                self._buckets = {k: v for k, v in self._buckets.items() if v[1] >= cutoff}
+        return retry_after
+
+
+class SQLiteTokenBucketStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS token_bucket '
+                                   '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=2, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')  # Losing a few buckets on power loss is harmless
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, cost=1):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM token_bucket WHERE key = ?', (key,)).fetchone()
+            tokens, retry_after = token_bucket_take(row[0] if row else None, row[1] if row else None,
+                                                    rate, burst, now, cost)
+            conn.execute('INSERT INTO token_bucket (key, tokens, updated) VALUES (?, ?, ?) '
+                         'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                         (key, tokens, now))
+            if random.random() < 0.001:
+                conn.execute('DELETE FROM token_bucket WHERE updated < ?', (now - 3600,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return retry_after
+
+
+rate_limit_store = (SQLiteTokenBucketStore(app.config['RATE_LIMIT_DB']) if app.config['RATE_LIMIT_DB']
+                    else MemoryTokenBucketStore())
+
+
+def rate_limit_retry_after(name, limits):
+    # The user's own bucket is checked first and a denial stops there, so a client over its user limit does not
+    # keep draining the IP bucket it shares with everyone behind the same address
+    scopes = []
+    if 'user' in limits and current_user.is_authenticated:
+        scopes.append(('user', current_user.id))
+    if 'ip' in limits:
+        scopes.append(('ip', request.remote_addr))
+    for scope, identity in scopes:
+        rate, burst = limits[scope]
+        try:
+            wait = rate_limit_store.take(f'{name}:{scope}:{identity}', rate, burst)
+        except sqlite3.Error as e:
+            app.logger.warning(f"Rate limit store unavailable, allowing request: {e}")
+            return 0.0
+        if wait:
+            metrics_inc('anonn_rate_limited_total', {'route': name, 'scope': scope})
+            return wait
+    return 0.0
+
+
+def wants_json_response():
+    return (request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json
+            or request.path.startswith('/api/') or request.endpoint == 'get_new_posts')
+
+
+def too_many_requests(retry_after):
+    seconds = max(1, math.ceil(retry_after))
+    message = f'Слишком много запросов. Повторите через {seconds} с.'
+    if wants_json_response():
+        response = jsonify({'success': False, 'message': message, 'retry_after': seconds})
+    else:
+        response = Response(f'<!DOCTYPE html><html lang="ru"><meta charset="UTF-8"><p>{message}</p>'
+                            f'<p><a href="javascript:history.back()">Назад</a></p></html>', mimetype='text/html')
+    response.status_code = 429
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+@app.before_request
+def enforce_rate_limits():
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return None
+    limits = app.config['RATE_LIMITS'].get(request.endpoint)
+    if not limits or request.method not in limits.get('methods', (request.method,)):
+        return None
+    retry_after = rate_limit_retry_after(request.endpoint, limits)
+    if retry_after:
+        return too_many_requests(retry_after)
+    return None
+
+
+# --- Password Hashing ---
+class PasswordHashingOverloaded(Exception):
+    pass
+
+
+password_hash_executor = ThreadPoolExecutor(max_workers=app.config['PASSWORD_HASH_WORKERS'],
+                                            thread_name_prefix='password-hash')
+# Jobs running plus jobs queued; beyond this new logins are turned away instead of piling up
+_password_hash_slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_WORKERS'] +
+                                                  app.config['PASSWORD_HASH_QUEUE_DEPTH'])
+
+
+def _timed_password_job(func, *args):
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        metrics_observe('anonn_password_hash_duration_seconds', time.perf_counter() - started)
+
+
+def run_password_job(func, *args):
+    if not _password_hash_slots.acquire(blocking=False):
+        metrics_inc('anonn_password_hash_rejected_total')
+        raise PasswordHashingOverloaded()
+    try:
+        future = password_hash_executor.submit(_timed_password_job, func, *args)
+    except BaseException:
+        _password_hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: _password_hash_slots.release())
+    try:
+        return future.result(timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+    except FutureTimeoutError:
+        metrics_inc('anonn_password_hash_rejected_total')
+        raise PasswordHashingOverloaded()
+
+
+def hash_password(password):
+    return run_password_job(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(password_hash, password):
+    return run_password_job(check_password_hash, password_hash, password)
+
+
+_password_hash_prefixes = {}
+
+
+def password_hash_prefix():
+    # What werkzeug stores before the salt for PASSWORD_HASH_METHOD, which it may expand ('scrypt' is saved as
+    # 'scrypt:32768:8:1'); taken from one hash made with the method and kept per method
+    method = app.config['PASSWORD_HASH_METHOD']
+    if method not in _password_hash_prefixes:
+        _password_hash_prefixes[method] = generate_password_hash('', method).split('$', 1)[0]
+    return _password_hash_prefixes[method]
+
+
+def login_failure_retry_after(username, cost=0):
+    rate, burst = app.config['LOGIN_FAILURE_LIMIT']
+    try:
+        return rate_limit_store.take(f'login_failure:user:{(username or "").lower()}', rate, burst, cost)
+    except sqlite3.Error as e:
+        app.logger.warning(f"Rate limit store unavailable for login throttling: {e}")
+        return 0.0
+
+
+# --- Static Assets ---
+# CSS/JS live in static/ and are copied at startup to static/dist/<name>.<content hash>.<ext> together with
+# .gz/.br variants. Fingerprinted URLs never change content, so browsers may cache them forever.
+ASSET_SOURCES = ('forum.css', 'forum.js')
+ASSET_DIST_DIR = os.path.join(app.static_folder, 'dist')
+ASSET_MIMETYPES = {'.css': 'text/css', '.js': 'text/javascript'}
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+asset_manifest = {}  # Source name -> fingerprinted file name
+
+
+def _write_asset_if_missing(path, data):
+    if os.path.exists(path):
+        return
+    tmp_path = f'{path}.{os.getpid()}.tmp'  # Workers may build the same asset concurrently
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build_asset_manifest():
+    os.makedirs(ASSET_DIST_DIR, exist_ok=True)
+    manifest = {}
+    for name in ASSET_SOURCES:
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        fingerprinted = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        path = os.path.join(ASSET_DIST_DIR, fingerprinted)
+        _write_asset_if_missing(path, data)
+        _write_asset_if_missing(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli:
+            _write_asset_if_missing(path + '.br', brotli.compress(data, quality=11))
+        manifest[name] = fingerprinted
+    asset_manifest.clear()
+    asset_manifest.update(manifest)
+
+
+def asset_url(name):
+    return url_for('asset', filename=asset_manifest.get(name, name))
+
+
+build_asset_manifest()
+
+
+@app.context_processor
+def inject_asset_url():
+    return {'asset_url': asset_url}
+
+
+@app.route('/assets/<filename>')
+def asset(filename):
+    ext = os.path.splitext(filename)[1]
+    path = safe_join(ASSET_DIST_DIR, filename)
+    # Old fingerprints stay servable so pages rendered before a deploy keep working
+    if ext not in ASSET_MIMETYPES or path is None or not os.path.isfile(path):
+        abort(404)
+    encoding, file_path = None, path
+    for candidate, suffix in ASSET_ENCODINGS:
+        if request.accept_encodings[candidate] and os.path.isfile(path + suffix):
+            encoding, file_path = candidate, path + suffix
+            break
+    response = send_file(file_path, mimetype=ASSET_MIMETYPES[ext], conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+# --- Response Compression ---
+class CompressionMiddleware:
+    # Gzip-encodes eligible responses. Bodies with a Content-Length are compressed in one go; streamed bodies
+    # (no Content-Length) are flushed after every chunk so the client still receives each chunk immediately.
+
+    def __init__(self, wsgi_app, level=6, min_size=500, mimetypes=('text/html',)):
+        self.wsgi_app = wsgi_app
+        self.level = level
+        self.min_size = min_size
+        self.mimetypes = set(mimetypes)
+
+    def __call__(self, environ, start_response):
+        if (not app.config['COMPRESSION_ENABLED'] or environ.get('REQUEST_METHOD') == 'HEAD'
+                or not parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))['gzip']):
+            return self.wsgi_app(environ, start_response)
+
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            captured['status'], captured['headers'], captured['exc_info'] = status, headers, exc_info
+            return self._write_unsupported
+
+        app_iter = self.wsgi_app(environ, capture_start_response)
+        chunks = iter(app_iter)
+        pending = []
+        if 'status' not in captured:
+            # Start_response may legally be deferred until the first body chunk is produced
+            for chunk in chunks:
+                pending.append(chunk)
+                if 'status' in captured:
+                    break
+        status, headers = captured['status'], captured['headers']
+
+        if not self._should_compress(status, headers):
+            start_response(status, headers, captured['exc_info'])
+            return self._passthrough(pending, chunks, app_iter)
+
+        headers = [(k, v) for k, v in headers if k.lower() not in ('content-length', 'vary', 'etag')] + \
+                  self._encoding_headers(headers)
+        content_length = self._header(headers=captured['headers'], name='content-length')
+        if content_length is not None:
+            try:
+                body = b''.join(pending) + b''.join(chunks)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            compressed = gzip.compress(body, compresslevel=self.level, mtime=0)
+            metrics_inc('anonn_compression_bytes_total', {'direction': 'in'}, len(body))
+            metrics_inc('anonn_compression_bytes_total', {'direction': 'out'}, len(compressed))
+            start_response(status, headers + [('Content-Length', str(len(compressed)))], captured['exc_info'])
+            return [compressed]
+        start_response(status, headers, captured['exc_info'])
+        return self._compress_stream(pending, chunks, app_iter)
+
+    @staticmethod
+    def _write_unsupported(data):
+        raise RuntimeError('CompressionMiddleware does not support the WSGI write() callable')
+
+    @staticmethod
+    def _header(headers, name):
+        for key, value in headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def _should_compress(self, status, headers):
+        code = int(status.split(None, 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        if self._header(headers, 'content-encoding'):
+            return False  # Already encoded, e.g. precompressed static assets
+        if 'no-transform' in (self._header(headers, 'cache-control') or ''):
+            return False
+        mimetype = (self._header(headers, 'content-type') or '').split(';', 1)[0].strip().lower()
+        if mimetype not in self.mimetypes:
+            return False
+        content_length = self._header(headers, 'content-length')
+        return content_length is None or int(content_length) >= self.min_size
+
+    def _encoding_headers(self, headers):
+        vary = [v.strip() for v in (self._header(headers, 'vary') or '').split(',') if v.strip()]
+        if 'accept-encoding' not in (v.lower() for v in vary):
+            vary.append('Accept-Encoding')
+        result = [('Content-Encoding', 'gzip'), ('Vary', ', '.join(vary))]
+        etag = self._header(headers, 'etag')
+        if etag:
+            # The gzip body is a different byte sequence, so only a weak validator still holds
+            result.append(('ETag', etag if etag.startswith('W/') else f'W/{etag}'))
+        return result
+
+    @staticmethod
+    def _passthrough(pending, chunks, app_iter):
+        try:
+            yield from pending
+            yield from chunks
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def _compress_stream(self, pending, chunks, app_iter):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        bytes_in = bytes_out = 0
+        try:
+            for source in (pending, chunks):
+                for chunk in source:
+                    if not chunk:
+                        continue
+                    data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                    bytes_in += len(chunk)
+                    bytes_out += len(data)
+                    yield data
+            data = compressor.flush()
+            bytes_out += len(data)
+            yield data
+        finally:
+            metrics_inc('anonn_compression_bytes_total', {'direction': 'in'}, bytes_in)
+            metrics_inc('anonn_compression_bytes_total', {'direction': 'out'}, bytes_out)
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+app.wsgi_app = CompressionMiddleware(app.wsgi_app, level=app.config['COMPRESSION_LEVEL'],
+                                     min_size=app.config['COMPRESSION_MIN_SIZE'],
+                                     mimetypes=app.config['COMPRESSION_MIMETYPES'])
+
+
+# --- Conditional GET ---
+# Changes whenever the code or the assets change, so a deploy invalidates every ETag handed out before it
+with open(__file__, 'rb') as _source:
+    APP_BUILD_ID = hashlib.sha256(_source.read() + json.dumps(asset_manifest, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def bump_data_versions(*names):
+    # An upsert, so two transactions creating the same name cannot both insert it
+    table = DataVersion.__table__
+    insert = VOTE_UPSERT_INSERTS.get(db.engine.dialect.name)
+    for name in sorted(set(names)):  # One lock order for concurrent writers
+        if insert is None:
+            result = db.session.execute(table.update().where(table.c.name == name).values(version=table.c.version + 1))
+            if result.rowcount == 0:
+                db.session.execute(table.insert().values(name=name, version=1))
+            continue
+        db.session.execute(insert(table).values(name=name, version=1).on_conflict_do_update(
+            index_elements=[table.c.name], set_={'version': table.c.version + 1}))
+
+
+def get_data_versions(*names):
+    rows = dict(db.session.query(DataVersion.name, DataVersion.version).filter(DataVersion.name.in_(names)).all())
+    return [rows.get(name, 0) for name in names]
+
+
+def viewer_cache_key():
+    if not current_user.is_authenticated:
+        return 'anon'
+    return f'{current_user.id}:{int(bool(current_user.is_admin))}:{int(current_user.is_active)}'
+
+
+def conditional_etag(*parts, html_page=False):
+    if html_page and '_flashes' in session:
+        return None  # The page carries one-off flash messages; always render it
+    raw = '|'.join(str(part) for part in (APP_BUILD_ID, request.full_path, viewer_cache_key()) + parts)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def etag_not_modified(etag):
+    if etag is None:
+        return None
+    hit = request.if_none_match.contains_weak(etag)
+    metrics_cache('etag', hit)
+    if not hit:
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def with_etag(response, etag):
+    response = make_response(response)
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# --- Tag Filters ---
+# ?tag=a&tag=b (or ?tag=a,b) filters the feed by several tags: tag_mode=all (the default) keeps posts that have
+# every tag, tag_mode=any posts with at least one. A tag's posts are one range of ix_post_tags_tag_post, so "any"
+# is a scan of each range; "all" walks the range of the tag with the lowest post_count and probes the primary key
+# (post_id, tag_id) for the others, so its cost follows the rarest tag however popular the rest are.
+TAG_FILTER_MODES = ('all', 'any')
+
+
+def requested_tag_names():
+    names = []
+    for value in request.args.getlist('tag'):
+        for name in value.split(','):  # Tags never contain commas; the post form splits on them
+            name = name.strip()
+            if name and name != 'all' and name not in names:
+                names.append(name)
+    return names
+
+
+def resolve_tag_filter():
+    # Returns (tags, mode); unknown names are dropped, as an unknown single ?tag= always was
+    names = requested_tag_names()[:app.config['TAG_FILTER_MAX']]
+    mode = request.args.get('tag_mode', 'all')
+    if mode not in TAG_FILTER_MODES:
+        mode = 'all'
+    tags = sorted(Tag.query.filter(Tag.name.in_(names)).all(), key=lambda tag: names.index(tag.name)) if names else []
+    return tags, mode
+
+
+def tagged_post_ids(tags, mode):
+    if mode == 'any' or len(tags) == 1:
+        return select(post_tags.c.post_id).where(post_tags.c.tag_id.in_([tag.id for tag in tags]))
+    rarest, *others = sorted(tags, key=lambda tag: tag.post_count or 0)
+    links = post_tags.alias('rarest_tag_posts')
+    statement = select(links.c.post_id).where(links.c.tag_id == rarest.id)
+    for tag in others:
+        statement = statement.where(select(post_tags.c.post_id).where(
+            post_tags.c.post_id == links.c.post_id, post_tags.c.tag_id == tag.id).exists())
+    return statement
+
+
+def tag_count_update(tag_ids=None):
+    table = Tag.__table__
+    count = select(func.count()).select_from(post_tags).where(post_tags.c.tag_id == table.c.id).scalar_subquery()
+    statement = table.update().values(post_count=count)
+    if tag_ids is not None:
+        statement = statement.where(table.c.id.in_(tag_ids))
+    return statement
+
+
+def tags_of_posts(post_ids):
+    return set(db.session.execute(select(post_tags.c.tag_id).where(post_tags.c.post_id.in_(post_ids))).scalars())
+
+
+def tag_list():
+    # The TAG_LIST_SIZE most used tags for the filter dropdown, by name
+    return sorted(Tag.query.filter(Tag.post_count > 0).order_by(Tag.post_count.desc())
+                  .limit(app.config['TAG_LIST_SIZE']).all(), key=lambda tag: tag.name)
+
+
+@app.cli.command('rebuild-tag-counts')
+def rebuild_tag_counts_command():
+    """Пересчитать tag.post_count по связям постов с тегами"""
+    updated = db.session.execute(tag_count_update()).rowcount
+    bump_data_versions('feed')
+    db.session.commit()
+    click.echo(f'Recounted {updated} tags.')
+
+
+# --- Page Cache ---
+# Logged-out visitors all get the same index page for a given URL, so it is rendered once per 'feed' data
+# version. Writers never touch the cache: bumping the version in their transaction makes every stored page
+# stale, and the next request replaces it.
+INDEX_SORT_OPTIONS = ('date_desc', 'date_asc', 'score_desc', 'hot', 'activity')
+
+
+class MemoryPageCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (version, body), least recently used first
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, version, body):
+        with self.lock:
+            self.entries[key] = (version, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class DirectoryPageCache:
+    # One <sha1 of key>.<version>.html file per page. Every set() deletes the files of older versions and then
+    # the least recently written ones beyond max_entries, so the directory never holds more than that.
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key, version):
+        return os.path.join(self.path, f'{hashlib.sha1(key.encode()).hexdigest()}.{version}.html')
+
+    def get(self, key, version):
+        try:
+            with open(self._file(key, version), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, version, body):
+        path = self._file(key, version)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(body)
+        os.replace(temp_path, path)  # Atomic, so readers in other workers never see half a page
+        self._prune(version)
+
+    def _prune(self, version):
+        current = []
+        for entry in os.scandir(self.path):
+            parts = entry.name.split('.')
+            if parts[-1] != 'html':
+                continue
+            try:
+                if len(parts) != 3 or int(parts[1]) < version:
+                    os.remove(entry.path)
+                else:
+                    current.append((entry.stat().st_mtime, entry.path))
+            except (ValueError, OSError):  # Removed by another worker meanwhile
+                continue
+        current.sort()
+        for _, path in current[:max(len(current) - self.max_entries, 0)]:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+
+class SingleFlight:
+    # Lets one thread per key do the work while the others wait for it (per process)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def run(self, key, func, timeout):
+        with self.lock:
+            done = self.calls.get(key)
+            leader = done is None
+            if leader:
+                done = self.calls[key] = threading.Event()
+        if not leader:
+            done.wait(timeout)
+            return
+        try:
+            func()
+        finally:
+            with self.lock:
+                del self.calls[key]
+            done.set()
+
+
+if app.config['PAGE_CACHE_DIR']:
+    page_cache = DirectoryPageCache(app.config['PAGE_CACHE_DIR'], app.config['PAGE_CACHE_MAX_ENTRIES'])
+else:
+    page_cache = MemoryPageCache(app.config['PAGE_CACHE_MAX_ENTRIES'])
+page_cache_flights = SingleFlight()
+
+
+def anonymous_page_cache_key():
+    if not app.config['PAGE_CACHE_ENABLED'] or current_user.is_authenticated or '_flashes' in session:
+        return None
+    # Only the URLs the UI links to; anything else would let visitors fill the cache with junk keys
+    if (set(request.args) - {'sort_by', 'tag', 'tag_mode'}
+            or request.args.get('sort_by', 'date_desc') not in INDEX_SORT_OPTIONS
+            or request.args.get('tag_mode', 'all') not in TAG_FILTER_MODES):
+        return None
+    tag_names = requested_tag_names()
+    if len(tag_names) > app.config['TAG_FILTER_MAX'] or (
+            tag_names and Tag.query.filter(Tag.name.in_(tag_names)).count() != len(tag_names)):
+        return None
+    # Only what render_index reads, so tag order, duplicates, defaults and the Host header share one entry
+    sort_by = request.args.get('sort_by', 'date_desc')
+    tag_mode = request.args.get('tag_mode', 'all') if len(tag_names) > 1 else 'all'
+    return f"{request.path}|{sort_by}|{tag_mode}|{','.join(sorted(tag_names))}"
+
+
+def cached_page(key, version, render):
+    body = page_cache.get(key, version)
+    metrics_cache('page', body is not None)
+    if body is None:
+        rendered = []
+
+        def fill():
+            rendered.append(render().encode('utf-8'))
+            page_cache.set(key, version, rendered[0])
+
+        page_cache_flights.run((key, version), fill, app.config['PAGE_CACHE_WAIT'])
+        body = rendered[0] if rendered else page_cache.get(key, version)
+        if body is None:  # The request we waited for failed or took too long
+            body = render().encode('utf-8')
+    return Response(body, mimetype='text/html')
+
+
 # --- Achievement Logic ---
 def check_and_award_achievements(user, event_type, event_context=None):
     if not user or not user.is_authenticated:
@@ -200,9 +1402,11 @@ def check_and_award_achievements(user, event_type, event_context=None):
         if ach.id in user_achievement_ids:
             continue
         awarded_this_check = False
-        if ach.condition_type == 'posts_made' and user.posts.count() >= ach.condition_value:
+        if ach.condition_type == 'posts_made' and (user.posts.count() + ArchivedPost.query.filter_by(
+                user_id=user.id).count()) >= ach.condition_value:
             awarded_this_check = True
-        elif ach.condition_type == 'votes_cast' and user.votes.count() >= ach.condition_value:
+        elif ach.condition_type == 'votes_cast' and (user.votes.count() + ArchivedVote.query.filter_by(
+                user_id=user.id).count()) >= ach.condition_value:
             awarded_this_check = True
         elif ach.condition_type == 'total_post_upvotes_received':
             if event_type == 'vote_on_my_post' and event_context and event_context.get('post_author_id') == user.id:
@@ -224,10 +1428,12 @@ def check_and_award_achievements(user, event_type, event_context=None):
             db.session.add(new_user_ach)
             user_achievement_ids.add(ach.id)  # Avoid re-awarding in same check cycle
             awarded_new = True
+            metrics_inc('anonn_achievements_awarded_total', {'achievement': ach.name})
             flash(f'Новое достижение разблокировано: {ach.name} ({ach.icon_emoji})!', 'success')
             app.logger.info(f"User {user.username} awarded achievement: {ach.name}")
     if awarded_new:
         try:
+            bump_data_versions(f'profile:{user.id}')
             db.session.commit()
         except Exception as e:
             db.session.rollback()
@@ -247,6 +1453,20 @@ def escape_html(text):
     return html.escape(text).replace('\n', '<br>')
 
 
+POST_PREVIEW_LENGTH = 100  # Characters of a post shown in lists that link to it (profile, archive)
+
+
+def one_line_preview(text, max_length):
+    preview = ' '.join(text.split())
+    if len(preview) > max_length:
+        preview = preview[:max_length - 1] + '…'
+    return preview
+
+
+def post_preview(content):
+    return one_line_preview(content, POST_PREVIEW_LENGTH)
+
+
 def render_formatted_post_content(text):
     if text is None: return ""
     escaped_text = html.escape(text)
@@ -372,465 +1592,7 @@ BASE_HTML_TEMPLATE = """
     <link rel="preconnect" href="https://fonts.googleapis.com">
     <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
     <link href="https://fonts.googleapis.com/css2?family=Montserrat:wght@400;500;600;700&display=swap" rel="stylesheet">
-    <style>
-        :root {
-            --bg-color: #0d0d0d;
-            --text-color: #e0e0e0;
-            --border-color: #333333;
-            --input-bg: #1a1a1a;
-            --input-border: #444444;
-            --button-bg: #2a2a2a;
-            --button-text: #f0f0f0;
-            --button-hover-bg: #3a3a3a;
-            --link-color: #aaaaaa;
-            --link-hover-color: #cccccc;
-            --time-color: #777777;
-            --post-bg: #1f1f1f;
-            --reply-bg: #252525;
-            --flash-info-bg: #2a3a4a;
-            --radius-full: 35px;
-            --radius-large-container: 1.5rem;
-            --pinned-color: #ffcc00;
-            --dm-sidebar-bg: #161616;
-            --dm-active-conversation-bg: #252525;
-            --dm-message-sent-bg: #2a3a4a;
-            --dm-message-received-bg: #3a3a3a;
-            --toggle-button-bg: #4a4a4a;
-            --toggle-button-hover-bg: #5a5a5a;
-            --left-sidebar-width: 520px;
-            --bottom-panel-height-approx: 250px;
-            --profile-header-bg: #252525;
-            --achievement-bg: #2c2c2c;
-            --ban-button-bg: #c0392b;
-            --unban-button-bg: #27ae60;
-            --button-hover-danger-bg: #e74c3c;
-            --button-hover-success-bg: #2ecc71;
-            --report-button-bg: #e67e22; /* Orange-ish for report */
-            --report-button-hover-bg: #d35400;
-        }
-        body {
-            font-family: 'Montserrat', sans-serif;
-            background-color: var(--bg-color);
-            color: var(--text-color);
-            line-height: 1.6;
-            margin: 0;
-            padding: 0;
-            display: flex;
-            min-height: 100vh;
-            overflow-x: hidden;
-        }
-
-        .messaging-sidebar {
-            width: var(--left-sidebar-width);
-            min-width: var(--left-sidebar-width);
-            background-color: var(--dm-sidebar-bg);
-            border-right: 1px solid var(--border-color);
-            padding: 15px;
-            box-sizing: border-box;
-            display: flex;
-            flex-direction: column;
-            overflow-y: auto;
-            height: 100vh;
-            position: fixed;
-            left: 0;
-            top: 0;
-            transition: transform 0.3s ease-in-out, min-width 0.3s ease-in-out, width 0.3s ease-in-out;
-            z-index: 1001;
-            border-top-right-radius: 60px;
-            border-bottom-right-radius: 60px;
-        }
-        .messaging-sidebar.collapsed {
-            transform: translateX(-100%);
-            min-width: 0;
-            width: 0;
-            padding-left: 0;
-            padding-right: 0;
-            border-right: none;
-        }
-
-        .main-forum-container {
-            flex-grow: 1;
-            padding: 20px;
-            margin-left: var(--left-sidebar-width);
-            box-sizing: border-box;
-            transition: margin-left 0.3s ease-in-out, max-width 0.3s ease-in-out;
-        }
-        .main-forum-container.left-sidebar-collapsed {
-            margin-left: 0;
-        }
-
-        .main-content-wrapper {
-            max-width: 800px;
-            margin: 0 auto;
-            padding-bottom: var(--bottom-panel-height-approx);
-            transition: padding-bottom 0.3s ease-in-out;
-        }
-        .main-content-wrapper.bottom-panel-collapsed {
-            padding-bottom: 40px;
-        }
-
-
-        h1, h2 {
-            color: var(--text-color);
-            border-bottom: 1px solid var(--border-color);
-            padding-bottom: 10px;
-            margin-top: 30px;
-            font-weight: 600;
-        }
-        h1 { border-bottom: none; text-align: center; margin-bottom: 40px; font-weight: 700; }
-        h1 a { color: var(--text-color); text-decoration: none; }
-        a { color: var(--link-color); text-decoration: none; transition: color 0.2s; }
-        a:hover { color: var(--link-hover-color); text-decoration: none; }
-
-        form { margin-bottom: 30px; padding: 25px; border: 1px solid var(--border-color); background-color: var(--post-bg); border-radius: var(--radius-large-container); }
-
-        textarea, input[type="text"], input[type="password"], input[type="email"] { width: 100%; padding: 12px 18px; margin-bottom: 15px; border: 1px solid var(--input-border); background-color: var(--input-bg); color: var(--text-color); border-radius: var(--radius-full); font-size: 1em; box-sizing: border-box; transition: border-color 0.2s, background-color 0.2s; font-family: 'Montserrat', sans-serif; }
-        textarea:focus, input[type="text"]:focus, input[type="password"]:focus, input[type="email"]:focus { outline: none; border-color: var(--link-color); background-color: #222; }
-        textarea { min-height: 100px; resize: vertical; }
-        button[type="submit"], .button { padding: 10px 20px; background-color: var(--button-bg); color: var(--button-text); border: none; border-radius: var(--radius-full); cursor: pointer; font-size: 0.95em; font-weight: 500; transition: background-color 0.2s; display: inline-block; font-family: 'Montserrat', sans-serif; margin-right: 5px; text-decoration: none; }
-        button[type="submit"]:hover, .button:hover { background-color: var(--button-hover-bg); }
-        .button.report-button { background-color: var(--report-button-bg); }
-        .button.report-button:hover { background-color: var(--report-button-hover-bg); }
-
-
-        .post { border: 1px solid var(--border-color); padding: 20px 25px; margin-bottom: 25px; background-color: var(--post-bg); border-radius: var(--radius-large-container); overflow-wrap: break-word; word-wrap: break-word; }
-        .reply { margin-left: 0; margin-top: 15px; padding: 15px 20px; background-color: var(--reply-bg); border: 1px solid var(--border-color); border-radius: var(--radius-large-container); }
-        .post-content, .reply-content { margin-bottom: 15px; }
-        .metadata { color: var(--time-color); font-size: 0.85em; display: flex; justify-content: space-between; align-items: center; flex-wrap: wrap; gap: 10px; margin-top: 10px; }
-        .author { font-weight: 600; margin-right: 10px; color: var(--text-color); }
-        .achievement-icon { margin-left: 4px; cursor: help; font-size: 0.9em; }
-        .post form { margin-top: 25px; }
-        .post-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px; flex-wrap: wrap; gap: 10px;}
-        .post-tags { font-size: 0.8em; color: var(--link-color); margin-top: 5px; margin-bottom: 10px; }
-        .pinned-indicator { color: var(--pinned-color); font-weight: bold; }
-        .edit-indicator { font-size: 0.8em; color: var(--edit-indicator-color); cursor: default; }
-        .vote-section { display: flex; align-items: center; gap: 10px; margin-top: 15px; }
-        .vote-button { background-color: var(--button-bg); color: var(--button-text); border: none; border-radius: var(--radius-full); padding: 6px 12px; cursor: pointer; font-size: 0.85em; transition: background-color 0.2s; }
-        .vote-button:hover { background-color: var(--button-hover-bg); }
-        .vote-button.active { background-color: var(--link-color); } /* Adjusted active vote button color */
-        .post-score { font-weight: bold; font-size: 0.9em; min-width: 20px; text-align: center; }
-        .score-positive { color: #2ecc71; } /* Green */
-        .score-negative { color: #e74c3c; } /* Red */
-        .score-neutral { color: var(--text-color); }
-
-        .header { display: flex; justify-content: flex-end; align-items: center; margin-bottom: 20px; padding-bottom: 15px; border-bottom: 1px solid var(--border-color); }
-        .nav a, .nav span { margin-left: 15px; font-size: 0.9em; }
-        .nav .username-link { font-weight: bold; }
-        .sort-options { margin-bottom: 20px; font-size: 0.9em; display: flex; flex-wrap: wrap; align-items: center; gap: 15px; }
-        .flash-messages { list-style: none; padding: 0; margin: 0 0 20px 0; }
-        .flash-messages li { padding: 12px 18px; margin-bottom: 12px; border-radius: var(--radius-full); text-align: center; font-weight: 500; }
-        .flash-info { color: #3498db; background-color: #dbe9f3; border: 1px solid #a6cbe7; } /* Light blue */
-        .flash-success { color: #27ae60; background-color: #d4edda; border: 1px solid #c3e6cb; } /* Light green */
-        .flash-error { color: #c0392b; background-color: #f8d7da; border: 1px solid #f5c6cb; } /* Light red */
-
-        /* Combined New Post Panel */
-        .fixed-bottom-new-post-panel {
-            position: fixed;
-            bottom: 0;
-            left: 720px; /* Adjusted to use variable */
-            right: 200px;
-            background-color: rgba(31, 31, 31, 0.85);
-            backdrop-filter: blur(8px);
-            -webkit-backdrop-filter: blur(8px);
-            padding: 15px 20px;
-            border-top: 1px solid var(--border-color);
-            z-index: 1000;
-            border-top-left-radius: 60px; /* Smaller radius */
-            border-top-right-radius: 60px; /* Smaller radius */
-            box-shadow: 0 -5px 25px rgba(0,0,0,0.35);
-            box-sizing: border-box;
-            transition: transform 0.3s ease-in-out, max-height 0.3s ease-in-out, padding 0.3s ease-in-out, border-top-width 0.3s ease-in-out, left 0.3s ease-in-out;
-            max-height: var(--bottom-panel-height-approx);
-            overflow: hidden; /* Hide content when collapsed */
-            display: flex; /* Use flexbox */
-            flex-direction: column; /* Stack elements vertically */
-            margin-left: 200px;
-        }
-
-        .fixed-bottom-new-post-panel.left-sidebar-collapsed {
-             left: 0; /* Adjust left when sidebar is collapsed */
-        }
-
-        .fixed-bottom-new-post-panel.collapsed {
-            max-height: 0 !important;
-            padding-top: 0 !important;
-            padding-bottom: 0 !important;
-            border-top-width: 0 !important;
-        }
-
-        .fixed-bottom-new-post-panel form {
-            margin-bottom: 0;
-            border: none;
-            background-color: transparent;
-            padding: 0;
-            display: flex; /* Use flexbox */
-            flex-direction: column; /* Stack elements vertically */
-            height: 100%; /* Fill panel height */
-        }
-
-        .fixed-bottom-new-post-panel textarea {
-            flex-grow: 1; /* Allow textarea to grow */
-            min-height: 60px; /* Minimum height */
-            margin-bottom: 8px !important;
-            padding: 10px 15px !important;
-            font-size: 0.95em !important;
-            resize: vertical; /* Allow vertical resize */
-            border-radius: var(--radius-full);
-        }
-
-        .fixed-bottom-new-post-panel input[type="text"] {
-             margin-bottom: 8px !important;
-             padding: 10px 15px !important;
-             font-size: 0.95em !important;
-             border-radius: var(--radius-full);
-        }
-
-        .fixed-bottom-new-post-panel .controls-container {
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-            margin-top: 5px;
-            flex-shrink: 0; /* Prevent shrinking */
-            border-radius: var(--radius-full);
-        }
-
-        .fixed-bottom-new-post-panel .pinned-checkbox-container {
-            display: flex;
-            align-items: center;
-            border-radius: var(--radius-full);
-        }
-
-        .fixed-bottom-new-post-panel button[type="submit"] {
-            padding: 8px 18px !important;
-            font-size: 0.9em !important;
-            border-radius: var(--radius-full);
-        }
-
-        .fixed-bottom-new-post-panel .checkbox-label {
-            font-size: 0.9em;
-            margin-bottom: 0;
-            font-weight: 400;
-            border-radius: var(--radius-full);
-        }
-
-        .color-picker-container {
-            display: flex;
-            align-items: center;
-            margin-bottom: 8px; /* Space below color picker */
-            gap: 10px;
-            border-radius: var(--radius-full);
-        }
-
-        .color-picker-container label {
-             font-size: 0.9em;
-             color: var(--time-color);
-             border-radius: var(--radius-full);
-        }
-
-        .color-picker-container input[type="color"] {
-            padding: 0;
-            border: none;
-            background: none;
-            height: 30px;
-            width: 40px;
-            cursor: pointer;
-            border-radius: var(--radius-full);
-        }
-         .color-picker-container button {
-             padding: 8px 12px;
-             font-size: 0.8em;
-             border-radius: var(--radius-full);
-             border: none;
-             background-color: rgba(50, 50, 50, 0.85);
-             backdrop-filter: blur(8px);
-             -webkit-backdrop-filter: blur(8px);
-             color: var(--text-color);
-         }
-
-
-        /* Messaging Sidebar Specific Styles */
-        .messaging-sidebar h3 { font-size: 1.1em; color: var(--text-color); margin-top: 0; margin-bottom: 10px; border-bottom: 1px solid var(--border-color); padding-bottom: 8px; }
-        .messaging-sidebar input[type="text"] { padding: 8px 12px !important; font-size: 0.9em !important; margin-bottom: 10px !important; border-radius: var(--radius-full); }
-        .conversation-list, .dm-user-search-results { list-style: none; padding: 0; margin: 0; flex-grow: 1; overflow-y: auto; } /* flex-grow for list */
-        .conversation-list li, .dm-user-search-results li { padding: 10px; border-bottom: 1px solid var(--border-color); cursor: pointer; font-size: 0.9em; transition: background-color 0.2s; display: flex; justify-content: space-between; align-items: center; }
-        .conversation-list li:hover, .dm-user-search-results li:hover { background-color: var(--button-hover-bg); }
-        .conversation-list li.active-conversation { background-color: var(--dm-active-conversation-bg); font-weight: bold; }
-        .unread-indicator { display: inline-block; width: 8px; height: 8px; background-color: var(--pinned-color); border-radius: 50%; margin-left: 8px; }
-        .chat-area {
-            margin-top: 15px;
-            border-top: 1px solid var(--border-color);
-            padding-top: 15px;
-            display: flex;
-            flex-direction: column; /* Stack elements */
-            flex-grow: 1; /* Allow chat area to fill space */
-            overflow: hidden; /* Contain children */
-        }
-        .chat-header { font-size: 1em; font-weight: bold; margin-bottom:10px; padding-bottom: 5px; border-bottom: 1px #444; flex-shrink: 0; } /* Prevent shrinking */
-        .messages-display { flex-grow: 1; overflow-y: auto; margin-bottom: 10px; padding-right: 5px; scroll-behavior: smooth; } /* Allow messages to scroll and grow */
-        .message-bubble { padding: 8px 12px; border-radius: 15px; margin-bottom: 8px; max-width: 80%; word-wrap: break-word; font-size: 0.9em; }
-        .message-bubble.sent { background-color: var(--dm-message-sent-bg); margin-left: auto; border-bottom-right-radius: 5px; }
-        .message-bubble.received { background-color: var(--dm-message-received-bg); margin-right: auto; border-bottom-left-radius: 5px; }
-        .message-bubble .msg-time { font-size: 0.7em; color: var(--time-color); display: block; text-align: right; margin-top: 3px; }
-        .dm-input-form { flex-shrink: 0; } /* Prevent shrinking */
-        .dm-input-form textarea { min-height: 40px !important; padding: 8px 12px !important; font-size: 0.9em !important; margin-bottom: 8px !important; resize: none; border-radius: var(--radius-full); }
-        .dm-input-form button { padding: 6px 15px !important; font-size: 0.85em !important; width: 100%; border-radius: var(--radius-full); }
-        .no-dm-selected { text-align: center; color: var(--time-color); margin-top: 30px; font-size: 0.9em; flex-grow: 1; display: flex; align-items: center; justify-content: center; } /* Center placeholder */
-        #dm-back-to-conversations { font-size: 0.85em; margin-bottom: 10px; cursor: pointer; color: var(--link-color); flex-shrink: 0; } /* Prevent shrinking */
-        #dm-back-to-conversations:hover { color: var(--link-hover-color); }
-        .dm-user-search-results .user-search-actions { display: flex; gap: 5px; }
-        .dm-user-search-results .user-search-actions .button { padding: 5px 10px; font-size: 0.8em; }
-
-
-        /* Panel Toggle Buttons */
-        .panel-toggle-button {
-            position: fixed;
-            background-color: var(--toggle-button-bg);
-            color: var(--button-text);
-            border: 1px solid var(--border-color);
-            border-radius: 50%;
-            width: 36px;
-            height: 36px;
-            font-size: 18px; /* Consistent font size */
-            line-height: 34px;
-            text-align: center;
-            cursor: pointer;
-            z-index: 1005;
-            transition: background-color 0.2s, left 0.3s ease-in-out, bottom 0.3s ease-in-out, transform 0.3s ease-in-out;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.2);
-        }
-        .panel-toggle-button:hover {
-            background-color: var(--toggle-button-hover-bg);
-        }
-
-        #left-sidebar-toggle {
-            top: 50%;
-            left: calc(var(--left-sidebar-width) - 18px);
-            transform: translateY(-50%) rotate(0deg); /* No initial rotation */
-        }
-        #left-sidebar-toggle.collapsed-state {
-            left: 5px;
-            transform: translateY(-50%) rotate(180deg); /* Rotate when collapsed */
-        }
-        /* Ensure toggle button position adjusts with sidebar */
-        .messaging-sidebar.collapsed + .main-forum-container + #left-sidebar-toggle {
-             left: 5px;
-        }
-         /* Specific rule to handle toggle button when sidebar is collapsed and main container is adjusted */
-        .main-forum-container.left-sidebar-collapsed + #left-sidebar-toggle {
-             left: 5px;
-        }
-
-
-        #bottom-panel-toggle {
-            left: 50%;
-            bottom: var(--bottom-panel-height-approx);
-            transform: translateX(-50%) translateY(50%);
-        }
-         #bottom-panel-toggle.collapsed-state {
-            bottom: 25px;
-            transform: translateX(-50%) translateY(0); /* No vertical translation when collapsed */
-        }
-
-        /* User Profile Styles */
-        .profile-container { padding: 20px; background-color: var(--post-bg); border-radius: var(--radius-large-container); margin-top: 20px; }
-        .profile-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 20px; padding-bottom: 15px; border-bottom: 1px solid var(--border-color); flex-wrap: wrap; gap: 15px;} /* Allow wrapping */
-        .profile-header h2 { margin: 0; border-bottom: none; flex-grow: 1; } /* Allow title to grow */
-        .profile-actions { display: flex; gap: 10px; flex-wrap: wrap; } /* Arrange buttons */
-        .profile-actions .button, .profile-actions form button { margin-left: 0; } /* Remove extra margin */
-        .profile-actions .report-button { background-color: var(--report-button-bg); } /* Apply report button color */
-        .profile-actions .report-button:hover { background-color: var(--report-button-hover-bg); }
-
-        .profile-info { margin-bottom: 20px; }
-        .profile-info h3 { margin-top: 0; color: var(--text-color); font-size: 1.2em; }
-        .profile-info p { white-space: pre-wrap; word-wrap: break-word; }
-        .achievements-grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(150px, 1fr)); gap: 15px; }
-        .achievement-card { background-color: var(--achievement-bg); padding: 15px; border-radius: 10px; text-align: center; }
-        .achievement-card .icon { font-size: 2em; margin-bottom: 5px; }
-        .achievement-card .name { font-weight: bold; margin-bottom: 5px; }
-        .achievement-card .description { font-size: 0.85em; color: var(--time-color); }
-        .ban-button { background-color: var(--ban-button-bg); }
-        .ban-button:hover { background-color: var(--button-hover-danger-bg); }
-        .unban-button { background-color: var(--unban-button-bg); }
-        .unban-button:hover { background-color: var(--button-hover-success-bg); }
-        .edit-profile-form textarea { min-height: 150px; }
-
-        /* Report Modal Styles */
-        .modal {
-            display: none; /* Hidden by default */
-            position: fixed; /* Stay in place */
-            z-index: 2000; /* Sit on top */
-            left: 0;
-            top: 0;
-            width: 100%; /* Full width */
-            height: 100%; /* Full height */
-            overflow: auto; /* Enable scroll if needed */
-            background-color: rgba(0,0,0,0.6); /* Black w/ opacity */
-            backdrop-filter: blur(5px);
-            -webkit-backdrop-filter: blur(5px);
-            padding-top: 60px;
-        }
-
-        .modal-content {
-            background-color: var(--post-bg);
-            margin: 5% auto; /* 15% from the top and centered */
-            padding: 20px;
-            border: 1px solid var(--border-color);
-            width: 80%; /* Could be more responsive */
-            max-width: 500px; /* Max width */
-            border-radius: var(--radius-large-container);
-            position: relative;
-        }
-
-        .close-button {
-            color: var(--time-color);
-            position: absolute;
-            top: 10px;
-            right: 20px;
-            font-size: 28px;
-            font-weight: bold;
-            cursor: pointer;
-        }
-
-        .close-button:hover,
-        .close-button:focus {
-            color: var(--text-color);
-            text-decoration: none;
-            cursor: pointer;
-        }
-
-        .modal-content h3 {
-            margin-top: 0;
-            border-bottom: 1px solid var(--border-color);
-            padding-bottom: 10px;
-        }
-
-        .modal-content textarea {
-            width: calc(100% - 24px); /* Adjust for padding */
-            margin-bottom: 15px;
-        }
-
-        .modal-content button {
-            width: auto; /* Auto width for buttons */
-            margin-top: 10px;
-        }
-
-         /* Admin Reports Page Styles */
-        .admin-reports-container { padding: 20px; background-color: var(--post-bg); border-radius: var(--radius-large-container); margin-top: 20px; }
-        .admin-reports-container h2 { margin-top: 0; border-bottom: 1px solid var(--border-color); padding-bottom: 10px; margin-bottom: 20px;}
-        .report-item { border: 1px solid var(--border-color); padding: 15px; margin-bottom: 15px; background-color: var(--reply-bg); border-radius: 10px; }
-        .report-item strong { color: var(--text-color); }
-        .report-item .report-metadata { font-size: 0.85em; color: var(--time-color); margin-bottom: 10px; }
-        .report-item .report-reason { margin-bottom: 10px; white-space: pre-wrap; word-wrap: break-word; }
-        .report-item .report-actions { display: flex; gap: 10px; flex-wrap: wrap; }
-        .report-item .report-actions form { margin: 0; padding: 0; border: none; background: none; }
-        .report-item .report-actions button { padding: 5px 10px; font-size: 0.8em; }
-        .report-status-open { color: var(--report-button-bg); font-weight: bold; }
-        .report-status-reviewed { color: var(--link-color); }
-        .report-status-action_taken { color: var(--unban-button-bg); font-weight: bold; }
-        .report-status-dismissed { color: var(--time-color); }
-
-
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('forum.css') }}">
 </head>
 <body>
     <button id="left-sidebar-toggle" class="panel-toggle-button">&laquo;</button>
@@ -866,7 +1628,7 @@ BASE_HTML_TEMPLATE = """
 
         {% else %}
             <p style="text-align:center; margin-top: 20px; font-size:0.9em;">
-                <a href="{{ url_for('login', next=request.url) }}">Войдите</a>, чтобы использовать сообщения.
+                <a href="{{ url_for('login', next=request.full_path) }}">Войдите</a>, чтобы использовать сообщения.
             </p>
         {% endif %}
     </div>
@@ -881,8 +1643,10 @@ BASE_HTML_TEMPLATE = """
                          {% if current_user.is_admin %}
                             <a href="{{ url_for('admin_reports') }}">Жалобы</a> {# Link to admin reports #}
                         {% endif %}
+                        <a href="{{ url_for('archive_index') }}">Архив</a>
                         <a href="{{ url_for('logout') }}">Выйти</a>
                     {% else %}
+                        <a href="{{ url_for('archive_index') }}">Архив</a>
                         <a href="{{ url_for('login') }}">Войти</a>
                         <a href="{{ url_for('register') }}">Регистрация</a>
                     {% endif %}
@@ -901,26 +1665,42 @@ BASE_HTML_TEMPLATE = """
                 {% endwith %}
             </div>
 
-            {% if not request.endpoint in ['edit_post', 'user_profile', 'edit_profile', 'admin_reports'] and not request.endpoint.startswith('dm_') %} {# Exclude admin_reports #}
+            {% if not request.endpoint in ['edit_post', 'user_profile', 'edit_profile', 'admin_reports', 'archive_index', 'archived_post'] and not request.endpoint.startswith('dm_') %} {# Exclude admin_reports #}
             <div class="sort-options">
                 <div>
                     Сортировать по:
-                    <a href="{{ url_for('index', sort_by='score_desc', tag=tag_filter or '') }}">Рейтингу (убыв.)</a> |
-                    <a href="{{ url_for('index', sort_by='date_desc', tag=tag_filter or '') }}">Дате (новые)</a> |
-                    <a href="{{ url_for('index', sort_by='date_asc', tag=tag_filter or '') }}">Дате (старые)</a>
+                    <a href="{{ url_for('index', sort_by='hot', **(tag_args or {})) }}">Горячее</a> |
+                    <a href="{{ url_for('index', sort_by='activity', **(tag_args or {})) }}">Активности</a> |
+                    <a href="{{ url_for('index', sort_by='score_desc', **(tag_args or {})) }}">Рейтингу (убыв.)</a> |
+                    <a href="{{ url_for('index', sort_by='date_desc', **(tag_args or {})) }}">Дате (новые)</a> |
+                    <a href="{{ url_for('index', sort_by='date_asc', **(tag_args or {})) }}">Дате (старые)</a>
                 </div>
                 <div>
-                    <label for="tag-filter">Фильтр по тегу:</label>
+                    <label for="tag-filter">{% if tag_filters %}Добавить тег:{% else %}Фильтр по тегу:{% endif %}</label>
                     <select id="tag-filter" class="tag-filter-dropdown" onchange="window.location.href = this.value;">
-                        <option value="{{ url_for('index', sort_by=sort_by, tag='all') }}" {% if tag_filter is none or tag_filter == 'all' %}selected{% endif %}>Все теги</option>
-                        {% for tag_item in all_tags %}
-                            <option value="{{ url_for('index', sort_by=sort_by, tag=tag_item.name) }}" {% if tag_filter == tag_item.name %}selected{% endif %}>{{ tag_item.name }}</option>
+                        {% if tag_filters %}
+                            <option value="" selected disabled>Выберите тег</option>
+                        {% else %}
+                            <option value="{{ url_for('index', sort_by=sort_by) }}" selected>Все теги</option>
+                        {% endif %}
+                        {% for tag_item in all_tags if tag_item.name not in (tag_filters or []) %}
+                            <option value="{{ url_for('index', sort_by=sort_by, tag=(tag_filters or []) + [tag_item.name], tag_mode=(tag_args or {}).get('tag_mode')) }}">{{ tag_item.name }} ({{ tag_item.post_count }})</option>
                         {% endfor %}
                     </select>
                 </div>
-                {% if tag_filter and tag_filter != 'all' %}
-                <div>
-                    <a href="{{ url_for('index', sort_by=sort_by, tag='') }}">Сбросить фильтр тегов</a>
+                {% if tag_filters %}
+                <div class="active-tag-filters">
+                    {% for name in tag_filters %}
+                        <span class="active-tag">{{ name }} <a href="{{ url_for('index', sort_by=sort_by, tag=tag_filters|reject('equalto', name)|list, tag_mode=tag_args.get('tag_mode')) }}" title="Убрать тег">&times;</a></span>
+                    {% endfor %}
+                    {% if tag_filters|length > 1 %}
+                        {% if tag_mode == 'any' %}
+                            <a href="{{ url_for('index', sort_by=sort_by, tag=tag_filters) }}">Все теги сразу</a> | <b>Любой из тегов</b>
+                        {% else %}
+                            <b>Все теги сразу</b> | <a href="{{ url_for('index', sort_by=sort_by, tag=tag_filters, tag_mode='any') }}">Любой из тегов</a>
+                        {% endif %}
+                    {% endif %}
+                    <a href="{{ url_for('index', sort_by=sort_by) }}">Сбросить фильтр тегов</a>
                 </div>
                 {% endif %}
             </div>
@@ -928,748 +1708,54 @@ BASE_HTML_TEMPLATE = """
 
             {{ content | safe }}
         </div> {# End of main-content-wrapper #}
-    </div> {# End of main-forum-container #}
-
-    {% if new_post_form_html_for_bottom_panel and not request.endpoint in ['edit_post', 'user_profile', 'edit_profile', 'admin_reports'] %} {# Exclude admin_reports #}
-        <button id="bottom-panel-toggle" class="panel-toggle-button">&#9660;</button>
-        <div class="fixed-bottom-new-post-panel" id="fixed-bottom-panel">
-             <form method="POST" action="{{ url_for('index') }}" id="new-post-form">
-                <textarea id="new-post-content" name="content" placeholder="Напишите что-нибудь... (форматирование: &lt;b&gt;, &lt;i&gt;, &lt;u&gt;)" required rows="3"></textarea> {# Removed font tag hint #}
-                <div class="color-picker-container"> {# Added color picker for new post #}
-                     <label for="post-color-picker">Цвет текста:</label>
-                     <input type="color" id="post-color-picker" value="#e0e0e0">
-                     <button type="button" onclick="applyColorTag('new-post-content', 'post-color-picker')">Применить цвет</button>
-                </div>
-                <input type="text" id="tags" name="tags" placeholder="Теги (через запятую, например: новости, обсуждение)">
-                <div class="controls-container">
-                    {% if current_user.is_authenticated and current_user.is_admin %}
-                        <div class="pinned-checkbox-container">
-                            <input type="checkbox" id="pinned" name="pinned">
-                            <label for="pinned" class="checkbox-label">Закрепить</label>
-                        </div>
-                    {% endif %}
-                    <button type="submit">Отправить</button>
-                </div>
-             </form>
-        </div>
-    {% endif %}
-
-    <div id="reportModal" class="modal">
-        <div class="modal-content">
-            <span class="close-button">&times;</span>
-            <h3>Пожаловаться на пользователя</h3>
-            <form id="report-user-form">
-                <input type="hidden" id="reported-user-id" name="reported_user_id">
-                <textarea id="report-reason" name="reason" placeholder="Опишите причину жалобы..." required rows="5"></textarea>
-                <button type="submit" class="button">Отправить жалобу</button>
-            </form>
-        </div>
-    </div>
-
-
-    <script>
-        // Existing JS for forum posts, polling, voting etc.
-        let latestKnownPostId = 0;
-        let postPollingIntervalId = null;
-        let isPostPollingActive = true;
-
-        function getLatestPostIdOnPage() {
-            const postsContainer = document.getElementById('posts-container');
-            if (!postsContainer) return 0;
-            const firstPost = postsContainer.querySelector('.post:not(:has(.pinned-indicator))');
-            if (firstPost && firstPost.dataset.postId) {
-                return parseInt(firstPost.dataset.postId, 10);
-            }
-            return 0;
-        }
-
-        function stopPostPolling() {
-            if (postPollingIntervalId) {
-                clearInterval(postPollingIntervalId);
-                postPollingIntervalId = null;
-                isPostPollingActive = false;
-                console.log("Post polling stopped.");
-            }
-        }
-
-        function displayFlashMessage(message, category) {
-            const container = document.getElementById('flash-container');
-            if (!container) return;
-            const ul = document.createElement('ul');
-            ul.className = 'flash-messages';
-            const li = document.createElement('li');
-            li.className = `flash-${category}`;
-            li.innerHTML = message; // Use innerHTML to allow <br>
-            ul.appendChild(li);
-            container.insertBefore(ul, container.firstChild);
-            setTimeout(() => { if (ul.parentNode === container) { ul.remove(); } }, 5000);
-        }
-
-        function handleFetchError(error, actionType = 'действие') {
-            console.error(`${actionType} Error:`, error);
-            let displayMessage = `Не удалось выполнить ${actionType}. Пожалуйста, попробуйте снова.`;
-            if (error.message === 'Forbidden') displayMessage = 'Действие запрещено. Возможно, вы забанены.';
-            else if (error.message === 'Unauthorized') displayMessage = `Пожалуйста, войдите, чтобы выполнить ${actionType}.`;
-            else if (error.message) displayMessage = error.message;
-            displayFlashMessage(displayMessage, 'error');
-            if (error.message === 'Forbidden' || error.message === 'Unauthorized') {
-                stopPostPolling();
-                stopDmPolling();
-            }
-        }
-
-        async function processResponse(response, actionType = 'действие') {
-             if (!response.ok) {
-                let errorMessage = `Ошибка сети: ${response.statusText}`;
-                let errorType = 'NetworkError';
-                if (response.status === 401) errorType = 'Unauthorized';
-                if (response.status === 403) errorType = 'Forbidden';
-                try {
-                    const errData = await response.json();
-                    errorMessage = errData.message || errorMessage;
-                } catch (e) { /* Ignore if not JSON */ }
-                 const error = new Error(errorMessage);
-                 error.name = errorType;
-                 throw error;
-            }
-             const contentType = response.headers.get("content-type");
-             if (contentType && contentType.indexOf("application/json") !== -1) {
-                 return await response.json();
-             }
-             return null; // Or throw an error if non-JSON is unexpected
-        }
-
-        document.addEventListener('click', function(event) {
-            if (event.target.matches('.vote-button')) {
-                event.preventDefault();
-                const button = event.target;
-                if (button.disabled) return;
-                const postId = button.dataset.postId;
-                const voteType = button.dataset.voteType;
-                const url = `/vote/${postId}/${voteType}`;
-                button.disabled = true; button.style.opacity = '0.7';
-                fetch(url, { method: 'POST', headers: { 'X-Requested-With': 'XMLHttpRequest', 'Content-Type': 'application/json' } })
-                .then(response => processResponse(response, 'голосование'))
-                .then(data => {
-                    if (data && data.success) {
-                        const scoreElement = document.getElementById(`score-${postId}`);
-                        if (scoreElement) {
-                            scoreElement.textContent = data.new_score;
-                            scoreElement.className = 'post-score';
-                            if (data.new_score > 0) scoreElement.classList.add('score-positive');
-                            else if (data.new_score < 0) scoreElement.classList.add('score-negative');
-                            else scoreElement.classList.add('score-neutral');
-                        }
-                        const likeButton = document.querySelector(`.vote-button.like-button[data-post-id='${postId}']`);
-                        const dislikeButton = document.querySelector(`.vote-button.dislike-button[data-post-id='${postId}']`);
-                        if (likeButton) likeButton.classList.remove('active');
-                        if (dislikeButton) dislikeButton.classList.remove('active');
-                        if (data.user_vote === 1 && likeButton) likeButton.classList.add('active');
-                        else if (data.user_vote === -1 && dislikeButton) dislikeButton.classList.add('active');
-                        if (data.flash_messages) data.flash_messages.forEach(fm => displayFlashMessage(fm.message, fm.category));
-                    } else if (data) handleFetchError(new Error(data.message || 'Ошибка при голосовании.'), 'голосование');
-                })
-                .catch(error => handleFetchError(error, 'голосование'))
-                .finally(() => {
-                     const currentButton = document.querySelector(`.vote-button[data-post-id='${postId}'][data-vote-type='${voteType}']`);
-                     if(currentButton){ currentButton.disabled = false; currentButton.style.opacity = '1';}
-                });
-            }
-        });
-
-        function initializeNewPostFormListener() {
-            const newPostForm = document.getElementById('new-post-form');
-            if (newPostForm) {
-                newPostForm.addEventListener('submit', function(event) {
-                    event.preventDefault();
-                    const formData = new FormData(newPostForm);
-                    const submitButton = newPostForm.querySelector('button[type="submit"]');
-                    submitButton.disabled = true; submitButton.style.opacity = '0.7'; submitButton.textContent = 'Отправка...';
-                    fetch(newPostForm.action, { method: 'POST', body: formData, headers: { 'X-Requested-With': 'XMLHttpRequest' } })
-                    .then(response => processResponse(response, 'отправка поста'))
-                    .then(data => {
-                        if (data && data.success && data.post_html && data.new_post_id) {
-                            newPostForm.reset();
-                            const postsContainer = document.getElementById('posts-container');
-                            if (postsContainer) {
-                                const placeholder = postsContainer.querySelector('.no-posts-placeholder');
-                                if(placeholder) placeholder.remove();
-                                postsContainer.insertAdjacentHTML('afterbegin', data.post_html);
-                                const newPostElement = postsContainer.firstElementChild;
-                                if (newPostElement) {
-                                    newPostElement.classList.add('new-post-highlight');
-                                    latestKnownPostId = Math.max(latestKnownPostId, data.new_post_id);
-                                }
-                            }
-                            displayFlashMessage(data.message || 'Пост успешно создан!', 'success');
-                            if (data.flash_messages) data.flash_messages.forEach(fm => displayFlashMessage(fm.message, fm.category));
-                        } else if (data) handleFetchError(new Error(data.message || 'Не удалось создать пост.'), 'отправка поста');
-                    })
-                    .catch(error => handleFetchError(error, 'отправка поста'))
-                    .finally(() => { submitButton.disabled = false; submitButton.style.opacity = '1'; submitButton.textContent = 'Отправить'; });
-                });
-            }
-        }
-
-        function fetchNewPosts() {
-            if (!isPostPollingActive || document.hidden || !document.getElementById('posts-container')) return;
-            const currentLatestId = getLatestPostIdOnPage();
-            latestKnownPostId = Math.max(latestKnownPostId, currentLatestId);
-            const url = `/get_new_posts/${latestKnownPostId}`;
-            fetch(url)
-                .then(response => processResponse(response, 'проверка новых постов'))
-                .then(data => {
-                    if (data && data.success && data.posts_html && data.posts_html.length > 0) {
-                        const postsContainer = document.getElementById('posts-container');
-                        if (postsContainer) {
-                            const placeholder = postsContainer.querySelector('.no-posts-placeholder');
-                            if(placeholder) placeholder.remove();
-                            let maxNewId = latestKnownPostId;
-                            data.posts_html.forEach(postData => {
-                                const existingPostElement = document.getElementById(`post-${postData.id}`);
-                                if (existingPostElement) existingPostElement.outerHTML = postData.html;
-                                else {
-                                    postsContainer.insertAdjacentHTML('afterbegin', postData.html);
-                                    const newPostElement = postsContainer.firstElementChild;
-                                    if (newPostElement && newPostElement.id === `post-${postData.id}`) newPostElement.classList.add('new-post-highlight');
-                                }
-                                maxNewId = Math.max(maxNewId, postData.id);
-                            });
-                            latestKnownPostId = maxNewId;
-                        }
-                    }
-                    if (data && data.flash_messages) data.flash_messages.forEach(fm => displayFlashMessage(fm.message, fm.category));
-                })
-                .catch(error => {
-                     if (error.name === 'Forbidden' || error.name === 'Unauthorized') handleFetchError(error, 'проверка новых постов');
-                     else console.warn('Post Polling Error:', error.message || error);
-                });
-        }
-
-        // --- Direct Messaging JavaScript ---
-        const dmUserSearchInput = document.getElementById('dm-user-search');
-        const dmUserSearchResultsUl = document.getElementById('dm-user-search-results');
-        const dmConversationListUl = document.getElementById('dm-conversation-list');
-        const dmChatAreaContainer = document.getElementById('dm-chat-area-container');
-        const dmConversationListContainer = document.getElementById('dm-conversation-list-container');
-        const dmChatHeaderUsername = document.getElementById('dm-chat-with-username');
-        const dmMessagesDisplayDiv = document.getElementById('dm-messages-display');
-        const dmMessageForm = document.getElementById('dm-message-form');
-        const dmReceiverIdInput = document.getElementById('dm-receiver-id');
-        const dmMessageContentTextarea = document.getElementById('dm-message-content');
-        const dmNoSelectionPlaceholder = document.getElementById('dm-no-selection-placeholder');
-        const dmBackButton = document.getElementById('dm-back-to-conversations');
-
-        let activeConversationUserId = null;
-        let dmPollingIntervalId = null;
-        let isDmPollingActive = false;
-        let lastDmTimestamp = null;
-
-
-        function showChatArea(show = true) {
-            if(!dmChatAreaContainer || !dmConversationListContainer || !dmUserSearchResultsUl || !dmNoSelectionPlaceholder) return;
-            if (show) {
-                dmChatAreaContainer.style.display = 'flex';
-                dmConversationListContainer.style.display = 'none';
-                dmUserSearchResultsUl.style.display = 'none';
-                dmNoSelectionPlaceholder.style.display = 'none';
-            } else {
-                dmChatAreaContainer.style.display = 'none';
-                dmConversationListContainer.style.display = 'block';
-                dmUserSearchResultsUl.style.display = 'block';
-                if (dmConversationListUl.children.length === 0 && dmUserSearchResultsUl.children.length === 0) {
-                     dmNoSelectionPlaceholder.style.display = 'flex'; // Use flex to center
-                } else {
-                     dmNoSelectionPlaceholder.style.display = 'none';
-                }
-            }
-        }
-
-        if(dmBackButton) {
-            dmBackButton.addEventListener('click', () => {
-                activeConversationUserId = null;
-                stopDmPolling();
-                showChatArea(false);
-                loadConversations();
-            });
-        }
-
-        async function loadConversations() {
-            if (!current_user.is_authenticated || !dmConversationListUl) return;
-            try {
-                const response = await fetch('/api/direct_messages/conversations');
-                const data = await processResponse(response, 'загрузка диалогов');
-                if (data && data.success) {
-                    dmConversationListUl.innerHTML = '';
-                    if (dmNoSelectionPlaceholder && data.conversations.length === 0 && (!dmUserSearchResultsUl || dmUserSearchResultsUl.children.length === 0) ) {
-                         dmNoSelectionPlaceholder.style.display = 'flex'; // Use flex to center
-                    } else if (dmNoSelectionPlaceholder) {
-                         dmNoSelectionPlaceholder.style.display = 'none';
-                    }
-                    data.conversations.forEach(convo => {
-                        const li = document.createElement('li');
-                        const usernameSpan = document.createElement('span');
-                        usernameSpan.textContent = convo.username;
-                        li.appendChild(usernameSpan);
-
-                        li.dataset.userId = convo.user_id;
-                        if (convo.unread_count > 0) {
-                            const unreadSpan = document.createElement('span');
-                            unreadSpan.className = 'unread-indicator';
-                            unreadSpan.title = `${convo.unread_count} непрочитанных`;
-                            li.appendChild(unreadSpan);
-                        }
-                        if (convo.user_id === activeConversationUserId) {
-                            li.classList.add('active-conversation');
-                        }
-                        li.addEventListener('click', () => {
-                            setActiveConversation(convo.user_id, convo.username);
-                        });
-                        dmConversationListUl.appendChild(li);
-                    });
-                }
-            } catch (error) {
-                handleFetchError(error, 'загрузка диалогов');
-            }
-        }
-
-        async function setActiveConversation(userId, username) {
-            if(!dmChatHeaderUsername || !dmReceiverIdInput || !dmMessagesDisplayDiv) return;
-
-            activeConversationUserId = userId;
-            dmChatHeaderUsername.textContent = username;
-            dmReceiverIdInput.value = userId;
-            dmMessagesDisplayDiv.innerHTML = '';
-            lastDmTimestamp = null;
-
-            document.querySelectorAll('#dm-conversation-list li').forEach(li => {
-                li.classList.remove('active-conversation');
-                if (parseInt(li.dataset.userId) === userId) {
-                    li.classList.add('active-conversation');
-                }
-            });
-
-            showChatArea(true);
-            await loadMessagesForConversation(userId);
-            await markMessagesAsRead(userId);
-            startDmPolling();
-        }
-
-        async function loadMessagesForConversation(userId, sinceTimestamp = null) {
-            if (!activeConversationUserId || activeConversationUserId !== userId || !dmMessagesDisplayDiv) return;
-            let url = `/api/direct_messages/with/${userId}`;
-            if (sinceTimestamp) {
-                url += `?since=${sinceTimestamp}`;
-            }
-            try {
-                const response = await fetch(url);
-                const data = await processResponse(response, 'загрузка сообщений');
-                if (data && data.success) {
-                    // Check if we are near the bottom before adding new messages
-                    const isNearBottom = dmMessagesDisplayDiv.scrollHeight - dmMessagesDisplayDiv.scrollTop <= dmMessagesDisplayDiv.clientHeight + 50; // Add a small buffer
-
-                    data.messages.forEach(msg => {
-                        appendMessageToDisplay(msg);
-                        lastDmTimestamp = msg.timestamp;
-                    });
-
-                    // Scroll to bottom only if we were near the bottom or loading initial messages
-                    if (isNearBottom || !sinceTimestamp) {
-                         dmMessagesDisplayDiv.scrollTop = dmMessagesDisplayDiv.scrollHeight;
-                    }
-                    if (data.messages.length > 0 && !sinceTimestamp) {
-                         markMessagesAsRead(userId);
-                    }
-                }
-            } catch (error) {
-                handleFetchError(error, 'загрузка сообщений');
-            }
-        }
-
-        async function markMessagesAsRead(senderId) {
-            if (!current_user.is_authenticated || !senderId) return;
-            try {
-                await fetch(`/api/direct_messages/mark_read/${senderId}`, { method: 'POST' });
-                if(dmConversationListUl){
-                    const convoLi = dmConversationListUl.querySelector(`li[data-user-id="${senderId}"] .unread-indicator`);
-                    if (convoLi) convoLi.remove();
-                }
-            } catch (error) {
-                console.error("Error marking messages as read:", error);
-            }
-        }
-
-
-        function appendMessageToDisplay(msg) {
-            if(!dmMessagesDisplayDiv) return;
-            const msgDiv = document.createElement('div');
-            msgDiv.classList.add('message-bubble');
-            msgDiv.classList.add(msg.sender_id === current_user.id ? 'sent' : 'received');
-
-            const contentP = document.createElement('p');
-            contentP.innerHTML = msg.content;
-            msgDiv.appendChild(contentP);
-
-            const timeSpan = document.createElement('span');
-            timeSpan.className = 'msg-time';
-            // Parse timestamp as UTC and format for local time
-            const date = new Date(msg.timestamp + 'Z');
-            timeSpan.textContent = date.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
-            msgDiv.appendChild(timeSpan);
-
-            dmMessagesDisplayDiv.appendChild(msgDiv);
-        }
-
-        if (dmMessageForm) {
-            dmMessageForm.addEventListener('submit', async function(event) {
-                event.preventDefault();
-                if (!current_user.is_authenticated || !dmMessageContentTextarea || !dmReceiverIdInput) return;
-                const content = dmMessageContentTextarea.value.trim();
-                const receiverId = dmReceiverIdInput.value;
-                if (!content || !receiverId) return;
-
-                try {
-                    const response = await fetch('/api/direct_messages/send', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json', 'X-Requested-With': 'XMLHttpRequest' },
-                        body: JSON.stringify({ receiver_id: receiverId, content: content })
-                    });
-                    const data = await processResponse(response, 'отправка сообщения');
-                    if (data && data.success && data.message) {
-                        appendMessageToDisplay(data.message);
-                        if(dmMessagesDisplayDiv) dmMessagesDisplayDiv.scrollTop = dmMessagesDisplayDiv.scrollHeight;
-                        dmMessageContentTextarea.value = '';
-                        lastDmTimestamp = data.message.timestamp;
-                        loadConversations();
-                    } else if (data && data.message) {
-                        displayFlashMessage(data.message, 'error');
-                    }
-                } catch (error) {
-                    handleFetchError(error, 'отправка сообщения');
-                }
-            });
-        }
-
-        if (dmUserSearchInput) {
-            dmUserSearchInput.addEventListener('input', async function() {
-                if(!dmUserSearchResultsUl) return;
-                const query = this.value.trim();
-                dmUserSearchResultsUl.innerHTML = '';
-                if (query.length < 2) {
-                    if (query.length === 0) showChatArea(false);
-                    return;
-                }
-                try {
-                    const response = await fetch(`/api/users/search_for_dm?q=${encodeURIComponent(query)}`);
-                    const data = await processResponse(response, 'поиск пользователей');
-                    if (data && data.success) {
-                        if(dmNoSelectionPlaceholder) dmNoSelectionPlaceholder.style.display = 'none';
-                        data.users.forEach(user => {
-                            const li = document.createElement('li');
-
-                            const userInfoDiv = document.createElement('div');
-                            const usernameLink = document.createElement('a');
-                            usernameLink.href = `/user/${user.username}`;
-                            usernameLink.textContent = user.username;
-                            usernameLink.target = "_blank"; // Open profile in new tab
-                            userInfoDiv.appendChild(usernameLink);
-                            li.appendChild(userInfoDiv);
-
-                            const actionsDiv = document.createElement('div');
-                            actionsDiv.className = 'user-search-actions';
-
-                            const messageButton = document.createElement('button');
-                            messageButton.textContent = 'Написать';
-                            messageButton.className = 'button';
-                            messageButton.dataset.userId = user.id;
-                            messageButton.dataset.username = user.username;
-                            messageButton.addEventListener('click', (e) => {
-                                e.stopPropagation(); // Prevent li click event
-                                setActiveConversation(user.id, user.username);
-                                dmUserSearchInput.value = '';
-                                dmUserSearchResultsUl.innerHTML = '';
-                            });
-                            actionsDiv.appendChild(messageButton);
-                            li.appendChild(actionsDiv);
-
-                            // Original click to open chat directly (can be kept or removed based on preference)
-                            // li.addEventListener('click', () => {
-                            //     setActiveConversation(user.id, user.username);
-                            //     dmUserSearchInput.value = '';
-                            //     dmUserSearchResultsUl.innerHTML = '';
-                            // });
-                            dmUserSearchResultsUl.appendChild(li);
-                        });
-                         if (dmConversationListContainer && data.users.length > 0) {
-                             dmConversationListContainer.style.display = 'none';
-                         } else if (dmConversationListContainer) {
-                             dmConversationListContainer.style.display = 'block';
-                         }
-
-                    }
-                } catch (error) {
-                    handleFetchError(error, 'поиск пользователей');
-                }
-            });
-        }
-
-        function pollNewDms() {
-            if (!isDmPollingActive || !activeConversationUserId || document.hidden) return;
-            loadMessagesForConversation(activeConversationUserId, lastDmTimestamp);
-        }
-
-        function startDmPolling() {
-            stopDmPolling();
-            isDmPollingActive = true;
-            dmPollingIntervalId = setInterval(pollNewDms, 3500);
-            console.log(`DM polling started for user ${activeConversationUserId}.`);
-        }
-
-        function stopDmPolling() {
-            if (dmPollingIntervalId) {
-                clearInterval(dmPollingIntervalId);
-                dmPollingIntervalId = null;
-            }
-            isDmPollingActive = false;
-        }
-
-        // --- Panel Toggling Logic ---
-        const leftSidebar = document.getElementById('messaging-sidebar');
-        const mainForumContainer = document.getElementById('main-forum-container');
-        const leftSidebarToggle = document.getElementById('left-sidebar-toggle');
-        const fixedBottomPanel = document.getElementById('fixed-bottom-panel');
-        const bottomPanelToggle = document.getElementById('bottom-panel-toggle');
-        const mainContentWrapper = document.getElementById('main-content-wrapper');
-
-
-        function updateLeftSidebarToggleButton(isCollapsed) {
-            if (!leftSidebarToggle) return;
-            leftSidebarToggle.innerHTML = isCollapsed ? '&raquo;' : '&laquo;'; // Use consistent arrows
-            leftSidebarToggle.classList.toggle('collapsed-state', isCollapsed);
-        }
-
-        function toggleLeftSidebar() {
-            if (!leftSidebar || !mainForumContainer || !leftSidebarToggle) return;
-
-            leftSidebar.classList.toggle('collapsed');
-            mainForumContainer.classList.toggle('left-sidebar-collapsed');
-            const isCollapsed = leftSidebar.classList.contains('collapsed');
-            updateLeftSidebarToggleButton(isCollapsed);
-            localStorage.setItem('leftSidebarCollapsed', isCollapsed.toString());
-
-            if (fixedBottomPanel) {
-                 fixedBottomPanel.classList.toggle('left-sidebar-collapsed', isCollapsed);
-                 // Adjust fixed bottom panel left position based on sidebar state
-                 if (isCollapsed) {
-                     fixedBottomPanel.style.left = '0';
-                 } else {
-                     // Use the CSS variable value
-                     const sidebarWidth = getComputedStyle(document.documentElement).getPropertyValue('--left-sidebar-width').trim();
-                     fixedBottomPanel.style.left = sidebarWidth;
-                 }
-            }
-        }
-
-        function updateBottomPanelToggleButton(isCollapsed) {
-             if (!bottomPanelToggle) return;
-            bottomPanelToggle.innerHTML = isCollapsed ? '&#9650;' : '&#9660;'; // Use up/down arrows
-            bottomPanelToggle.classList.toggle('collapsed-state', isCollapsed);
-        }
-
-        function toggleBottomPanel() {
-            if (!fixedBottomPanel || !mainContentWrapper || !bottomPanelToggle) return;
-
-            fixedBottomPanel.classList.toggle('collapsed');
-            mainContentWrapper.classList.toggle('bottom-panel-collapsed');
-            const isCollapsed = fixedBottomPanel.classList.contains('collapsed');
-            updateBottomPanelToggleButton(isCollapsed);
-            localStorage.setItem('bottomPanelCollapsed', isCollapsed.toString());
-        }
-
-        // --- Report Modal JavaScript ---
-        const reportModal = document.getElementById('reportModal');
-        const closeButton = reportModal ? reportModal.querySelector('.close-button') : null;
-        const reportUserForm = document.getElementById('report-user-form');
-        const reportedUserIdInput = document.getElementById('reported-user-id');
-        const reportReasonTextarea = document.getElementById('report-reason');
-
-        // Function to open the modal
-        function openReportModal(userId) {
-            if (!reportModal || !reportedUserIdInput || !reportReasonTextarea) return;
-            reportedUserIdInput.value = userId;
-            reportReasonTextarea.value = ''; // Clear previous reason
-            reportModal.style.display = 'block';
-        }
-
-        // Function to close the modal
-        function closeReportModal() {
-            if (!reportModal) return;
-            reportModal.style.display = 'none';
-        }
-
-        // Close the modal when the user clicks on <span> (x)
-        if (closeButton) {
-            closeButton.onclick = function() {
-                closeReportModal();
-            }
-        }
-
-        // Close the modal when the user clicks anywhere outside of the modal content
-        window.onclick = function(event) {
-            if (event.target == reportModal) {
-                closeReportModal();
-            }
-        }
-
-        // Handle report form submission (This is for the modal, the profile page uses a direct form submit now)
-        if (reportUserForm) {
-             reportUserForm.addEventListener('submit', async function(event) {
-                event.preventDefault();
-                const userId = reportedUserIdInput.value;
-                const reason = reportReasonTextarea.value.trim();
-
-                if (!userId || !reason) {
-                    displayFlashMessage('Пожалуйста, укажите причину жалобы.', 'error');
-                    return;
-                }
-
-                try {
-                    // This fetch is for the modal form submit, which is now less likely to be used
-                    // as the profile page has a direct form. Keeping it for completeness if needed elsewhere.
-                    const response = await fetch(`/report_user/${userId}`, {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                            'X-Requested-With': 'XMLHttpRequest' // Indicate AJAX request
-                        },
-                        body: JSON.stringify({ reason: reason })
-                    });
-                    const data = await processResponse(response, 'отправка жалобы (модаль)');
-                    if (data && data.success) {
-                        displayFlashMessage(data.message || 'Жалоба отправлена!', 'success');
-                        closeReportModal();
-                    } else if (data) {
-                        handleFetchError(new Error(data.message || 'Не удалось отправить жалобу.'), 'отправка жалобы (модаль)');
-                    }
-                } catch (error) {
-                    handleFetchError(error, 'отправка жалобы (модаль)');
-                }
-            });
-        }
-
-
-        // --- Color Tag Insertion Logic ---
-        function applyColorTag(textareaId, colorPickerId) {
-            const textarea = document.getElementById(textareaId);
-            const colorPicker = document.getElementById(colorPickerId);
-            if (!textarea || !colorPicker) return;
-
-            const color = colorPicker.value;
-            const start = textarea.selectionStart;
-            const end = textarea.selectionEnd;
-            const selectedText = textarea.value.substring(start, end);
-
-            const tagStart = `<font color='${color}'>`;
-            const tagEnd = `</font>`;
-
-            const newText = textarea.value.substring(0, start) +
-                            tagStart + selectedText + tagEnd +
-                            textarea.value.substring(end);
-
-            textarea.value = newText;
-
-            // Restore cursor position
-            const newCursorPosition = start + tagStart.length + selectedText.length;
-            textarea.selectionStart = newCursorPosition;
-            textarea.selectionEnd = newCursorPosition;
-            textarea.focus();
-        }
-
-
-        // --- Initialization ---
-        document.addEventListener('DOMContentLoaded', () => {
-            initializeNewPostFormListener();
-            if (document.getElementById('posts-container')) {
-                latestKnownPostId = getLatestPostIdOnPage();
-                // Only start polling if we are on the main index page
-                if (window.location.pathname === '/') {
-                    if (isPostPollingActive) {
-                         postPollingIntervalId = setInterval(fetchNewPosts, 3000);
-                         console.log("Post polling started.");
-                    }
-                } else {
-                    stopPostPolling(); // Ensure polling is stopped on other pages
-                }
-            } else {
-                 stopPostPolling(); // Ensure polling is stopped if posts-container is not present
-            }
-
-
-            if (current_user && current_user.is_authenticated) {
-                loadConversations();
-                if (dmChatAreaContainer) showChatArea(false);
-            }
-
-            if (leftSidebarToggle) {
-                leftSidebarToggle.addEventListener('click', toggleLeftSidebar);
-                const isLeftCollapsed = localStorage.getItem('leftSidebarCollapsed') === 'true';
-                if (isLeftCollapsed) {
-                    if(leftSidebar) leftSidebar.classList.add('collapsed');
-                    if(mainForumContainer) mainForumContainer.classList.add('left-sidebar-collapsed');
-                    if(fixedBottomPanel) fixedBottomPanel.classList.add('left-sidebar-collapsed');
-                }
-                updateLeftSidebarToggleButton(isLeftCollapsed);
-                 // Set initial left position for fixed bottom panel based on initial state
-                if (fixedBottomPanel) {
-                    const sidebarWidth = getComputedStyle(document.documentElement).getPropertyValue('--left-sidebar-width').trim();
-                    fixedBottomPanel.style.left = isLeftCollapsed ? '0' : sidebarWidth;
-                }
-            }
-
-            if (bottomPanelToggle && fixedBottomPanel && mainContentWrapper) {
-                // Set initial bottom panel toggle position based on sidebar state
-                 const isLeftSidebarCollapsed = leftSidebar && leftSidebar.classList.contains('collapsed');
-                 const initialLeftMargin = isLeftSidebarCollapsed ? 0 : parseFloat(getComputedStyle(document.documentElement).getPropertyValue('--left-sidebar-width').trim());
-                 const mainContentWidth = mainForumContainer.offsetWidth; // Use main container width
-                 bottomPanelToggle.style.left = `${initialLeftMargin + mainContentWidth / 2}px`;
-                 bottomPanelToggle.style.transform = `translateX(-50%) translateY(50%)`; // Initial transform
-
-                bottomPanelToggle.addEventListener('click', toggleBottomPanel);
-                const isBottomCollapsed = localStorage.getItem('bottomPanelCollapsed') === 'true';
-                if (isBottomCollapsed) {
-                    if(fixedBottomPanel) fixedBottomPanel.classList.add('collapsed');
-                    if(mainContentWrapper) mainContentWrapper.classList.add('bottom-panel-collapsed');
-                }
-                updateBottomPanelToggleButton(isBottomCollapsed);
-            } else if (bottomPanelToggle) {
-                bottomPanelToggle.style.display = 'none'; // Hide if panel is not present
-            }
+    </div> {# End of main-forum-container #}
 
-            // Re-calculate bottom panel toggle position on window resize
-             window.addEventListener('resize', () => {
-                 if (bottomPanelToggle && mainForumContainer) {
-                     const isLeftSidebarCollapsed = leftSidebar && leftSidebar.classList.contains('collapsed');
-                     const currentLeftMargin = isLeftSidebarCollapsed ? 0 : parseFloat(getComputedStyle(document.documentElement).getPropertyValue('--left-sidebar-width').trim());
-                     const mainContentWidth = mainForumContainer.offsetWidth;
-                     bottomPanelToggle.style.left = `${currentLeftMargin + mainContentWidth / 2}px`;
-                 }
-             });
+    {% if new_post_form_html_for_bottom_panel and not request.endpoint in ['edit_post', 'user_profile', 'edit_profile', 'admin_reports', 'archive_index', 'archived_post'] %} {# Exclude admin_reports #}
+        <button id="bottom-panel-toggle" class="panel-toggle-button">&#9660;</button>
+        <div class="fixed-bottom-new-post-panel" id="fixed-bottom-panel">
+             <form method="POST" action="{{ url_for('index') }}" id="new-post-form">
+                <textarea id="new-post-content" name="content" placeholder="Напишите что-нибудь... (форматирование: &lt;b&gt;, &lt;i&gt;, &lt;u&gt;)" required rows="3"></textarea> {# Removed font tag hint #}
+                <div class="color-picker-container"> {# Added color picker for new post #}
+                     <label for="post-color-picker">Цвет текста:</label>
+                     <input type="color" id="post-color-picker" value="#e0e0e0">
+                     <button type="button" onclick="applyColorTag('new-post-content', 'post-color-picker')">Применить цвет</button>
+                </div>
+                <input type="text" id="tags" name="tags" placeholder="Теги (через запятую, например: новости, обсуждение)">
+                <div class="controls-container">
+                    {% if current_user.is_authenticated and current_user.is_admin %}
+                        <div class="pinned-checkbox-container">
+                            <input type="checkbox" id="pinned" name="pinned">
+                            <label for="pinned" class="checkbox-label">Закрепить</label>
+                        </div>
+                    {% endif %}
+                    <button type="submit">Отправить</button>
+                </div>
+             </form>
+        </div>
+    {% endif %}
 
-        });
+    <div id="reportModal" class="modal">
+        <div class="modal-content">
+            <span class="close-button">&times;</span>
+            <h3>Пожаловаться на пользователя</h3>
+            <form id="report-user-form">
+                <input type="hidden" id="reported-user-id" name="reported_user_id">
+                <textarea id="report-reason" name="reason" placeholder="Опишите причину жалобы..." required rows="5"></textarea>
+                <button type="submit" class="button">Отправить жалобу</button>
+            </form>
+        </div>
+    </div>
 
-        window.addEventListener('beforeunload', () => {
-             stopPostPolling();
-             stopDmPolling();
-        });
 
+    <script>
         // Pass current_user object to JS
         var current_user = {
             id: {{ current_user.id if current_user.is_authenticated else 'null' }},
             is_authenticated: {{ 'true' if current_user.is_authenticated else 'false' }},
             is_admin: {{ 'true' if current_user.is_authenticated and current_user.is_admin else 'false' }}
         };
-
     </script>
+    <script src="{{ asset_url('forum.js') }}"></script>
 </body>
 </html>
 """
@@ -1680,6 +1766,10 @@ BASE_HTML_TEMPLATE = """
 # @login_required  # Removed login_required to allow public profiles, report button will be conditional
 def user_profile(username):
     user = User.query.filter_by(username=username).first_or_404()
+    etag = conditional_etag(*get_data_versions(f'profile:{user.id}', 'user-stats'), html_page=True)
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
 
     profile_html = f"""
     <div class="profile-container">
@@ -1735,6 +1825,47 @@ def user_profile(username):
     profile_html += """
             </div>
     """
+    stats = db.session.get(UserStats, user.id) or UserStats(post_count=0, reply_count=0, votes_cast=0, karma=0)
+    last_active = stats.last_active_at.strftime("%Y-%m-%d %H:%M") if stats.last_active_at else '—'
+    profile_html += f"""
+        <div class="profile-stats">
+            <h3>Статистика:</h3>
+            <ul>
+                <li>Постов: {stats.post_count}</li>
+                <li>Ответов: {stats.reply_count}</li>
+                <li>Голосов отдано: {stats.votes_cast}</li>
+                <li>Карма: {stats.karma}</li>
+                <li>Последняя активность: {last_active}</li>
+            </ul>
+        </div>
+    """
+
+    # Keyset page over ix_post_user_recent: the same cost on the first page and the thousandth
+    page_size = app.config['PROFILE_POSTS_PAGE_SIZE']
+    posts_query = Post.query.filter(Post.user_id == user.id)
+    before_id = request.args.get('before', type=int)
+    if before_id is not None:
+        posts_query = posts_query.filter(Post.id < before_id)
+    posts = posts_query.order_by(Post.id.desc()).limit(page_size + 1).all()
+    has_more = len(posts) > page_size
+    posts = posts[:page_size]
+    profile_html += '<div class="profile-posts"><h3>Посты:</h3>'
+    for post in posts:
+        profile_html += f"""
+            <div class="profile-post-item">
+                <a href="{url_for('index', _anchor=f'post-{post.id}')}">{escape_html(post_preview(post.content))}</a>
+                <div class="metadata">
+                    <span class="time">{post.date.strftime("%Y-%m-%d %H:%M") if post.date else ''}</span>
+                    <span>рейтинг: {post.score}</span>
+                    <span>ответов: {post.reply_count}</span>
+                </div>
+            </div>
+        """
+    if not posts:
+        profile_html += '<p>Постов нет.</p>' if before_id is None else '<p>Больше постов нет.</p>'
+    if has_more:
+        profile_html += f'<div class="profile-posts-nav"><a href="{url_for('user_profile', username=user.username, before=posts[-1].id)}" class="button">Дальше</a></div>'
+    profile_html += '</div>'
     # Add Report Form (initially hidden)
     if current_user.is_authenticated and current_user.id != user.id:
         profile_html += f"""
@@ -1787,7 +1918,7 @@ def user_profile(username):
         }
     </script>
     """
-    return render_template_string(BASE_HTML_TEMPLATE, content=profile_html, all_tags=Tag.query.order_by(Tag.name).all())
+    return with_etag(render_template_string(BASE_HTML_TEMPLATE, content=profile_html), etag)
 
 
 @app.route('/report_user/<int:user_id>', methods=['POST'])
@@ -1831,43 +1962,114 @@ def admin_reports():
         flash('У вас нет прав доступа к этой странице.', 'error')
         return redirect(url_for('index'))
 
-    # Fetch reports, maybe order by timestamp, unresolved first
-    reports = Report.query.order_by(Report.is_resolved.asc(), Report.timestamp.desc()).all()
-
-    reports_html = """
-    <div class="reports-container">
+    # One entry per reported user, most recently reported first; pages continue after (latest time, latest id).
+    # The page walks ix_report_resolved_timestamp from the cursor and keeps the reports that are their user's
+    # latest (one probe of ix_report_resolved_reported_user_latest each), so a deep page reads about as many
+    # rows as the first instead of grouping the whole queue.
+    show_resolved = request.args.get('status') == 'resolved'
+    page_size = app.config['ADMIN_REPORTS_PAGE_SIZE']
+    newer = Report.__table__.alias('newer_report')
+    latest_query = Report.query.filter(Report.is_resolved == show_resolved, ~select(newer.c.id).where(
+        newer.c.is_resolved == show_resolved, newer.c.reported_user_id == Report.reported_user_id,
+        or_(newer.c.timestamp > Report.timestamp, and_(newer.c.timestamp == Report.timestamp, newer.c.id > Report.id))
+    ).exists())
+
+    before_id = request.args.get('before_id', type=int)
+    before_at_str = request.args.get('before')
+    if before_id is not None and before_at_str:
+        try:
+            before_at = datetime.fromisoformat(before_at_str)
+        except ValueError:
+            return redirect(url_for('admin_reports', status='resolved' if show_resolved else None))
+        # The plain bound lets the index walk start at the cursor; the OR alone would be checked row by row
+        latest_query = latest_query.filter(Report.timestamp <= before_at, or_(
+            Report.timestamp < before_at, and_(Report.timestamp == before_at, Report.id < before_id)))
+    groups = latest_query.order_by(Report.timestamp.desc(), Report.id.desc()).limit(page_size + 1).all()
+    has_more = len(groups) > page_size
+    groups = groups[:page_size]
+
+    # Counts and latest reasons of just these users, then everything else the page shows in two IN queries
+    # instead of per-report lazy loads
+    group_stats = {row.reported_user_id: row for row in db.session.query(
+        Report.reported_user_id, func.count(Report.id).label('report_count'),
+        func.max(case((Report.reason != None, Report.id))).label('latest_reason_id')
+    ).filter(Report.is_resolved == show_resolved, Report.reported_user_id.in_([g.reported_user_id for g in groups]))
+        .group_by(Report.reported_user_id)} if groups else {}
+    report_ids = {row.latest_reason_id for row in group_stats.values() if row.latest_reason_id}
+    reports_by_id = {r.id: r for r in groups}
+    reports_by_id.update({r.id: r for r in Report.query.filter(Report.id.in_(report_ids - set(reports_by_id)))}
+                         if report_ids else {})
+    user_ids = {g.reported_user_id for g in groups} | {r.reporter_id for r in reports_by_id.values()}
+    users = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
+    open_reports_total = Report.query.filter(Report.is_resolved == False).count()
+
+    def user_link(user_id, missing_text):
+        user = users.get(user_id)
+        if not user:
+            return missing_text
+        return f'<a href="{url_for('user_profile', username=user.username)}">{escape_html(user.username)}</a>'
+
+    status_arg = 'resolved' if show_resolved else None
+    reports_html = f"""
+    <div class="admin-reports-container">
         <h2>Жалобы пользователей</h2>
+        <div class="report-queue-nav">
+            <a href="{url_for('admin_reports')}" class="button{'' if show_resolved else ' active'}">Открытые ({open_reports_total})</a>
+            <a href="{url_for('admin_reports', status='resolved')}" class="button{' active' if show_resolved else ''}">Решённые</a>
+        </div>
     """
-    if reports:
-        for report in reports:
-            reporter_link = f'<a href="{url_for('user_profile', username=report.reporter.username)}">{escape_html(report.reporter.username)}</a>' if report.reporter else 'Аноним'
-            reported_link = f'<a href="{url_for('user_profile', username=report.reported_user.username)}">{escape_html(report.reported_user.username)}</a>' if report.reported_user else 'Неизвестный пользователь'
-            report_class = 'report-item'
-            if report.is_resolved:
-                report_class += ' report-resolved'
+    if groups:
+        for latest_report in groups:
+            reported_user = users.get(latest_report.reported_user_id)
+            stats = group_stats[latest_report.reported_user_id]
+            reason_report = reports_by_id.get(stats.latest_reason_id)
+            report_class = 'report-item report-resolved' if show_resolved else 'report-item'
+            actions = ''
+            if not show_resolved:
+                actions += '<form method="POST" action="' + url_for('admin_resolve_user_reports', user_id=latest_report.reported_user_id) + '" style="display:inline;"><button type="submit" class="button">Отметить все как решённые</button></form>'
+            if reported_user and not reported_user.is_banned:
+                actions += '<form method="POST" action="' + url_for('ban_user', user_id=latest_report.reported_user_id) + '" style="display:inline;"><button type="submit" class="button ban-button">Забанить пользователя</button></form>'
+            elif reported_user:
+                actions += '<form method="POST" action="' + url_for('unban_user', user_id=latest_report.reported_user_id) + '" style="display:inline;"><button type="submit" class="button unban-button">Разбанить пользователя</button></form>'
 
             reports_html += f"""
             <div class="{report_class}">
-                <div class="report-meta">
-                    От: {reporter_link} на: {reported_link} ({report.timestamp.strftime("%Y-%m-%d %H:%M")})
+                <div class="report-metadata">
+                    На: {user_link(latest_report.reported_user_id, 'Неизвестный пользователь')} — жалоб: <strong>{stats.report_count}</strong>,
+                    последняя от {user_link(latest_report.reporter_id, 'Аноним')} ({latest_report.timestamp.strftime("%Y-%m-%d %H:%M")})
                 </div>
                 <div class="report-reason">
-                    Причина: {escape_html(report.reason) if report.reason else 'Не указана'}
-                </div>
-                <div class="report-actions">
-                    {'<form method="POST" action="' + url_for('admin_resolve_report', report_id=report.id) + '" style="display:inline;"><button type="submit" class="button">Отметить как решенную</button></form>' if not report.is_resolved else ''}
-                    {'<form method="POST" action="' + url_for('ban_user', user_id=report.reported_user_id) + '" style="display:inline;"><button type="submit" class="button ban-button">Забанить пользователя</button></form>' if report.reported_user and not report.reported_user.is_banned else ''}
-                    {'<form method="POST" action="' + url_for('unban_user', user_id=report.reported_user_id) + '" style="display:inline;"><button type="submit" class="button unban-button">Разбанить пользователя</button></form>' if report.reported_user and report.reported_user.is_banned else ''}
+                    Последняя причина: {escape_html(reason_report.reason) if reason_report else 'Не указана'}
                 </div>
+                <div class="report-actions">{actions}</div>
             </div>
             """
+        if has_more:
+            last = groups[-1]
+            next_url = url_for('admin_reports', status=status_arg, before=last.timestamp.isoformat(), before_id=last.id)
+            reports_html += f'<div class="report-queue-nav"><a href="{next_url}" class="button">Дальше</a></div>'
     else:
-        reports_html += "<p>Нет новых жалоб.</p>"
+        reports_html += "<p>Нет жалоб.</p>" if show_resolved else "<p>Нет новых жалоб.</p>"
 
     reports_html += "</div>"
 
     return render_template_string(BASE_HTML_TEMPLATE, content=reports_html, all_tags=Tag.query.order_by(Tag.name).all())
 
+
+@app.route('/admin/reports/resolve_user/<int:user_id>', methods=['POST'])
+@login_required
+def admin_resolve_user_reports(user_id):
+    if not current_user.is_admin:
+        flash('У вас нет прав доступа к этой странице.', 'error')
+        return redirect(url_for('index'))
+
+    resolved = Report.query.filter_by(reported_user_id=user_id, is_resolved=False).update(
+        {'is_resolved': True}, synchronize_session=False)
+    db.session.commit()
+
+    flash(f'Жалоб отмечено как решённые: {resolved}.', 'success')
+    return redirect(request.referrer or url_for('admin_reports'))
+
 @app.route('/admin/reports/resolve/<int:report_id>', methods=['POST'])
 @login_required
 def admin_resolve_report(report_id):
@@ -1892,6 +2094,7 @@ def edit_profile():
 
     if request.method == 'POST':
         current_user.about_me = request.form.get('about_me', '').strip()
+        bump_data_versions(f'profile:{current_user.id}')
         db.session.commit()
         flash('Профиль успешно обновлен!', 'success')
         return redirect(url_for('user_profile', username=current_user.username))
@@ -1912,6 +2115,9 @@ def edit_profile():
     return render_template_string(BASE_HTML_TEMPLATE, content=form_html, all_tags=Tag.query.order_by(Tag.name).all())
 
 
+INDEX_STREAM_MARKER = '<!--index-posts-->'
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':  # For new forum post
@@ -1930,13 +2136,20 @@ def index():
         if not content or not content.strip():
             return jsonify({'success': False, 'message': 'Содержание поста не может быть пустым.'}), 400
 
-        new_post = Post(content=content, author=current_user, pinned=pinned)
+        now = datetime.utcnow()
+        new_post = Post(content=content, author=current_user, pinned=pinned, date=now, last_activity_at=now)
         tag_names = [tag.strip() for tag in tags_string.split(',') if tag.strip()]
         for tag_name in tag_names:
             tag = Tag.query.filter_by(name=tag_name).first()
             if not tag: tag = Tag(name=tag_name); db.session.add(tag)
             new_post.tags.append(tag)
         db.session.add(new_post)
+        db.session.flush()
+        refresh_hot_ranks([new_post.id])
+        if new_post.tags:
+            db.session.execute(tag_count_update([tag.id for tag in new_post.tags]))
+        update_user_stats({current_user.id: {'post_count': 1}}, [current_user.id])
+        bump_data_versions('feed')
         db.session.commit()
         check_and_award_achievements(current_user, event_type='new_post')
 
@@ -1949,32 +2162,44 @@ def index():
         })
 
     # --- GET request for index ---
+    feed_version, = get_data_versions('feed')
+    etag = conditional_etag(feed_version, html_page=True)
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    cache_key = anonymous_page_cache_key()
+    if cache_key is not None:
+        return with_etag(cached_page(cache_key, feed_version, lambda: render_index(streaming=False)), etag)
+    return with_etag(render_index(streaming=app.config['INDEX_STREAMING']), etag)
+
+
+def render_index(streaming):
     sort_by = request.args.get('sort_by', 'date_desc')
-    tag_filter_name = request.args.get('tag')
     query = Post.query
-    active_tag_filter = None
-
-    if tag_filter_name and tag_filter_name != 'all':
-        tag_obj = Tag.query.filter_by(name=tag_filter_name).first()
-        if tag_obj:
-            query = query.join(Post.tags).filter(Tag.id == tag_obj.id);
-            active_tag_filter = tag_filter_name
-        else:
-            tag_filter_name = None
-    elif tag_filter_name == 'all':
-        tag_filter_name = None
+    tags, tag_mode = resolve_tag_filter()
+    tag_args = {}
+    if tags:
+        query = query.filter(Post.id.in_(tagged_post_ids(tags, tag_mode)))
+        tag_args['tag'] = [tag.name for tag in tags]
+        if tag_mode == 'any' and len(tags) > 1:
+            tag_args['tag_mode'] = 'any'
 
     if sort_by == 'date_asc':
-        posts = query.order_by(Post.pinned.desc(), Post.date.asc()).all()
+        query = query.order_by(Post.pinned.desc(), Post.date.asc())
     elif sort_by == 'score_desc':
-        all_matching_posts = query.order_by(Post.pinned.desc(), Post.date.desc()).all()
-        posts = sorted([p for p in all_matching_posts if p.pinned], key=lambda p: p.date, reverse=True) + \
-                sorted([p for p in all_matching_posts if not p.pinned], key=lambda p: p.score, reverse=True)
+        # Pinned posts stay on top by date; the rest by score, newest first among equal scores
+        query = query.order_by(Post.pinned.desc(), case((Post.pinned == True, 0), else_=Post.vote_score).desc(),
+                               Post.date.desc())
+    elif sort_by == 'activity':  # Threads bumped by a new reply first; a walk of ix_post_pinned_activity
+        query = query.order_by(Post.pinned.desc(), Post.last_activity_at.desc())
+    elif sort_by == 'hot':
+        # Pinned posts are ranked first already, so this walks ix_post_rank_hot_score without sorting
+        query = query.join(PostRank, PostRank.post_id == Post.id).order_by(PostRank.hot_score.desc())
     else: # date_desc is default
-        posts = query.order_by(Post.pinned.desc(), Post.date.desc()).all()
+        query = query.order_by(Post.pinned.desc(), Post.date.desc())
 
-    all_tags_list = Tag.query.order_by(Tag.name).all()
-    posts_html_list = [render_post(post) for post in posts]
+    all_tags_list = tag_list()
 
     new_post_form_content_html = ""
     if current_user.is_authenticated and current_user.is_active:
@@ -2005,16 +2230,109 @@ def index():
     else:
         new_post_form_content_html = f'<p><a href="{url_for('login')}">Войдите</a> или <a href="{url_for('register')}">зарегистрируйтесь</a>, чтобы оставлять сообщения.</p>'
 
-    no_posts_placeholder = '<p class="no-posts-placeholder" style="text-align:center; padding: 20px 0;">Пока нет постов. Создайте первый!</p>' if not posts else ''
+    no_posts_placeholder = '<p class="no-posts-placeholder" style="text-align:center; padding: 20px 0;">Пока нет постов. Создайте первый!</p>'
+    template_context = dict(all_tags=all_tags_list, sort_by=sort_by, tag_filters=tag_args.get('tag', []),
+                            tag_mode=tag_mode, tag_args=tag_args,
+                            new_post_form_html_for_bottom_panel=new_post_form_content_html)
+
+    if streaming:
+        # Render the shell now (this also consumes the flashes before the session cookie is written),
+        # then fill the posts container chunk by chunk
+        page_content = f'''
+        <h2>Посты ({Post.query.count()})</h2>
+        <div id="posts-container"> {INDEX_STREAM_MARKER} </div>'''
+        head, tail = render_template_string(BASE_HTML_TEMPLATE, content=page_content,
+                                            **template_context).split(INDEX_STREAM_MARKER, 1)
+
+        # Only the ids are read up front, and each chunk is loaded by its own query that is fully read before
+        # it is sent. A cursor left open while a slow client drains the response would hold SQLite's shared
+        # lock and make every write wait on that client.
+        post_ids = [post_id for post_id, in query.with_entities(Post.id)]
+
+        def generate_page():
+            yield head
+            chunk_size = app.config['INDEX_STREAM_CHUNK']
+            for start in range(0, len(post_ids), chunk_size):
+                chunk_ids = post_ids[start:start + chunk_size]
+                posts = {post.id: post for post in
+                         Post.query.options(selectinload(Post.tags)).filter(Post.id.in_(chunk_ids)).all()}
+                # A post deleted since the ids were read is skipped
+                yield ''.join(render_post(posts[post_id]) for post_id in chunk_ids if post_id in posts)
+            if not post_ids:
+                yield no_posts_placeholder
+            yield tail
+
+        return Response(stream_with_context(generate_page()), mimetype='text/html')
+
+    posts = query.all()
     page_content = f'''
         <h2>Посты ({Post.query.count()})</h2>
-        <div id="posts-container"> {''.join(posts_html_list) if posts else no_posts_placeholder} </div>'''
+        <div id="posts-container"> {''.join(render_post(post) for post in posts) if posts else no_posts_placeholder} </div>'''
 
-    return render_template_string(
-        BASE_HTML_TEMPLATE, content=page_content, all_tags=all_tags_list,
-        sort_by=sort_by, tag_filter=active_tag_filter,
-        new_post_form_html_for_bottom_panel=new_post_form_content_html
-    )
+    return render_template_string(BASE_HTML_TEMPLATE, content=page_content, **template_context)
+
+
+# --- Conversation Summaries ---
+def conversation_preview(content):
+    return one_line_preview(content, CONVERSATION_PREVIEW_LENGTH)
+
+
+def record_dm_in_conversation(dm):
+    # Runs in the sender's transaction after dm is flushed, so the summary commits or rolls back with it
+    table = Conversation.__table__
+    low_id, high_id = sorted((dm.sender_id, dm.receiver_id))
+    unread_column = 'unread_low' if dm.receiver_id == low_id else 'unread_high'
+    is_newer = func.coalesce(table.c.last_message_id, 0) < dm.id  # Concurrent sends may commit out of order
+    last_values = {'last_message_id': dm.id, 'last_message_at': dm.timestamp, 'last_sender_id': dm.sender_id,
+                   'last_message_preview': conversation_preview(dm.content)}
+    update = table.update().where(table.c.user_low_id == low_id, table.c.user_high_id == high_id).values(
+        **{name: case((is_newer, value), else_=table.c[name]) for name, value in last_values.items()},
+        **{unread_column: table.c[unread_column] + 1})
+    if db.session.execute(update).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(user_low_id=low_id, user_high_id=high_id, **last_values,
+                                                     **dict({'unread_low': 0, 'unread_high': 0}, **{unread_column: 1})))
+    except IntegrityError:  # The first message of this pair from another request won the insert
+        db.session.execute(update)
+
+
+def rebuild_conversations():
+    # Recomputes every summary from direct_message and its archive in one transaction; returns the number of
+    # conversations. A conversation whose last message is archived keeps its preview but no last_message_id.
+    live, archived = DirectMessage.__table__, ArchivedDirectMessage.__table__
+    dm = select(live.c.id, live.c.sender_id, live.c.receiver_id, live.c.content, live.c.timestamp,
+                live.c.is_read).union_all(
+        select(archived.c.id, archived.c.sender_id, archived.c.receiver_id, archived.c.content,
+               archived.c.timestamp, archived.c.is_read)).subquery()
+    low = case((dm.c.sender_id < dm.c.receiver_id, dm.c.sender_id), else_=dm.c.receiver_id)
+    high = case((dm.c.sender_id < dm.c.receiver_id, dm.c.receiver_id), else_=dm.c.sender_id)
+    unread_low = func.sum(case(((dm.c.receiver_id == low) & (dm.c.is_read == False), 1), else_=0))
+    unread_high = func.sum(case(((dm.c.receiver_id == high) & (dm.c.is_read == False), 1), else_=0))
+    pairs = db.session.execute(select(low.label('low'), high.label('high'), func.max(dm.c.id).label('last_id'),
+                                      unread_low.label('unread_low'), unread_high.label('unread_high'))
+                               .group_by(low, high)).all()
+    last_ids = [pair.last_id for pair in pairs]
+    last_messages = {}
+    live_ids = set()
+    for start in range(0, len(last_ids), 500):
+        for message in db.session.execute(select(dm.c.id, dm.c.timestamp, dm.c.sender_id, dm.c.content)
+                                          .where(dm.c.id.in_(last_ids[start:start + 500]))):
+            last_messages[message.id] = message
+        live_ids.update(db.session.execute(select(live.c.id).where(live.c.id.in_(last_ids[start:start + 500])))
+                        .scalars())
+    db.session.execute(Conversation.__table__.delete())
+    rows = [{'user_low_id': pair.low, 'user_high_id': pair.high,
+             'last_message_id': pair.last_id if pair.last_id in live_ids else None,
+             'last_message_at': last_messages[pair.last_id].timestamp,
+             'last_sender_id': last_messages[pair.last_id].sender_id,
+             'last_message_preview': conversation_preview(last_messages[pair.last_id].content),
+             'unread_low': pair.unread_low or 0, 'unread_high': pair.unread_high or 0} for pair in pairs]
+    for start in range(0, len(rows), 1000):
+        db.session.execute(Conversation.__table__.insert(), rows[start:start + 1000])
+    db.session.commit()
+    return len(rows)
 
 
 # --- Direct Messaging API Routes ---
@@ -2037,68 +2355,95 @@ def search_users_for_dm():
 @app.route('/api/direct_messages/conversations', methods=['GET'])
 @login_required
 def get_conversations():
-    sent_to_ids = db.session.query(DirectMessage.receiver_id).filter(
-        DirectMessage.sender_id == current_user.id).distinct()
-    received_from_ids = db.session.query(DirectMessage.sender_id).filter(
-        DirectMessage.receiver_id == current_user.id).distinct()
+    etag = conditional_etag(*get_data_versions(f'dm:{current_user.id}'))
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
 
-    user_ids = {uid[0] for uid in sent_to_ids}.union({uid[0] for uid in received_from_ids})
+    summaries = Conversation.query.filter(
+        or_(Conversation.user_low_id == current_user.id, Conversation.user_high_id == current_user.id)
+    ).all()
+    other_ids = [c.user_high_id if c.user_low_id == current_user.id else c.user_low_id for c in summaries]
+    users = {u.id: u for u in User.query.filter(User.id.in_(other_ids)).all()} if other_ids else {}
 
     conversations = []
-    if user_ids:
-        users = User.query.filter(User.id.in_(user_ids)).all()
-        for user_obj in users:
-            unread_count = DirectMessage.query.filter(
-                DirectMessage.sender_id == user_obj.id,
-                DirectMessage.receiver_id == current_user.id,
-                DirectMessage.is_read == False
-            ).count()
-
-            last_msg = DirectMessage.query.filter(
-                or_(
-                    (DirectMessage.sender_id == current_user.id) & (DirectMessage.receiver_id == user_obj.id),
-                    (DirectMessage.sender_id == user_obj.id) & (DirectMessage.receiver_id == current_user.id)
-                )
-            ).order_by(DirectMessage.timestamp.desc()).first()
-
-            conversations.append({
-                'user_id': user_obj.id,
-                'username': user_obj.username,
-                'unread_count': unread_count,
-                'last_message_time': last_msg.timestamp if last_msg else datetime.min
-            })
+    for summary, other_id in zip(summaries, other_ids):
+        user_obj = users.get(other_id)
+        if not user_obj:
+            continue
+        conversations.append({
+            'user_id': user_obj.id,
+            'username': user_obj.username,
+            'unread_count': summary.unread_low if summary.user_low_id == current_user.id else summary.unread_high,
+            'last_message_time': summary.last_message_at or datetime.min,
+            'last_message_preview': summary.last_message_preview or '',
+        })
     conversations.sort(key=lambda c: c['last_message_time'], reverse=True)
-    return jsonify({'success': True, 'conversations': conversations})
+    return with_etag(jsonify({'success': True, 'conversations': conversations}), etag)
 
 
 @app.route('/api/direct_messages/with/<int:other_user_id>', methods=['GET'])
 @login_required
 def get_messages_with_user(other_user_id):
+    etag = conditional_etag(*get_data_versions(f'dm:{current_user.id}'))
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
     other_user = User.query.get_or_404(other_user_id)
-    since_timestamp_str = request.args.get('since')
-
-    query = DirectMessage.query.filter(
-        or_(
-            (DirectMessage.sender_id == current_user.id) & (DirectMessage.receiver_id == other_user_id),
-            (DirectMessage.sender_id == other_user_id) & (DirectMessage.receiver_id == current_user.id)
-        )
-    )
-    if since_timestamp_str:
+    try:
+        limit = min(int(request.args.get('limit', app.config['DM_PAGE_SIZE'])), app.config['DM_MAX_PAGE_SIZE'])
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Неверные параметры запроса.'}), 400
+    if limit < 1:
+        return jsonify({'success': False, 'message': 'Неверные параметры запроса.'}), 400
+
+    since_timestamp_str = request.args.get('since')  # Pages loaded before the switch to id cursors
+    if since_timestamp_str and after_id is None:
         try:
             # Parse timestamp assuming it's UTC (isoformat ends with Z)
             since_timestamp = datetime.fromisoformat(since_timestamp_str.replace('Z', '+00:00'))
-            query = query.filter(DirectMessage.timestamp > since_timestamp)
         except ValueError:
             return jsonify({'success': False, 'message': 'Неверный формат времени.'}), 400
+        last_before = DirectMessage.query.filter(
+            or_(
+                (DirectMessage.sender_id == current_user.id) & (DirectMessage.receiver_id == other_user.id),
+                (DirectMessage.sender_id == other_user.id) & (DirectMessage.receiver_id == current_user.id)
+            ), DirectMessage.timestamp <= since_timestamp).order_by(DirectMessage.id.desc()).first()
+        after_id = last_before.id if last_before else 0
+
+    # Each direction is its own range scan on (sender_id, receiver_id, id); fetch one extra row to know
+    # whether there is more, then merge the two sides. Archived messages are never new, so only pages
+    # going back in history also scan the archive.
+    messages = []
+    models = (DirectMessage,) if after_id is not None else (DirectMessage, ArchivedDirectMessage)
+    for model in models:
+        for sender_id, receiver_id in ((current_user.id, other_user.id), (other_user.id, current_user.id)):
+            query = model.query.filter(model.sender_id == sender_id, model.receiver_id == receiver_id)
+            if after_id is not None:
+                query = query.filter(model.id > after_id).order_by(model.id.asc())
+            else:
+                if before_id is not None:
+                    query = query.filter(model.id < before_id)
+                query = query.order_by(model.id.desc())
+            messages.extend(query.limit(limit + 1).all())
+
+    if after_id is not None:
+        messages.sort(key=lambda m: m.id)  # Oldest new messages first; a later poll picks up the rest
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+    else:
+        messages.sort(key=lambda m: m.id, reverse=True)  # The latest page before the cursor
+        has_more = len(messages) > limit
+        messages = messages[:limit][::-1]
 
-    messages = query.order_by(DirectMessage.timestamp.asc()).all()
-
-    return jsonify({'success': True, 'messages': [
+    return with_etag(jsonify({'success': True, 'has_more': has_more, 'messages': [
         {'id': m.id, 'sender_id': m.sender_id, 'receiver_id': m.receiver_id,
          'content': escape_html(m.content),  # Already escaped here
          'timestamp': m.timestamp.isoformat(), 'is_read': m.is_read}
         for m in messages
-    ]})
+    ]}), etag)
 
 
 @app.route('/api/direct_messages/send', methods=['POST'])
@@ -2120,8 +2465,11 @@ def send_direct_message():
     if receiver.id == current_user.id:
         return jsonify({'success': False, 'message': 'Нельзя отправить сообщение самому себе.'}), 400
 
-    dm = DirectMessage(sender_id=current_user.id, receiver_id=receiver_id, content=content)
+    dm = DirectMessage(sender_id=current_user.id, receiver_id=receiver.id, content=content)
     db.session.add(dm)
+    db.session.flush()
+    record_dm_in_conversation(dm)
+    bump_data_versions(f'dm:{current_user.id}', f'dm:{receiver.id}')
     db.session.commit()
 
     return jsonify({'success': True, 'message': {
@@ -2133,16 +2481,23 @@ def send_direct_message():
 @app.route('/api/direct_messages/mark_read/<int:sender_id>', methods=['POST'])
 @login_required
 def mark_dm_as_read(sender_id):
-    messages_to_mark = DirectMessage.query.filter_by(
+    marked_count = DirectMessage.query.filter_by(
         sender_id=sender_id,
         receiver_id=current_user.id,
         is_read=False
-    ).all()
-
-    for msg in messages_to_mark:
-        msg.is_read = True
+    ).update({'is_read': True}, synchronize_session=False)
+
+    if marked_count:
+        # Subtract what was actually marked: a message arriving meanwhile stays counted as unread
+        table = Conversation.__table__
+        low_id, high_id = sorted((sender_id, current_user.id))
+        unread_column = table.c.unread_low if current_user.id == low_id else table.c.unread_high
+        db.session.execute(table.update().where(table.c.user_low_id == low_id, table.c.user_high_id == high_id)
+                           .values({unread_column: case((unread_column > marked_count, unread_column - marked_count),
+                                                        else_=0)}))
+        bump_data_versions(f'dm:{current_user.id}', f'dm:{sender_id}')
     db.session.commit()
-    return jsonify({'success': True, 'marked_count': len(messages_to_mark)})
+    return jsonify({'success': True, 'marked_count': marked_count})
 
 
 @app.route('/edit_post/<int:post_id>', methods=['GET', 'POST'])
@@ -2177,13 +2532,17 @@ def edit_post(post_id):
             tag = Tag.query.filter_by(name=tag_name).first()
             if not tag: tag = Tag(name=tag_name); db.session.add(tag)
             post.tags.append(tag)
-        db.session.commit()
+        db.session.flush()
         current_tag_ids = {tag.id for tag in post.tags}
+        if original_tag_ids | current_tag_ids:
+            db.session.execute(tag_count_update(original_tag_ids | current_tag_ids))
+        bump_data_versions('feed', f'profile:{post.user_id}')
+        db.session.commit()
         tag_ids_potentially_orphaned = original_tag_ids - current_tag_ids
         if tag_ids_potentially_orphaned:
             orphaned_tags = Tag.query.filter(Tag.id.in_(tag_ids_potentially_orphaned)).all()
             for tag_to_check in orphaned_tags:
-                if tag_to_check and not tag_to_check.posts.count(): db.session.delete(tag_to_check) # Added check for tag existence
+                if tag_to_check and not tag_to_check.post_count: db.session.delete(tag_to_check)
             db.session.commit()
         flash('Пост успешно обновлен!', 'success');
         return redirect(url_for('index', _anchor=f'post-{post.id}'))
@@ -2196,6 +2555,11 @@ def edit_post(post_id):
 
 @app.route('/get_new_posts/<int:latest_post_id>')
 def get_new_posts(latest_post_id):
+    etag = conditional_etag(*get_data_versions('feed'))
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
+
     # Fetch pinned posts separately to ensure they are always at the top
     pinned_posts = Post.query.filter_by(pinned=True).order_by(Post.date.desc()).all()
     # Fetch new non-pinned posts
@@ -2204,12 +2568,308 @@ def get_new_posts(latest_post_id):
 
     all_posts_to_render = pinned_posts + new_posts # Combine, pinned first
 
-    if not all_posts_to_render: return jsonify({'success': True, 'posts_html': [], 'flash_messages': []})
+    if not all_posts_to_render:
+        return with_etag(jsonify({'success': True, 'posts_html': [], 'flash_messages': []}), etag)
 
     posts_data = [{'id': post.id, 'html': render_post(post)} for post in all_posts_to_render]
 
-    return jsonify(
-        {'success': True, 'posts_html': posts_data, 'flash_messages': []})
+    return with_etag(jsonify(
+        {'success': True, 'posts_html': posts_data, 'flash_messages': []}), etag)
+
+
+# --- Feed API ---
+# /api/v1/posts pages the feed newest first by id: ?before=<id> continues a listing, ?after=<id> polls for posts
+# newer than the client has. ?fields= picks what each post carries, ?tag= and ?tag_mode= filter like the feed
+# page. Rows come from one column-projected SELECT per page (plus one for tags when asked), and the payload is
+# serialized by orjson when it is installed.
+API_POST_FIELDS = ('id', 'content', 'html', 'date', 'author', 'score', 'reply_count', 'last_activity_at', 'pinned',
+                   'edit_count', 'tags')
+API_DEFAULT_POST_FIELDS = ('id', 'content', 'date', 'author', 'score', 'reply_count', 'pinned', 'tags')
+API_REPLY_FIELDS = ('id', 'content', 'date', 'author')
+
+
+class ApiError(Exception):
+    pass
+
+
+def api_response(payload, etag=None):
+    if orjson:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return with_etag(Response(body, mimetype='application/json'), etag)
+
+
+def api_error(message, status=400):
+    return jsonify({'success': False, 'message': message}), status
+
+
+def api_page_args():
+    limit = request.args.get('limit', app.config['API_PAGE_SIZE'], type=int)
+    before_id = request.args.get('before', type=int)
+    after_id = request.args.get('after', type=int)
+    if limit is None or not 1 <= limit <= app.config['API_MAX_PAGE_SIZE']:
+        raise ApiError(f'limit должен быть от 1 до {app.config["API_MAX_PAGE_SIZE"]}.')
+    if before_id is not None and after_id is not None:
+        raise ApiError('Укажите только before или after.')
+    return limit, before_id, after_id
+
+
+def api_fields(allowed, default):
+    requested = request.args.get('fields')
+    if not requested:
+        return default
+    fields = tuple(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in allowed]
+    if unknown or not fields:
+        raise ApiError(f'Неизвестные поля: {", ".join(unknown)}. Доступны: {", ".join(allowed)}.')
+    return fields
+
+
+def _api_date(value):
+    return value.isoformat() if value else None
+
+
+def api_post_rows(posts, fields):
+    # posts: rows of Post columns and the author's username; returns the JSON-ready dicts
+    tags = defaultdict(list)
+    if 'tags' in fields and posts:
+        for post_id, name in db.session.execute(
+                select(post_tags.c.post_id, Tag.name).join(Tag, Tag.id == post_tags.c.tag_id)
+                .where(post_tags.c.post_id.in_([post.id for post in posts])).order_by(Tag.name)):
+            tags[post_id].append(name)
+    getters = {'id': lambda p: p.id, 'content': lambda p: p.content,
+               'html': lambda p: str(render_formatted_post_content(p.content)), 'date': lambda p: _api_date(p.date),
+               'author': lambda p: p.username, 'score': lambda p: p.vote_score or 0,
+               'reply_count': lambda p: p.reply_count, 'last_activity_at': lambda p: _api_date(p.last_activity_at),
+               'pinned': lambda p: bool(p.pinned), 'edit_count': lambda p: p.edit_count or 0,
+               'tags': lambda p: tags.get(p.id, [])}
+    return [{name: getters[name](post) for name in fields} for post in posts]
+
+
+@app.route('/api/v1/posts')
+def api_posts():
+    etag = conditional_etag(*get_data_versions('feed'))
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
+    try:
+        limit, before_id, after_id = api_page_args()
+        fields = api_fields(API_POST_FIELDS, API_DEFAULT_POST_FIELDS)
+    except ApiError as e:
+        return api_error(str(e))
+
+    columns = [Post.id, Post.date, Post.vote_score, Post.reply_count, Post.last_activity_at, Post.pinned,
+               Post.edit_count]
+    if {'content', 'html'} & set(fields):
+        columns.append(Post.content)
+    query = select(*columns, User.username).join(User, User.id == Post.user_id)
+    tags, tag_mode = resolve_tag_filter()
+    if tags:
+        query = query.where(Post.id.in_(tagged_post_ids(tags, tag_mode)))
+    if after_id is not None:  # Oldest new posts first, so a client can keep polling from the last id it got
+        query = query.where(Post.id > after_id).order_by(Post.id.asc())
+    else:
+        if before_id is not None:
+            query = query.where(Post.id < before_id)
+        query = query.order_by(Post.id.desc())
+    posts = db.session.execute(query.limit(limit + 1)).all()
+    has_more = len(posts) > limit
+    posts = posts[:limit]
+    return api_response({'success': True, 'has_more': has_more, 'posts': api_post_rows(posts, fields)}, etag)
+
+
+@app.route('/api/v1/posts/<int:post_id>/replies')
+def api_post_replies(post_id):
+    etag = conditional_etag(*get_data_versions('feed'))
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
+    try:
+        limit, before_id, after_id = api_page_args()
+        fields = api_fields(API_REPLY_FIELDS, API_REPLY_FIELDS)
+    except ApiError as e:
+        return api_error(str(e))
+    if db.session.get(Post, post_id) is None:
+        return api_error('Пост не найден.', 404)
+
+    # Oldest first, as the thread reads; ?after= continues, ?before= goes back from a reply
+    query = select(Reply.id, Reply.content, Reply.date, User.username).join(User, User.id == Reply.user_id).where(
+        Reply.post_id == post_id)
+    if before_id is not None:
+        replies = db.session.execute(query.where(Reply.id < before_id).order_by(Reply.id.desc())
+                                     .limit(limit + 1)).all()
+        has_more = len(replies) > limit
+        replies = replies[:limit][::-1]
+    else:
+        if after_id is not None:
+            query = query.where(Reply.id > after_id)
+        replies = db.session.execute(query.order_by(Reply.id.asc()).limit(limit + 1)).all()
+        has_more = len(replies) > limit
+        replies = replies[:limit]
+    getters = {'id': lambda r: r.id, 'content': lambda r: r.content, 'date': lambda r: _api_date(r.date),
+               'author': lambda r: r.username}
+    return api_response({'success': True, 'has_more': has_more,
+                         'replies': [{name: getters[name](reply) for name in fields} for reply in replies]}, etag)
+
+
+# --- Votes ---
+# A vote is one INSERT ... ON CONFLICT (user_id, post_id) DO UPDATE: a first vote inserts, the other button switches
+# vote_type and the same button again sets it to 0; RETURNING gives the new state and the 0 rows are deleted in the
+# same transaction. Post.vote_score is then recomputed once per touched post. With VOTE_BATCHING the votes go
+# through one writer thread per process that applies everything queued in a single transaction, so a burst of
+# votes costs SQLite one commit and one writer instead of one of each per vote.
+VOTE_UPSERT_INSERTS = {'postgresql': pg_insert, 'sqlite': sqlite_insert}
+VOTE_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def vote_score_update(post_ids=None):
+    table = Post.__table__
+    score = select(func.coalesce(func.sum(Vote.vote_type), 0)).where(Vote.post_id == table.c.id).scalar_subquery()
+    statement = table.update().values(vote_score=score)
+    if post_ids is not None:
+        statement = statement.where(table.c.id.in_(post_ids))
+    return statement
+
+
+def _write_vote(user_id, post_id, value, now):
+    # Returns (vote id, vote_type after the write); vote_type 0 means the vote was taken back
+    table = Vote.__table__
+    insert = VOTE_UPSERT_INSERTS.get(db.engine.dialect.name)
+    if insert is None:  # No upsert: read, then write
+        existing = db.session.execute(select(table.c.id, table.c.vote_type).where(
+            table.c.user_id == user_id, table.c.post_id == post_id)).first()
+        if not existing:
+            return db.session.execute(table.insert().values(user_id=user_id, post_id=post_id, vote_type=value,
+                                                            date=now)).inserted_primary_key[0], value
+        new_value = 0 if existing.vote_type == value else value
+        db.session.execute(table.update().where(table.c.id == existing.id).values(vote_type=new_value, date=now))
+        return existing.id, new_value
+    statement = insert(table).values(user_id=user_id, post_id=post_id, vote_type=value, date=now)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.post_id],
+        set_={'vote_type': case((table.c.vote_type == statement.excluded.vote_type, 0),
+                                else_=statement.excluded.vote_type),
+              'date': statement.excluded.date})
+    return tuple(db.session.execute(statement.returning(table.c.id, table.c.vote_type)).one())
+
+
+def apply_votes(votes):
+    # votes: [(user_id, post_id, 1 or -1)]. Runs in the caller's transaction and returns, in the same order,
+    # (previous vote_type or None, new vote_type or None, post score, post author id), or None for a post that
+    # does not exist.
+    post_ids = {post_id for _, post_id, _ in votes}
+    old_scores = {row.id: row for row in db.session.execute(
+        select(Post.id, Post.vote_score, Post.user_id).where(Post.id.in_(post_ids)))}
+    existing_posts = set(old_scores)
+    previous = {(row.user_id, row.post_id): row.vote_type for row in db.session.execute(
+        select(Vote.user_id, Vote.post_id, Vote.vote_type).where(
+            Vote.user_id.in_({user_id for user_id, _, _ in votes}), Vote.post_id.in_(existing_posts)))}
+    now = datetime.utcnow()
+    states = []
+    removed_ids = []
+    stats = defaultdict(lambda: defaultdict(int))
+    for user_id, post_id, value in votes:
+        if post_id not in existing_posts:
+            states.append(None)
+            continue
+        vote_id, new_value = _write_vote(user_id, post_id, value, now)
+        old_value = previous.get((user_id, post_id))
+        states.append((old_value or None, new_value or None))
+        if not new_value:
+            removed_ids.append(vote_id)
+        stats[user_id]['votes_cast'] += bool(new_value) - bool(old_value)
+        previous[(user_id, post_id)] = new_value
+    if removed_ids:
+        db.session.execute(Vote.__table__.delete().where(Vote.id.in_(removed_ids), Vote.vote_type == 0))
+    posts = {}
+    if existing_posts:
+        posts = {row.id: row for row in db.session.execute(vote_score_update(existing_posts).returning(
+            Post.__table__.c.id, Post.__table__.c.vote_score, Post.__table__.c.user_id))}
+        refresh_hot_ranks(existing_posts)
+        for post_id, post in posts.items():
+            stats[post.user_id]['karma'] += post.vote_score - (old_scores[post_id].vote_score or 0)
+        update_user_stats(stats, active_user_ids={user_id for user_id, post_id, _ in votes
+                                                     if post_id in existing_posts}, now=now)
+        bump_data_versions('feed')
+    return [(*state, posts[post_id].vote_score, posts[post_id].user_id) if post_id in existing_posts else None
+            for (_, post_id, _), state in zip(votes, states)]
+
+
+class VoteWriter:
+    def __init__(self, max_batch):
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def submit(self, user_id, post_id, value):
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:  # Started in the worker process, after any fork
+                    self.thread = threading.Thread(target=self._run, name='vote-writer', daemon=True)
+                    self.thread.start()
+        future = Future()
+        self.queue.put(((user_id, post_id, value), future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:  # Everything that arrived while the last batch was written
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # Votes whose request gave up waiting were cancelled and are dropped; the rest can no longer be
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                with app.app_context():
+                    self._write(batch)
+            except Exception as e:  # The thread must survive: nothing restarts it, and every later vote would wait
+                app.logger.error(f"Vote writer failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _write(self, batch):
+        try:
+            results = apply_votes([vote for vote, _ in batch])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            else:  # One bad vote must not fail the others
+                for item in batch:
+                    self._write([item])
+            return
+        metrics_observe('anonn_vote_batch_size', len(batch), buckets=VOTE_BATCH_BUCKETS)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+vote_writer = VoteWriter(app.config['VOTE_BATCH_MAX'])
+
+
+class VoteNotWritten(Exception):
+    pass
+
+
+def submit_vote(user_id, post_id, value):
+    if app.config['VOTE_BATCHING']:
+        future = vote_writer.submit(user_id, post_id, value)
+        try:
+            return future.result(timeout=app.config['VOTE_WRITE_TIMEOUT'])
+        except FutureTimeoutError:
+            if future.cancel():  # Still queued: it will never be written, so the client can simply retry
+                raise VoteNotWritten()
+            return future.result()  # Already being written; answer with what was stored
+    result = apply_votes([(user_id, post_id, value)])[0]
+    db.session.commit()
+    return result
 
 
 @app.route('/vote/<int:post_id>/<string:vote_type_str>', methods=['POST'])
@@ -2219,42 +2879,53 @@ def vote(post_id, vote_type_str):
         {'success': False, 'message': 'Неверный запрос.'}), 400
     if not current_user.is_active: return jsonify(
         {'success': False, 'message': 'Вы забанены и не можете голосовать.'}), 403
-    post = Post.query.get_or_404(post_id)
     vote_value = 1 if vote_type_str == 'like' else -1 if vote_type_str == 'dislike' else 0
     if vote_value == 0: return jsonify({'success': False, 'message': 'Неверный тип голоса.'}), 400
 
-    existing_vote = Vote.query.filter_by(user_id=current_user.id, post_id=post_id).first()
-    new_vote_status = None;
-    standard_vote_message = ''
-    if existing_vote:
-        if existing_vote.vote_type == vote_value:
-            db.session.delete(existing_vote);
-            standard_vote_message = 'Голос убран.'
-        else:
-            existing_vote.vote_type = vote_value;
-            existing_vote.date = datetime.utcnow();
-            standard_vote_message = 'Голос изменен.';
-            new_vote_status = vote_value
-    else:
-        new_vote = Vote(user_id=current_user.id, post_id=post_id, vote_type=vote_value);
-        db.session.add(new_vote);
-        standard_vote_message = 'Голос засчитан.';
-        new_vote_status = vote_value
     try:
-        db.session.commit()
-        check_and_award_achievements(current_user, event_type='new_vote')
-        if post.author: check_and_award_achievements(post.author, event_type='vote_on_my_post',
-                                                     event_context={'post_id': post.id, 'post_user_id': post.user_id,
-                                                                    'post_author_id': post.author.id})
-        ajax_flash_messages = [{'message': msg_text, 'category': cat} for cat, msg_text in
-                               get_flashed_messages(with_categories=True)]
-        return jsonify(
-            {'success': True, 'message': standard_vote_message, 'new_score': post.score, 'user_vote': new_vote_status,
-             'flash_messages': ajax_flash_messages})
+        result = submit_vote(current_user.id, post_id, vote_value)
+    except VoteNotWritten:
+        return jsonify({'success': False, 'message': 'Сервер перегружен, голос не записан. Попробуйте ещё раз.'}), 503
     except Exception as e:
         db.session.rollback();
         app.logger.error(f"Error voting: {e}");
         return jsonify({'success': False, 'message': 'Ошибка БД при голосовании.'}), 500
+    if result is None:
+        abort(404)
+    old_vote_status, new_vote_status, new_score, post_user_id = result
+    if new_vote_status is None:
+        standard_vote_message = 'Голос убран.'
+    elif old_vote_status is not None:
+        standard_vote_message = 'Голос изменен.'
+    else:
+        standard_vote_message = 'Голос засчитан.'
+
+    # Taking a vote back cannot reach a vote count threshold, and only a score that went up can reach a
+    # score threshold (a like, or a dislike taken back or switched to a like)
+    if new_vote_status is not None:
+        check_and_award_achievements(current_user, event_type='new_vote')
+    if (new_vote_status or 0) > (old_vote_status or 0):
+        post_author = User.query.get(post_user_id)
+        if post_author: check_and_award_achievements(post_author, event_type='vote_on_my_post',
+                                                     event_context={'post_id': post_id, 'post_user_id': post_user_id,
+                                                                    'post_author_id': post_author.id})
+    ajax_flash_messages = [{'message': msg_text, 'category': cat} for cat, msg_text in
+                           get_flashed_messages(with_categories=True)]
+    return jsonify(
+        {'success': True, 'message': standard_vote_message, 'new_score': new_score, 'user_vote': new_vote_status,
+         'flash_messages': ajax_flash_messages})
+
+
+def post_activity_update(post_ids=None):
+    # Recounts reply_count and last_activity_at from the reply table
+    table, replies = Post.__table__, Reply.__table__
+    statement = table.update().values(
+        reply_count=select(func.count()).where(replies.c.post_id == table.c.id).scalar_subquery(),
+        last_activity_at=func.coalesce(select(func.max(replies.c.date)).where(
+            replies.c.post_id == table.c.id).scalar_subquery(), table.c.date))
+    if post_ids is not None:
+        statement = statement.where(table.c.id.in_(post_ids))
+    return statement
 
 
 @app.route('/reply/<int:post_id>', methods=['POST'])
@@ -2265,7 +2936,13 @@ def reply(post_id):
     post = Post.query.get_or_404(post_id)
     content = request.form.get('content')
     if content and content.strip():
-        db.session.add(Reply(content=content, post_id=post_id, author=current_user));
+        now = datetime.utcnow()
+        db.session.add(Reply(content=content, post_id=post_id, author=current_user, date=now));
+        db.session.execute(Post.__table__.update().where(Post.id == post_id).values(
+            reply_count=Post.__table__.c.reply_count + 1, last_activity_at=now))
+        refresh_hot_ranks([post_id])
+        update_user_stats({current_user.id: {'reply_count': 1}}, [current_user.id])
+        bump_data_versions('feed')
         db.session.commit();
         flash('Ответ добавлен!', 'success')
     else:
@@ -2281,13 +2958,14 @@ def delete_post(post_id):
         url_for('index'))
     tag_ids_to_check = [tag.id for tag in post.tags];
     author_of_deleted_post = post.author
+    subtract_post_stats([post.id])
     db.session.delete(post);
-    db.session.commit()
+    db.session.flush()
     if tag_ids_to_check:
-        for tag_id in tag_ids_to_check:
-            tag = Tag.query.get(tag_id)
-            if tag and not tag.posts.count(): db.session.delete(tag)
-        db.session.commit()
+        db.session.execute(tag_count_update(tag_ids_to_check))
+        db.session.execute(Tag.__table__.delete().where(Tag.id.in_(tag_ids_to_check), Tag.post_count == 0))
+    bump_data_versions('feed')
+    db.session.commit()
     if author_of_deleted_post:
         check_and_award_achievements(author_of_deleted_post, event_type='post_deleted_recheck_posts_made')
         check_and_award_achievements(author_of_deleted_post, event_type='post_deleted_recheck_total_upvotes')
@@ -2302,7 +2980,17 @@ def delete_reply(reply_id):
     post_id = reply.post_id
     if not (current_user.is_admin or reply.user_id == current_user.id): flash('Нет прав.', 'error'); return redirect(
         url_for('index', _anchor=f'post-{post_id}'))
+    reply_author_id = reply.user_id
     db.session.delete(reply);
+    db.session.flush()
+    posts = Post.__table__
+    db.session.execute(posts.update().where(posts.c.id == post_id).values(
+        reply_count=posts.c.reply_count - 1,
+        last_activity_at=func.coalesce(select(func.max(Reply.date)).where(Reply.post_id == post_id).scalar_subquery(),
+                                       posts.c.date)))
+    refresh_hot_ranks([post_id])
+    update_user_stats({reply_author_id: {'reply_count': -1}})
+    bump_data_versions('feed')
     db.session.commit();
     flash('Ответ удален!', 'success')
     return redirect(url_for('index', _anchor=f'post-{post_id}'))
@@ -2318,11 +3006,10 @@ def ban_user(user_id):
     if user_to_ban.is_admin: flash('Нельзя забанить админа.', 'error'); return redirect(
         request.referrer or url_for('user_profile', username=user_to_ban.username))
     user_to_ban.is_banned = True;
+    Report.query.filter_by(reported_user_id=user_id, is_resolved=False).update({'is_resolved': True}) # Mark unresolved reports as resolved
+    bump_data_versions('feed', f'profile:{user_to_ban.id}')
     db.session.commit();
     flash(f'Пользователь "{escape_html(user_to_ban.username)}" забанен.', 'success')
-    # Consider adding action_taken status to relevant reports
-    Report.query.filter_by(reported_user_id=user_id, is_resolved=False).update({'is_resolved': True}) # Mark unresolved reports as resolved
-    db.session.commit()
     return redirect(url_for('user_profile', username=user_to_ban.username))
 
 
@@ -2332,6 +3019,7 @@ def unban_user(user_id):
     if not current_user.is_admin: flash('Нет прав.', 'error'); return redirect(request.referrer or url_for('index'))
     user_to_unban = User.query.get_or_404(user_id)
     user_to_unban.is_banned = False;
+    bump_data_versions('feed', f'profile:{user_to_unban.id}')
     db.session.commit();
     flash(f'Пользователь "{escape_html(user_to_unban.username)}" разбанен.', 'success')
     return redirect(url_for('user_profile', username=user_to_unban.username))
@@ -2340,6 +3028,7 @@ def unban_user(user_id):
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated: return redirect(url_for('index'))
+    status, headers = 200, {}
     if request.method == 'POST':
         username = request.form.get('username');
         password = request.form.get('password');
@@ -2359,26 +3048,52 @@ def register():
             error = True
         if not error:
             new_user = User(username=username, about_me="");  # Initialize about_me
-            new_user.set_password(password)
-            if User.query.count() == 0: new_user.is_admin = True; flash('Первый пользователь - админ.', 'info')
-            db.session.add(new_user);
-            db.session.commit();
-            flash('Регистрация успешна! Войдите.', 'success');
-            return redirect(url_for('login'))
+            try:
+                new_user.set_password(password)
+            except PasswordHashingOverloaded:
+                flash('Сервер перегружен. Попробуйте зарегистрироваться через несколько секунд.', 'error')
+                status, headers = 503, {'Retry-After': '5'}
+            else:
+                if User.query.count() == 0: new_user.is_admin = True; flash('Первый пользователь - админ.', 'info')
+                db.session.add(new_user);
+                db.session.commit();
+                flash('Регистрация успешна! Войдите.', 'success');
+                return redirect(url_for('login'))
     page_content = f'''<h2>Регистрация</h2><form method="POST" action="{url_for('register')}"><div class="form-group"><label for="username">Имя:</label><input type="text" id="username" name="username" required value="{html.escape(request.form.get('username', ''))}"></div><div class="form-group"><label for="password">Пароль:</label><input type="password" id="password" name="password" required></div><div class="form-group"><label for="password_confirm">Подтвердите:</label><input type="password" id="password_confirm" name="password_confirm" required></div><button type="submit">Регистрация</button></form><p style="text-align: center;">Есть аккаунт? <a href="{url_for('login')}">Войти</a></p>'''
-    return render_template_string(BASE_HTML_TEMPLATE, content=page_content, all_tags=Tag.query.order_by(Tag.name).all())
+    return render_template_string(BASE_HTML_TEMPLATE, content=page_content,
+                                  all_tags=Tag.query.order_by(Tag.name).all()), status, headers
 
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated: return redirect(url_for('index'))
+    status, headers = 200, {}
     if request.method == 'POST':
         username = request.form.get('username');
         password = request.form.get('password');
         remember = request.form.get('remember') == 'on'
         user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password):
+        retry_after = login_failure_retry_after(username)
+        password_ok = False
+        if retry_after:
+            seconds = max(1, math.ceil(retry_after))
+            flash(f'Слишком много неудачных попыток входа. Повторите через {seconds} с.', 'error')
+            status, headers = 429, {'Retry-After': str(seconds)}
+        elif user:
+            try:
+                password_ok = user.check_password(password)
+            except PasswordHashingOverloaded:
+                flash('Сервер перегружен. Попробуйте войти через несколько секунд.', 'error')
+                status, headers = 503, {'Retry-After': '5'}
+        if password_ok:
             if not user.is_active: flash('Аккаунт забанен.', 'error'); return redirect(url_for('login'))
+            if user.password_needs_rehash:
+                # Hash parameters changed since this password was stored; upgrade it transparently
+                try:
+                    user.set_password(password)
+                    db.session.commit()
+                except PasswordHashingOverloaded:
+                    pass  # Try again on the next login
             login_user(user, remember=remember);
             flash('Вход выполнен!', 'success')
             next_page = request.args.get('next')
@@ -2387,14 +3102,16 @@ def login():
                     '//') and 'login' not in next_page and 'register' not in next_page:
                 return redirect(next_page)
             return redirect(url_for('index'))
-        else:
+        elif status == 200:
+            login_failure_retry_after(username, cost=1)
             flash('Неверное имя или пароль.', 'error')
     next_param_val = request.args.get('next')
     next_param = f"?next={next_param_val}" if next_param_val and next_param_val.startswith(
         '/') and not next_param_val.startswith('//') else ''
 
     page_content = f'''<h2>Вход</h2><form method="POST" action="{url_for('login')}{next_param}"><div class="form-group"><label for="username">Имя:</label><input type="text" id="username" name="username" required value="{html.escape(request.form.get('username', ''))}"></div><div class="form-group"><label for="password">Пароль:</label><input type="password" id="password" name="password" required></div><div class="form-group" style="display: flex; align-items: center;"><input type="checkbox" id="remember" name="remember" style="width: auto; margin-right: 8px;"><label for="remember" class="checkbox-label" style="margin-bottom: 0;">Запомнить</label></div><button type="submit">Войти</button></form><p style="text-align: center;">Нет аккаунта? <a href="{url_for('register')}">Регистрация</a></p>'''
-    return render_template_string(BASE_HTML_TEMPLATE, content=page_content, all_tags=Tag.query.order_by(Tag.name).all())
+    return render_template_string(BASE_HTML_TEMPLATE, content=page_content,
+                                  all_tags=Tag.query.order_by(Tag.name).all()), status, headers
 
 
 @app.route('/logout')
@@ -2435,13 +3152,1443 @@ def seed_achievements():
         db.session.rollback();
         app.logger.error(f"Error seeding achievements: {e}")
 
+# --- Bulk Moderation ---
+# Set-based SQL in batches of MODERATION_BATCH_SIZE rows, one short transaction per batch. Nothing is loaded
+# into the session and achievements are not re-checked, so a purge of thousands of rows never holds the
+# write lock for long.
+def _moderation_batches(id_column, condition):
+    batch_size = app.config['MODERATION_BATCH_SIZE']
+    while True:
+        ids = [row_id for (row_id,) in db.session.execute(
+            select(id_column).where(condition).order_by(id_column).limit(batch_size))]
+        if not ids:
+            return
+        yield ids
+        time.sleep(app.config['MODERATION_BATCH_PAUSE'])
+
+
+def delete_rows_in_batches(table, condition, *version_names):
+    deleted = 0
+    for ids in _moderation_batches(table.c.id, condition):
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        bump_data_versions(*version_names)
+        db.session.commit()
+        deleted += len(ids)
+    return deleted
+
+
+def delete_posts_in_batches(condition):
+    deleted = 0
+    for ids in _moderation_batches(Post.id, condition):
+        tag_ids = tags_of_posts(ids)
+        subtract_post_stats(ids)
+        db.session.execute(Post.__table__.delete().where(Post.id.in_(ids)))  # Replies, votes, tag links cascade
+        if tag_ids:
+            db.session.execute(tag_count_update(tag_ids))
+        bump_data_versions('feed')
+        db.session.commit()
+        deleted += len(ids)
+    if deleted:
+        delete_orphan_tags()
+    return deleted
+
+
+def delete_orphan_tags():
+    db.session.execute(Tag.__table__.delete().where(Tag.post_count == 0))
+    db.session.commit()
+
+
+def ban_users(user_ids):
+    # Admins and users who are already banned are skipped; returns the ids that were banned
+    banned = []
+    user_ids = sorted(set(user_ids))
+    batch_size = app.config['MODERATION_BATCH_SIZE']
+    for start in range(0, len(user_ids), batch_size):
+        ids = [uid for (uid,) in db.session.execute(select(User.id).where(
+            User.id.in_(user_ids[start:start + batch_size]), func.coalesce(User.is_admin, False) == False,
+            func.coalesce(User.is_banned, False) == False))]
+        if not ids:
+            continue
+        db.session.execute(User.__table__.update().where(User.id.in_(ids)).values(is_banned=True))
+        db.session.execute(Report.__table__.update().where(Report.reported_user_id.in_(ids),
+                                                          Report.is_resolved == False).values(is_resolved=True))
+        bump_data_versions('feed', *[f'profile:{uid}' for uid in ids])
+        db.session.commit()
+        banned.extend(ids)
+        time.sleep(app.config['MODERATION_BATCH_PAUSE'])
+    return banned
+
+
+def purge_user_content(user_id):
+    # Removes everything the user wrote or received; the account, reports and achievements stay
+    # Their votes counted towards these users' karma; recounted at the end
+    recount_user_ids = ({user_id}
+                        | set(db.session.execute(select(Post.user_id).join(Vote, Vote.post_id == Post.id).where(
+                            Vote.user_id == user_id)).scalars())
+                        | set(db.session.execute(select(ArchivedPost.user_id).join(
+                            ArchivedVote, ArchivedVote.post_id == ArchivedPost.id).where(
+                            ArchivedVote.user_id == user_id)).scalars()))
+    counts = {'posts': delete_posts_in_batches(Post.user_id == user_id)}
+    counts['replies'] = 0
+    for ids in _moderation_batches(Reply.id, Reply.user_id == user_id):
+        post_ids = set(db.session.execute(select(Reply.post_id).where(Reply.id.in_(ids))).scalars())
+        db.session.execute(Reply.__table__.delete().where(Reply.id.in_(ids)))
+        db.session.execute(post_activity_update(post_ids))
+        refresh_hot_ranks(post_ids)
+        bump_data_versions('feed')
+        db.session.commit()
+        counts['replies'] += len(ids)
+    counts['votes'] = 0
+    for ids in _moderation_batches(Vote.id, Vote.user_id == user_id):
+        post_ids = set(db.session.execute(select(Vote.post_id).where(Vote.id.in_(ids))).scalars())
+        db.session.execute(Vote.__table__.delete().where(Vote.id.in_(ids)))
+        db.session.execute(vote_score_update(post_ids))
+        refresh_hot_ranks(post_ids)
+        bump_data_versions('feed')
+        db.session.commit()
+        counts['votes'] += len(ids)
+    counts['archived_posts'] = 0
+    for ids in _moderation_batches(ArchivedPost.id, ArchivedPost.user_id == user_id):
+        subtract_post_stats(ids, archived=True)
+        db.session.execute(ArchivedPost.__table__.delete().where(ArchivedPost.id.in_(ids)))
+        bump_data_versions('feed')
+        db.session.commit()
+        counts['archived_posts'] += len(ids)
+    counts['archived_replies'] = delete_rows_in_batches(ArchivedReply.__table__, ArchivedReply.user_id == user_id,
+                                                        'feed')
+    counts['archived_votes'] = delete_rows_in_batches(ArchivedVote.__table__, ArchivedVote.user_id == user_id,
+                                                      'feed')
+    partner_ids = [low if high == user_id else high for low, high in db.session.execute(
+        select(Conversation.user_low_id, Conversation.user_high_id).where(
+            or_(Conversation.user_low_id == user_id, Conversation.user_high_id == user_id)))]
+    dm_versions = [f'dm:{uid}' for uid in [user_id] + partner_ids]
+    counts['direct_messages'] = (
+        delete_rows_in_batches(DirectMessage.__table__, DirectMessage.sender_id == user_id, *dm_versions)
+        + delete_rows_in_batches(DirectMessage.__table__, DirectMessage.receiver_id == user_id, *dm_versions)
+        + delete_rows_in_batches(ArchivedDirectMessage.__table__, ArchivedDirectMessage.sender_id == user_id,
+                                 *dm_versions)
+        + delete_rows_in_batches(ArchivedDirectMessage.__table__, ArchivedDirectMessage.receiver_id == user_id,
+                                 *dm_versions))
+    db.session.execute(Conversation.__table__.delete().where(
+        or_(Conversation.user_low_id == user_id, Conversation.user_high_id == user_id)))
+    recount_user_stats(recount_user_ids)
+    bump_data_versions(f'profile:{user_id}', *dm_versions)
+    db.session.commit()
+    return counts
+
+
+def post_range_condition(min_id=None, max_id=None, after=None, before=None):
+    conditions = []
+    if min_id is not None:
+        conditions.append(Post.id >= min_id)
+    if max_id is not None:
+        conditions.append(Post.id <= max_id)
+    if after is not None:
+        conditions.append(Post.date >= after)
+    if before is not None:
+        conditions.append(Post.date < before)
+    return and_(*conditions) if conditions else None
+
+
+def _admin_json_guard():
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Нет прав.'}), 403
+    return None
+
+
+@app.route('/admin/bulk/ban', methods=['POST'])
+@login_required
+def admin_bulk_ban():
+    denied = _admin_json_guard()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    try:
+        user_ids = [int(uid) for uid in data.get('user_ids', [])]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Неверный список пользователей.'}), 400
+    banned = ban_users(user_ids)
+    return jsonify({'success': True, 'banned': len(banned), 'banned_ids': banned})
+
+
+@app.route('/admin/bulk/purge_user/<int:user_id>', methods=['POST'])
+@login_required
+def admin_bulk_purge_user(user_id):
+    denied = _admin_json_guard()
+    if denied:
+        return denied
+    user = User.query.get_or_404(user_id)
+    if user.is_admin:
+        return jsonify({'success': False, 'message': 'Нельзя удалить содержимое админа.'}), 400
+    return jsonify({'success': True, 'deleted': purge_user_content(user.id)})
+
+
+@app.route('/admin/bulk/delete_posts', methods=['POST'])
+@login_required
+def admin_bulk_delete_posts():
+    denied = _admin_json_guard()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    try:
+        condition = post_range_condition(
+            min_id=int(data['min_id']) if data.get('min_id') is not None else None,
+            max_id=int(data['max_id']) if data.get('max_id') is not None else None,
+            after=datetime.fromisoformat(data['after']) if data.get('after') else None,
+            before=datetime.fromisoformat(data['before']) if data.get('before') else None)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Неверные параметры.'}), 400
+    if condition is None:
+        return jsonify({'success': False, 'message': 'Укажите диапазон id или дат.'}), 400
+    return jsonify({'success': True, 'deleted': delete_posts_in_batches(condition)})
+
+
+@app.cli.command('ban-users')
+@click.argument('user_ids', nargs=-1, type=int, required=True)
+def ban_users_command(user_ids):
+    """Забанить пользователей по id"""
+    banned = ban_users(user_ids)
+    click.echo(f'Banned {len(banned)} of {len(set(user_ids))} users.')
+
+
+@app.cli.command('purge-user')
+@click.argument('username')
+@click.option('--yes', is_flag=True, help='Не спрашивать подтверждение.')
+def purge_user_command(username, yes):
+    """Удалить все посты, ответы, голоса и сообщения пользователя"""
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f'User {username} not found.')
+    if user.is_admin:
+        raise click.ClickException('Refusing to purge an admin.')
+    if not yes:
+        click.confirm(f'Delete everything written by or sent to {username}?', abort=True)
+    for name, count in purge_user_content(user.id).items():
+        click.echo(f'{name}: {count}')
+
+
+@app.cli.command('delete-posts')
+@click.option('--min-id', type=int, default=None)
+@click.option('--max-id', type=int, default=None)
+@click.option('--after', type=click.DateTime(), default=None, help='Posts created at or after this UTC time.')
+@click.option('--before', type=click.DateTime(), default=None, help='Posts created before this UTC time.')
+@click.option('--yes', is_flag=True, help='Не спрашивать подтверждение.')
+def delete_posts_command(min_id, max_id, after, before, yes):
+    """Удалить посты по диапазону id и/или дат вместе с ответами и голосами"""
+    condition = post_range_condition(min_id, max_id, after, before)
+    if condition is None:
+        raise click.UsageError('Give at least one of --min-id, --max-id, --after, --before.')
+    matching = db.session.query(func.count(Post.id)).filter(condition).scalar()
+    if not yes:
+        click.confirm(f'Delete {matching} posts?', abort=True)
+    click.echo(f'Deleted {delete_posts_in_batches(condition)} posts.')
+
+
+# --- Scheduled Jobs ---
+# Functions registered with @scheduled_job(name, interval config key) run every that many seconds on one
+# background thread per worker, started by the first request so CLI commands and pre-fork servers get none.
+# Each run holds <SCHEDULER_LOCK_DIR>/anonn-<name>.lock, so with several workers only one of them runs it.
+SCHEDULED_JOBS = []  # (name, interval config key, func)
+_scheduler_thread = None
+_scheduler_start_lock = threading.Lock()
+
+
+def scheduled_job(name, interval_key):
+    def register(func):
+        SCHEDULED_JOBS.append((name, interval_key, func))
+        return func
+    return register
+
+
+def run_job_locked(name, func):
+    # Returns None without running func when another worker holds the job's lock
+    with open(os.path.join(app.config['SCHEDULER_LOCK_DIR'], f'anonn-{name}.lock'), 'a') as lock_file:
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+        return func()
+
+
+def _scheduler_loop():
+    jobs = {name: (app.config[key], func) for name, key, func in SCHEDULED_JOBS if app.config[key]}
+    next_run = {name: time.monotonic() + interval for name, (interval, _) in jobs.items()}
+    while True:
+        name = min(next_run, key=next_run.get)
+        time.sleep(max(0.0, next_run[name] - time.monotonic()))
+        interval, func = jobs[name]
+        with app.app_context():
+            try:
+                result = run_job_locked(name, func)
+                if result:
+                    app.logger.info(f"Scheduled job {name}: {result}")
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Scheduled job {name} failed: {e}")
+        next_run[name] = time.monotonic() + interval
+
+
+@app.before_request
+def start_scheduler():
+    global _scheduler_thread
+    if _scheduler_thread is not None or not any(app.config[key] for _, key, _ in SCHEDULED_JOBS):
+        return None
+    with _scheduler_start_lock:
+        if _scheduler_thread is None:
+            _scheduler_thread = threading.Thread(target=_scheduler_loop, name='scheduler', daemon=True)
+            _scheduler_thread.start()
+    return None
+
+
+# --- Hot Ranking ---
+# hot_score = log10(vote score + HOT_REPLY_WEIGHT * replies, sign kept) + post age in units of HOT_DECAY_SECONDS
+# since a fixed epoch: a post needs ten times the points to keep up with one HOT_DECAY_SECONDS newer. Decay is
+# relative to the epoch, so scores never go stale with time and only change with votes and replies; those write
+# paths refresh the post's row in their own transaction. Pinned posts rank above everything else, by date.
+HOT_EPOCH = datetime(2024, 1, 1)
+HOT_PINNED_BASE = 1e6  # Far above any reachable hot_score
+
+
+def hot_score(date, vote_score, reply_count, pinned):
+    age_term = ((date or HOT_EPOCH) - HOT_EPOCH).total_seconds() / app.config['HOT_DECAY_SECONDS']
+    if pinned:
+        return HOT_PINNED_BASE + age_term
+    points = (vote_score or 0) + app.config['HOT_REPLY_WEIGHT'] * reply_count
+    return math.copysign(math.log10(max(abs(points), 1)), points) + age_term
+
+
+def refresh_hot_ranks(post_ids=None):
+    # Rewrites the post_rank rows of the given posts, or of every post when None, in the caller's transaction
+    table = PostRank.__table__
+    posts = select(Post.id, Post.date, Post.vote_score, Post.pinned, Post.reply_count)
+    delete = table.delete()
+    if post_ids is not None:
+        post_ids = list(post_ids)
+        posts = posts.where(Post.id.in_(post_ids))
+        delete = delete.where(table.c.post_id.in_(post_ids))
+    db.session.execute(delete)
+    rows = [{'post_id': post_id, 'hot_score': hot_score(date, vote_score, replies, pinned)}
+            for post_id, date, vote_score, pinned, replies in db.session.execute(posts)]
+    for start in range(0, len(rows), 1000):
+        db.session.execute(table.insert(), rows[start:start + 1000])
+    return len(rows)
+
+
+@scheduled_job('hot-ranks', 'HOT_RANK_INTERVAL')
+def scheduled_hot_rank_rebuild():
+    ranked = refresh_hot_ranks()
+    db.session.commit()
+    return f'{ranked} posts ranked'
+
+
+@app.cli.command('rebuild-hot-ranks')
+def rebuild_hot_ranks_command():
+    """Пересчитать таблицу post_rank для сортировки «Горячее»"""
+    ranked = refresh_hot_ranks()
+    bump_data_versions('feed')
+    db.session.commit()
+    click.echo(f'Ranked {ranked} posts.')
+
+
+# --- User Stats ---
+# One user_stats row per user with the counters the profile shows. Posting, replying and voting add their deltas
+# with an upsert in the same transaction. Deleting posts takes other users' replies and votes with them, so it
+# subtracts per-user counts with one set-based UPDATE per counter and bumps the global 'user-stats' version
+# instead of every profile involved. Archived rows keep counting, so archiving leaves the stats as they were.
+USER_STATS_COUNTERS = ('post_count', 'reply_count', 'votes_cast', 'karma')
+
+
+def update_user_stats(deltas, active_user_ids=(), now=None):
+    # deltas: {user_id: {counter: change}}; users in active_user_ids also get last_active_at = now
+    table = UserStats.__table__
+    insert = VOTE_UPSERT_INSERTS.get(db.engine.dialect.name)
+    now = now or datetime.utcnow()
+    changed = []
+    for user_id in sorted(set(deltas) | set(active_user_ids)):  # One lock order for concurrent writers
+        values = {name: change for name, change in deltas.get(user_id, {}).items() if change}
+        updates = {name: table.c[name] + change for name, change in values.items()}
+        if user_id in active_user_ids:
+            values['last_active_at'] = updates['last_active_at'] = now
+        if not values:
+            continue
+        changed.append(user_id)
+        if insert is None:
+            if not db.session.execute(table.update().where(table.c.user_id == user_id).values(updates)).rowcount:
+                db.session.execute(table.insert().values(user_id=user_id, **values))
+            continue
+        db.session.execute(insert(table).values(user_id=user_id, **values).on_conflict_do_update(
+            index_elements=[table.c.user_id], set_=updates))
+    if changed:
+        bump_data_versions(*[f'profile:{user_id}' for user_id in changed])
+
+
+def subtract_post_stats(post_ids, archived=False):
+    # Call before deleting the posts: takes them, their replies and their votes off everyone's counters
+    posts, replies, votes = ((ArchivedPost.__table__, ArchivedReply.__table__, ArchivedVote.__table__) if archived
+                             else (Post.__table__, Reply.__table__, Vote.__table__))
+    table = UserStats.__table__
+    for counter, rows, post_key in (('post_count', posts, posts.c.id), ('reply_count', replies, replies.c.post_id),
+                                    ('votes_cast', votes, votes.c.post_id)):
+        count = select(func.count()).where(rows.c.user_id == table.c.user_id, post_key.in_(post_ids))
+        db.session.execute(table.update().where(table.c.user_id.in_(select(rows.c.user_id).where(
+            post_key.in_(post_ids)))).values({counter: table.c[counter] - count.scalar_subquery()}))
+    karma = select(func.coalesce(func.sum(votes.c.vote_type), 0)).join(posts, posts.c.id == votes.c.post_id).where(
+        posts.c.user_id == table.c.user_id, posts.c.id.in_(post_ids))
+    db.session.execute(table.update().where(table.c.user_id.in_(select(posts.c.user_id).where(
+        posts.c.id.in_(post_ids)))).values(karma=table.c.karma - karma.scalar_subquery()))
+    bump_data_versions('user-stats')
+
+
+def count_user_stats(user_condition):
+    # user_condition(column) limits the users; returns {user_id: {counter: value, 'last_active_at': ...}}
+    stats = defaultdict(lambda: {**dict.fromkeys(USER_STATS_COUNTERS, 0), 'last_active_at': None})
+    for counter, table in (('post_count', Post.__table__), ('post_count', ArchivedPost.__table__),
+                           ('reply_count', Reply.__table__), ('reply_count', ArchivedReply.__table__),
+                           ('votes_cast', Vote.__table__), ('votes_cast', ArchivedVote.__table__)):
+        for user_id, count, last_date in db.session.execute(
+                select(table.c.user_id, func.count(), func.max(table.c.date))
+                .where(user_condition(table.c.user_id)).group_by(table.c.user_id)):
+            row = stats[user_id]
+            row[counter] += count
+            if last_date and (row['last_active_at'] is None or last_date > row['last_active_at']):
+                row['last_active_at'] = last_date
+    for votes, posts in ((Vote.__table__, Post.__table__), (ArchivedVote.__table__, ArchivedPost.__table__)):
+        for user_id, karma in db.session.execute(
+                select(posts.c.user_id, func.sum(votes.c.vote_type)).join(posts, posts.c.id == votes.c.post_id)
+                .where(user_condition(posts.c.user_id)).group_by(posts.c.user_id)):
+            stats[user_id]['karma'] += karma or 0
+    return stats
+
+
+def _replace_user_stats(user_ids, user_condition):
+    stats = count_user_stats(user_condition)
+    table = UserStats.__table__
+    db.session.execute(table.delete().where(user_condition(table.c.user_id)))
+    empty = {**dict.fromkeys(USER_STATS_COUNTERS, 0), 'last_active_at': None}
+    rows = [{'user_id': user_id, **stats.get(user_id, empty)} for user_id in user_ids]
+    if rows:
+        db.session.execute(table.insert(), rows)
+    return len(rows)
+
+
+def recount_user_stats(user_ids):
+    # Runs in the caller's transaction
+    user_ids = sorted(set(user_ids))
+    if user_ids:
+        _replace_user_stats(user_ids, lambda column: column.in_(user_ids))
+        bump_data_versions(*[f'profile:{user_id}' for user_id in user_ids])
+
+
+def rebuild_user_stats(workers=1, batch_size=1000, progress=None):
+    # Recounts every user, batch_size consecutive ids per transaction, on `workers` threads with their own sessions
+    max_id = db.session.execute(select(func.max(User.id))).scalar() or 0
+
+    def rebuild_range(low):
+        high = low + batch_size
+        with app.app_context():
+            user_ids = list(db.session.execute(select(User.id).where(User.id >= low, User.id < high)).scalars())
+            rebuilt = _replace_user_stats(user_ids, lambda column: and_(column >= low, column < high))
+            db.session.commit()
+            return rebuilt
+
+    starts = range(0, max_id + 1, batch_size)
+    rebuilt = 0
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='user-stats') as executor:
+            for count in executor.map(rebuild_range, starts):
+                rebuilt += count
+                if progress:
+                    progress(rebuilt)
+    else:
+        for low in starts:
+            rebuilt += rebuild_range(low)
+            if progress:
+                progress(rebuilt)
+    bump_data_versions('user-stats')
+    db.session.commit()
+    return rebuilt
+
+
+@app.cli.command('rebuild-user-stats')
+@click.option('--workers', type=int, default=4, show_default=True, help='Потоков, пересчитывающих параллельно.')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Пользователей в одной транзакции.')
+def rebuild_user_stats_command(workers, batch_size):
+    """Пересчитать таблицу user_stats (посты, ответы, голоса, карма, последняя активность)"""
+    started = time.perf_counter()
+    rebuilt = rebuild_user_stats(workers, batch_size)
+    elapsed = time.perf_counter() - started
+    click.echo(f'Recounted {rebuilt} users in {elapsed:.1f}s ({rebuilt / elapsed if elapsed else 0:.0f} users/s).')
+
+
+# --- Archive ---
+# Threads whose post and replies are all older than ARCHIVE_POST_AGE_DAYS move, one MODERATION_BATCH_SIZE batch
+# per transaction, to archived_post/_reply/_vote with INSERT ... SELECT; deleting the post then clears the live
+# rows through ON DELETE CASCADE. Read DMs older than ARCHIVE_DM_AGE_DAYS move to archived_direct_message.
+# Pinned posts and unread messages stay live.
+ARCHIVE_TABLES = (('posts', Post.__table__, ArchivedPost.__table__, 'id'),
+                  ('replies', Reply.__table__, ArchivedReply.__table__, 'post_id'),
+                  ('votes', Vote.__table__, ArchivedVote.__table__, 'post_id'))
+
+
+def archivable_posts_condition(cutoff):
+    return and_(Post.date < cutoff, func.coalesce(Post.pinned, False) == False,
+                ~select(Reply.id).where(Reply.post_id == Post.id, Reply.date >= cutoff).exists())
+
+
+def archivable_direct_messages_condition(cutoff):
+    return and_(DirectMessage.timestamp < cutoff, DirectMessage.is_read == True)
+
+
+def _copy_rows(live, archive, key, ids):
+    columns = [column for column in live.columns if column.name in archive.c]  # Not the denormalized counters
+    return db.session.execute(archive.insert().from_select(
+        [column.name for column in columns], select(*columns).where(live.c[key].in_(ids)))).rowcount
+
+
+def archive_posts_in_batches(cutoff):
+    counts = {name: 0 for name, _, _, _ in ARCHIVE_TABLES}
+    for ids in _moderation_batches(Post.id, archivable_posts_condition(cutoff)):
+        for name, live, archive, key in ARCHIVE_TABLES:
+            counts[name] += _copy_rows(live, archive, key, ids)
+        tag_names = defaultdict(list)
+        for post_id, tag_name in db.session.execute(
+                select(post_tags.c.post_id, Tag.name).join(Tag, Tag.id == post_tags.c.tag_id)
+                .where(post_tags.c.post_id.in_(ids)).order_by(Tag.name)):
+            tag_names[post_id].append(tag_name)
+        if tag_names:
+            db.session.execute(ArchivedPost.__table__.update().where(ArchivedPost.id == db.bindparam('archived_id'))
+                               .values(tags=db.bindparam('tag_names')),
+                               [{'archived_id': post_id, 'tag_names': ','.join(names)}
+                                for post_id, names in tag_names.items()])
+        tag_ids = tags_of_posts(ids)
+        db.session.execute(Post.__table__.delete().where(Post.id.in_(ids)))  # Replies, votes, tag links cascade
+        if tag_ids:
+            db.session.execute(tag_count_update(tag_ids))
+        bump_data_versions('feed', 'user-stats')  # Profiles list live posts only
+        db.session.commit()
+    if counts['posts']:
+        delete_orphan_tags()
+    return counts
+
+
+def archive_direct_messages_in_batches(cutoff):
+    # The chat looks the same before and after (history pages read both tables), so no dm:<id> bumps;
+    # conversation.last_message_id goes NULL for an archived last message and the preview stays
+    archived = 0
+    live, archive = DirectMessage.__table__, ArchivedDirectMessage.__table__
+    for ids in _moderation_batches(DirectMessage.id, archivable_direct_messages_condition(cutoff)):
+        archived += _copy_rows(live, archive, 'id', ids)
+        db.session.execute(live.delete().where(live.c.id.in_(ids)))
+        db.session.commit()
+    return archived
+
+
+def archive_old_content(post_cutoff, dm_cutoff):
+    counts = archive_posts_in_batches(post_cutoff)
+    counts['direct_messages'] = archive_direct_messages_in_batches(dm_cutoff)
+    for name, count in counts.items():
+        if count:
+            metrics_inc('anonn_archived_rows_total', {'table': name}, count)
+    return counts
+
+
+def archive_cutoffs(post_days=None, dm_days=None):
+    now = datetime.utcnow()
+    post_days = app.config['ARCHIVE_POST_AGE_DAYS'] if post_days is None else post_days
+    dm_days = app.config['ARCHIVE_DM_AGE_DAYS'] if dm_days is None else dm_days
+    return now - timedelta(days=post_days), now - timedelta(days=dm_days)
+
+
+@scheduled_job('archive', 'ARCHIVE_INTERVAL')
+def scheduled_archive():
+    counts = archive_old_content(*archive_cutoffs())
+    return counts if any(counts.values()) else None
+
+
+def _archive_user_link(users, user_id):
+    user = users.get(user_id)
+    if not user:
+        return 'Аноним'
+    return f'<a href="{url_for('user_profile', username=user.username)}">{escape_html(user.username)}</a>'
+
+
+@app.route('/archive')
+def archive_index():
+    etag = conditional_etag(*get_data_versions('feed'), html_page=True)
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    page_size = app.config['ARCHIVE_PAGE_SIZE']
+    query = ArchivedPost.query
+    before_id = request.args.get('before', type=int)
+    if before_id is not None:
+        query = query.filter(ArchivedPost.id < before_id)
+    posts = query.order_by(ArchivedPost.id.desc()).limit(page_size + 1).all()
+    has_more = len(posts) > page_size
+    posts = posts[:page_size]
+    post_ids = [p.id for p in posts]
+    reply_counts = dict(db.session.query(ArchivedReply.post_id, func.count(ArchivedReply.id)).filter(
+        ArchivedReply.post_id.in_(post_ids)).group_by(ArchivedReply.post_id).all()) if post_ids else {}
+    user_ids = {p.user_id for p in posts}
+    users = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
+
+    archive_html = '<div class="archive-container"><h2>Архив</h2>'
+    if posts:
+        for post in posts:
+            preview = post_preview(post.content)
+            archive_html += f"""
+            <div class="archive-item">
+                <a href="{url_for('archived_post', post_id=post.id)}">{escape_html(preview)}</a>
+                <div class="metadata">
+                    <span class="author">{_archive_user_link(users, post.user_id)}</span>
+                    <span class="time">{post.date.strftime("%Y-%m-%d %H:%M") if post.date else ''}</span>
+                    <span>ответов: {reply_counts.get(post.id, 0)}</span>
+                </div>
+            </div>
+            """
+        if has_more:
+            archive_html += f'<div class="archive-nav"><a href="{url_for('archive_index', before=posts[-1].id)}" class="button">Дальше</a></div>'
+    else:
+        archive_html += '<p>Архив пуст.</p>'
+    archive_html += '</div>'
+    return with_etag(render_template_string(BASE_HTML_TEMPLATE, content=archive_html), etag)
+
+
+@app.route('/archive/post/<int:post_id>')
+def archived_post(post_id):
+    if Post.query.get(post_id):  # Still live
+        return redirect(url_for('index') + f'#post-{post_id}')
+    etag = conditional_etag(*get_data_versions('feed'), html_page=True)
+    not_modified = etag_not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    post = ArchivedPost.query.get_or_404(post_id)
+    replies = ArchivedReply.query.filter_by(post_id=post.id).order_by(ArchivedReply.date.asc()).all()
+    score = db.session.query(func.coalesce(func.sum(ArchivedVote.vote_type), 0)).filter(
+        ArchivedVote.post_id == post.id).scalar()
+    user_ids = {post.user_id} | {r.user_id for r in replies}
+    users = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()}
+
+    score_class = 'score-neutral'
+    if score > 0:
+        score_class = 'score-positive'
+    elif score < 0:
+        score_class = 'score-negative'
+    tags_html = ''
+    if post.tags:
+        tags_html = '<div class="post-tags">Теги: ' + ', '.join(escape_html(name) for name in post.tags.split(',')) + '</div>'
+    edit_indicator_html = ''
+    if post.edit_count:
+        edit_indicator_html = f'<span class="edit-indicator">(изменено {post.edit_count} раз)</span>'
+    replies_html = ''.join(
+        f'''<div class="reply" id="reply-{reply.id}">
+               <div class="reply-content">{escape_html(reply.content)}</div>
+               <div class="metadata">
+                   <div>
+                     <span class="author">{_archive_user_link(users, reply.user_id)}</span>
+                     <span class="time">{reply.date.strftime("%Y-%m-%d %H:%M") if reply.date else ''}</span>
+                   </div>
+               </div>
+           </div>''' for reply in replies)
+
+    post_html = f'''
+        <div class="archive-notice">Тема перенесена в архив: отвечать и голосовать в ней нельзя.</div>
+        <div class="post" id="post-{post.id}">
+            <div class="post-header">
+                 <div>
+                    <span class="author">{_archive_user_link(users, post.user_id)}</span>
+                    <span class="time">{post.date.strftime("%Y-%m-%d %H:%M") if post.date else ''}</span>
+                    {edit_indicator_html}
+                 </div>
+            </div>
+            <div class="post-content">{render_formatted_post_content(post.content)}</div>
+            {tags_html}
+            <div class="vote-section">
+                <span class="post-score {score_class}">{score}</span>
+            </div>
+            {replies_html}
+        </div>
+    '''
+    return with_etag(render_template_string(BASE_HTML_TEMPLATE, content=post_html), etag)
+
+
+@app.cli.command('archive')
+@click.option('--post-days', type=int, default=None, help='Возраст тем в днях (по умолчанию ARCHIVE_POST_AGE_DAYS).')
+@click.option('--dm-days', type=int, default=None, help='Возраст сообщений в днях (по умолчанию ARCHIVE_DM_AGE_DAYS).')
+@click.option('--dry-run', is_flag=True, help='Только посчитать, ничего не переносить.')
+def archive_command(post_days, dm_days, dry_run):
+    """Перенести старые темы и прочитанные сообщения в архивные таблицы"""
+    post_cutoff, dm_cutoff = archive_cutoffs(post_days, dm_days)
+    if dry_run:
+        posts = db.session.query(func.count(Post.id)).filter(archivable_posts_condition(post_cutoff)).scalar()
+        messages = db.session.query(func.count(DirectMessage.id)).filter(
+            archivable_direct_messages_condition(dm_cutoff)).scalar()
+        click.echo(f'posts: {posts}')
+        click.echo(f'direct_messages: {messages}')
+        return
+    for name, count in archive_old_content(post_cutoff, dm_cutoff).items():
+        click.echo(f'{name}: {count}')
+
+
+# --- Export / Import ---
+# NDJSON dump: a header line, then one {"table": ..., "row": {...}} line per row, parent tables first. Export walks
+# each table with yield_per and import inserts in batches, so memory stays flat however big the database is.
+# Conversations and data versions are derived and get rebuilt after an import.
+EXPORT_FORMAT = 'anonn-ndjson'
+EXPORT_VERSION = 1
+EXPORT_TABLES = (User.__table__, Achievement.__table__, Tag.__table__, Post.__table__, post_tags, Reply.__table__,
+                 Vote.__table__, DirectMessage.__table__, Report.__table__, UserAchievement.__table__,
+                 ArchivedPost.__table__, ArchivedReply.__table__, ArchivedVote.__table__,
+                 ArchivedDirectMessage.__table__)
+
+
+@contextlib.contextmanager
+def open_dump(path, mode):
+    # '-' is stdin/stdout, *.gz is gzip-compressed
+    if path == '-':
+        yield click.get_text_stream('stdout' if mode == 'w' else 'stdin', encoding='utf-8')
+    elif path.endswith('.gz'):
+        with gzip.open(path, mode + 't', encoding='utf-8') as f:
+            yield f
+    else:
+        with open(path, mode, encoding='utf-8') as f:
+            yield f
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Cannot export {type(value).__name__}')
+
+
+def export_data(out, chunk_size, progress=None):
+    out.write(json.dumps({'format': EXPORT_FORMAT, 'version': EXPORT_VERSION,
+                          'exported_at': datetime.utcnow().isoformat()}) + '\n')
+    totals = {}
+    for table in EXPORT_TABLES:
+        started = time.perf_counter()
+        count = 0
+        result = db.session.execute(select(table).order_by(*table.primary_key.columns)
+                                    .execution_options(yield_per=chunk_size))
+        for row in result.mappings():
+            out.write(json.dumps({'table': table.name, 'row': dict(row)}, default=_dump_value, ensure_ascii=False,
+                                 separators=(',', ':')) + '\n')
+            count += 1
+        totals[table.name] = count
+        if progress:
+            progress(table.name, count, time.perf_counter() - started)
+    return totals
+
+
+def _non_empty_tables():
+    # Achievements are seeded by init-db; imported ones replace them
+    return [table.name for table in EXPORT_TABLES if table is not Achievement.__table__
+            and db.session.execute(select(literal_column('1')).select_from(table).limit(1)).first()]
+
+
+def _reset_id_sequences():
+    # Rows keep their exported ids, so sequences have to be moved past them and past the archived ids
+    if db.engine.dialect.name == 'sqlite':
+        raise_sqlite_sequences(db.session)  # sqlite_sequence already follows the ids inserted into a table
+        return
+    if db.engine.dialect.name != 'postgresql':
+        return
+    quote = db.engine.dialect.identifier_preparer.quote
+    archives = dict(ARCHIVED_ID_TABLES)
+    for table in EXPORT_TABLES:
+        if 'id' in table.c and table.c.id.autoincrement is not False:
+            top = 'COALESCE(MAX(id), 1)'
+            if table in archives:
+                top = f'GREATEST({top}, (SELECT COALESCE(MAX(id), 1) FROM {quote(archives[table].name)}))'
+            db.session.execute(text(f"SELECT setval(pg_get_serial_sequence(:table, 'id'), {top}) "
+                                    f"FROM {quote(table.name)}"), {'table': quote(table.name)})
+
+
+def import_data(lines, batch_size, progress=None):
+    tables = {table.name: table for table in EXPORT_TABLES}
+    header = json.loads(next(lines, '{}') or '{}')
+    if header.get('format') != EXPORT_FORMAT or header.get('version') != EXPORT_VERSION:
+        raise ValueError('Not an AnonN export (or an unsupported version).')
+
+    totals = {}
+    state = {'table': None, 'rows': [], 'started': time.perf_counter()}
+
+    def flush():
+        if state['rows']:
+            db.session.execute(tables[state['table']].insert(), state['rows'])
+            db.session.commit()
+            totals[state['table']] = totals.get(state['table'], 0) + len(state['rows'])
+            state['rows'] = []
+
+    def finish_table():
+        flush()
+        if state['table'] and progress:
+            progress(state['table'], totals.get(state['table'], 0), time.perf_counter() - state['started'])
+
+    converters = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        table_name, row = record['table'], record['row']
+        if table_name != state['table']:
+            if table_name not in tables:
+                raise ValueError(f'Unknown table {table_name}.')
+            finish_table()
+            if table_name == Achievement.__table__.name:
+                db.session.execute(Achievement.__table__.delete())
+            state.update(table=table_name, started=time.perf_counter())
+            converters = [column.name for column in tables[table_name].columns
+                          if isinstance(column.type, db.DateTime)]
+        for name in converters:
+            if row.get(name) is not None:
+                row[name] = datetime.fromisoformat(row[name])
+        state['rows'].append(row)
+        if len(state['rows']) >= batch_size:
+            flush()
+    finish_table()
+
+    _reset_id_sequences()
+    db.session.execute(vote_score_update())  # Dumps from before post.vote_score existed
+    db.session.execute(tag_count_update())
+    db.session.execute(post_activity_update())
+    refresh_hot_ranks()
+    db.session.commit()
+    rebuild_user_stats()
+    rebuild_conversations()
+    bump_data_versions('feed')
+    db.session.commit()
+    return totals
+
+
+def _report_table_progress(table_name, count, seconds):
+    click.echo(f'{table_name}: {count} rows in {seconds:.1f}s ({count / seconds if seconds else 0:.0f} rows/s)',
+               err=True)
+
+
+@app.cli.command('export')
+@click.argument('path', default='-')
+@click.option('--chunk-size', type=int, default=1000, show_default=True, help='Строк за один fetch из базы.')
+def export_command(path, chunk_size):
+    """Выгрузить все данные форума в NDJSON (PATH или stdout, .gz сжимается)"""
+    started = time.perf_counter()
+    with open_dump(path, 'w') as out:
+        totals = export_data(out, chunk_size, progress=_report_table_progress)
+    elapsed = time.perf_counter() - started
+    click.echo(f'Exported {sum(totals.values())} rows in {elapsed:.1f}s.', err=True)
+
+
+@app.cli.command('import')
+@click.argument('path', default='-')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Строк в одном INSERT.')
+def import_command(path, batch_size):
+    """Загрузить выгрузку `flask export` в пустую базу"""
+    db.create_all()  # A brand-new database has no schema yet; existing tables are left as they are
+    add_missing_columns()
+    non_empty = _non_empty_tables()
+    if non_empty:
+        raise click.ClickException(f'Database is not empty ({", ".join(non_empty)}); import needs a fresh one.')
+    started = time.perf_counter()
+    with open_dump(path, 'r') as f:
+        try:
+            totals = import_data(iter(f), batch_size, progress=_report_table_progress)
+        except ValueError as e:
+            db.session.rollback()
+            raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - started
+    rows = sum(totals.values())
+    click.echo(f'Imported {rows} rows in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s).')
+
+
+# --- Backups ---
+# sqlite3's online backup API copies the live database page by page while the app keeps running. Between steps
+# the source is unlocked and the copy sleeps BACKUP_STEP_SLEEP. A write from another connection makes SQLite
+# restart the copy, so after BACKUP_MAX_RESTARTS restarts the rest is taken in a single step.
+BACKUP_DURATION_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+class BackupRestarted(Exception):
+    pass
+
+
+def sqlite_database_path():
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.database
+
+
+def verify_backup(path):
+    # PRAGMA integrity_check on a read-only connection; returns the problems found, empty when the file is sound
+    try:
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            return [row[0] for row in connection.execute('PRAGMA integrity_check') if row[0] != 'ok']
+        finally:
+            connection.close()
+    except sqlite3.DatabaseError as e:
+        return [str(e)]
+
+
+def rotate_backups(directory, prefix, keep):
+    if keep <= 0:
+        return []
+    backups = sorted(name for name in os.listdir(directory) if name.startswith(prefix) and name.endswith('.db'))
+    removed = backups[:-keep]
+    for name in removed:
+        os.remove(os.path.join(directory, name))
+    return removed
+
+
+def _copy_database(source_path, target_path):
+    # Returns (steps, restarts)
+    stats = {'steps': 0, 'restarts': 0, 'remaining': None}
+
+    def after_step(status, remaining, total):
+        stats['steps'] += 1
+        if stats['remaining'] is not None and remaining > stats['remaining']:
+            stats['restarts'] += 1
+            if stats['restarts'] > app.config['BACKUP_MAX_RESTARTS']:
+                raise BackupRestarted()
+        stats['remaining'] = remaining
+        if remaining:
+            time.sleep(app.config['BACKUP_STEP_SLEEP'])
+
+    source = sqlite3.connect(source_path)
+    try:
+        target = sqlite3.connect(target_path)
+        try:
+            try:
+                source.backup(target, pages=app.config['BACKUP_PAGES_PER_STEP'], progress=after_step)
+            except BackupRestarted:
+                app.logger.warning('Backup kept restarting under writes; copying the rest in one step')
+                source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return stats['steps'], stats['restarts']
+
+
+def backup_database(directory=None, keep=None):
+    source_path = sqlite_database_path()
+    if not source_path:
+        raise RuntimeError('Online backups need a SQLite database; back up other databases with their own tools.')
+    directory = directory or app.config['BACKUP_DIR']
+    keep = app.config['BACKUP_KEEP'] if keep is None else keep
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.splitext(os.path.basename(source_path))[0] + '-'
+    target_path = os.path.join(directory, f'{prefix}{datetime.utcnow():%Y%m%d-%H%M%S}.db')
+    partial_path = target_path + '.partial'
+
+    started = time.perf_counter()
+    steps, restarts = _copy_database(source_path, partial_path)
+    problems = verify_backup(partial_path)
+    if problems:
+        os.remove(partial_path)
+        raise RuntimeError(f'Backup failed integrity_check: {"; ".join(problems[:5])}')
+    os.replace(partial_path, target_path)
+    seconds = time.perf_counter() - started
+    metrics_observe('anonn_backup_duration_seconds', seconds, buckets=BACKUP_DURATION_BUCKETS)
+    return {'path': target_path, 'bytes': os.path.getsize(target_path), 'seconds': seconds, 'steps': steps,
+            'restarts': restarts, 'rotated': rotate_backups(directory, prefix, keep)}
+
+
+@scheduled_job('backup', 'BACKUP_INTERVAL')
+def scheduled_backup():
+    backup = backup_database()
+    return f"{backup['path']} ({backup['bytes']} bytes) in {backup['seconds']:.1f}s"
+
+
+@app.cli.command('backup')
+@click.option('--dir', 'directory', default=None, help='Каталог для копий (по умолчанию BACKUP_DIR).')
+@click.option('--keep', type=int, default=None, help='Сколько последних копий хранить (по умолчанию BACKUP_KEEP).')
+@click.option('--verify', 'verify_path', default=None, help='Только проверить целостность существующей копии.')
+def backup_command(directory, keep, verify_path):
+    """Сделать онлайн-копию SQLite-базы с ротацией и проверкой целостности"""
+    if verify_path:
+        problems = verify_backup(verify_path)
+        if problems:
+            raise click.ClickException('integrity_check failed:\n' + '\n'.join(problems))
+        click.echo(f'{verify_path}: ok')
+        return
+    try:
+        backup = backup_database(directory, keep)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Backed up to {backup['path']} ({backup['bytes'] / 1e6:.1f} MB) in {backup['seconds']:.1f}s, "
+               f"{backup['steps']} steps, {backup['restarts']} restarts.")
+    for name in backup['rotated']:
+        click.echo(f'Removed old backup {name}')
+
+
+# --- AnonN Migration ---
+# `flask migrate-anonn SOURCE_URL` copies an AnonN.py database (user, post, reply) into this schema, keeping the
+# ids. Each table streams through a server-side cursor in id order and is written in batches; a batch commits
+# together with its migration_checkpoint row, so an interrupted run resumes after the last committed id and a
+# later run picks up rows the old app wrote in the meantime. Every run only copies ids up to the maxima seen
+# when it started, which keeps replies from arriving before their posts. Edits and deletions of rows that were
+# already copied are not carried over.
+def _map_anonn_user(row):
+    return {'id': row.id, 'username': row.username or f'user_{row.id}', 'password_hash': row.password_hash or '',
+            'about_me': '', 'is_admin': bool(row.is_admin), 'is_banned': False}
+
+
+def _map_anonn_post(row):
+    return {'id': row.id, 'content': row.content, 'date': row.date, 'user_id': row.user_id, 'pinned': False,
+            'edit_count': 0}
+
+
+def _map_anonn_reply(row):
+    return {'id': row.id, 'content': row.content, 'date': row.date, 'post_id': row.post_id, 'user_id': row.user_id}
+
+
+ANONN_MIGRATION_STEPS = (('user', User.__table__, _map_anonn_user),
+                         ('post', Post.__table__, _map_anonn_post),
+                         ('reply', Reply.__table__, _map_anonn_reply))
+ANONN_FOLLOW_UP_CHECKPOINT = 'anonn:rebuilt'
+
+
+def migrate_anonn_table(source, legacy_table, target_table, map_row, upper_id, batch_size, progress=None):
+    name = f'anonn:{legacy_table.name}'
+    checkpoint = db.session.get(MigrationCheckpoint, name) or MigrationCheckpoint(name=name, last_id=0, rows=0)
+    if checkpoint.last_id >= upper_id:
+        return 0
+    db.session.add(checkpoint)
+    query = select(legacy_table).where(legacy_table.c.id > checkpoint.last_id,
+                                       legacy_table.c.id <= upper_id).order_by(legacy_table.c.id)
+    copied = 0
+    started = time.perf_counter()
+    with source.connect() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=batch_size).execute(query)
+        for rows in result.partitions(batch_size):
+            db.session.execute(target_table.insert(), [map_row(row) for row in rows])
+            checkpoint.last_id = rows[-1].id
+            checkpoint.rows += len(rows)
+            checkpoint.updated_at = datetime.utcnow()
+            db.session.commit()
+            copied += len(rows)
+            if progress:
+                progress(legacy_table.name, copied, time.perf_counter() - started)
+    return copied
+
+
+def migrate_anonn(source, batch_size, progress=None):
+    legacy = MetaData()
+    legacy.reflect(source, only=[name for name, _, _ in ANONN_MIGRATION_STEPS])
+    with source.connect() as connection:
+        upper_ids = {name: connection.execute(select(func.max(legacy.tables[name].c.id))).scalar() or 0
+                     for name, _, _ in ANONN_MIGRATION_STEPS}
+    copied = {}
+    for name, target_table, map_row in ANONN_MIGRATION_STEPS:
+        copied[name] = migrate_anonn_table(source, legacy.tables[name], target_table, map_row, upper_ids[name],
+                                           batch_size, progress)
+    # The rebuilds after the copy are recorded in their own checkpoint (rows = copied rows they covered), so a run
+    # that died after its last batch but before they finished gets them redone by the next run
+    step_names = [f'anonn:{name}' for name, _, _ in ANONN_MIGRATION_STEPS]
+    total = db.session.query(func.coalesce(func.sum(MigrationCheckpoint.rows), 0)).filter(
+        MigrationCheckpoint.name.in_(step_names)).scalar()
+    follow_up = db.session.get(MigrationCheckpoint, ANONN_FOLLOW_UP_CHECKPOINT)
+    if total and (follow_up is None or follow_up.rows != total):
+        _reset_id_sequences()
+        db.session.execute(post_activity_update())
+        refresh_hot_ranks()
+        bump_data_versions('feed')
+        db.session.commit()
+        rebuild_user_stats()
+        follow_up = db.session.get(MigrationCheckpoint, ANONN_FOLLOW_UP_CHECKPOINT) or MigrationCheckpoint(
+            name=ANONN_FOLLOW_UP_CHECKPOINT, last_id=0)
+        follow_up.rows = total
+        follow_up.updated_at = datetime.utcnow()
+        db.session.add(follow_up)
+        db.session.commit()
+    return copied
+
+
+@app.cli.command('migrate-anonn')
+@click.argument('source_url')
+@click.option('--batch-size', type=int, default=5000, show_default=True, help='Строк в одной транзакции.')
+@click.option('--status', is_flag=True, help='Только показать сохранённый прогресс.')
+def migrate_anonn_command(source_url, batch_size, status):
+    """Перенести пользователей, посты и ответы из базы AnonN.py (можно прерывать и запускать снова)"""
+    if status:
+        for checkpoint in MigrationCheckpoint.query.filter(MigrationCheckpoint.name.like('anonn:%')).order_by(
+                MigrationCheckpoint.name):
+            click.echo(f'{checkpoint.name}: {checkpoint.rows} rows, last id {checkpoint.last_id}, '
+                       f'updated {checkpoint.updated_at:%Y-%m-%d %H:%M:%S}')
+        return
+    db.create_all()  # As for import: a brand-new database has no schema yet
+    add_missing_columns()
+    # Rows keep their legacy ids, so a first run needs empty targets; later runs resume into their own rows
+    if not MigrationCheckpoint.query.filter(MigrationCheckpoint.name.like('anonn:%')).first():
+        non_empty = [table.name for _, table, _ in ANONN_MIGRATION_STEPS
+                     if db.session.execute(select(literal_column('1')).select_from(table).limit(1)).first()]
+        if non_empty:
+            raise click.ClickException(f'Database is not empty ({", ".join(non_empty)}); the migration needs a fresh one.')
+    source = create_engine(source_url.replace('postgres://', 'postgresql://', 1))
+    last_report = {}
+
+    def report(table_name, count, seconds):
+        if count - last_report.get(table_name, 0) >= batch_size * 10:
+            last_report[table_name] = count
+            click.echo(f'{table_name}: {count} rows ({count / seconds if seconds else 0:.0f} rows/s)')
+
+    started = time.perf_counter()
+    try:
+        copied = migrate_anonn(source, batch_size, progress=report)
+    except InvalidRequestError as e:  # A table is missing from the source
+        raise click.ClickException(str(e))
+    finally:
+        source.dispose()
+    elapsed = time.perf_counter() - started
+    for name, count in copied.items():
+        click.echo(f'{name}: {count} new rows')
+    total = sum(copied.values())
+    click.echo(f'Copied {total} rows in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} rows/s).')
+
+
+# --- Load Testing Data Generator ---
+LOAD_WORDS = ("привет форум пост ответ тема новости обсуждение вопрос мнение код сервер база данные "
+              "игра музыка фильм книга работа учеба погода город время идея проект релиз баг фича").split()
+
+
+def _skewed_cum_weights(n, exponent=1.1):
+    # Zipf-like weights: a handful of "power users"/"hot posts" get most of the activity. Cumulative, for
+    # rng.choices(cum_weights=...), which otherwise re-sums the whole list on every call.
+    return list(itertools.accumulate(1.0 / (rank + 1) ** exponent for rank in range(n)))
+
+
+def _random_load_text(rng, min_words=5, max_words=60):
+    words = [rng.choice(LOAD_WORDS) for _ in range(rng.randint(min_words, max_words))]
+    roll = rng.random()
+    if roll < 0.1:
+        words.insert(0, '<b>'); words.append('</b>')
+    elif roll < 0.15:
+        words.insert(0, f'<font color="#{rng.randrange(0x1000000):06x}">'); words.append('</font>')
+    return ' '.join(words)
+
+
+def _random_past_date(rng, now, days):
+    # Bias towards recent activity: most rows land in the last few days
+    return now - timedelta(seconds=int(days * 86400 * rng.random() ** 3))
+
+
+def _insert_in_batches(table, rows, batch_size):
+    inserted = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        db.session.execute(table.insert(), batch)  # list of params -> executemany
+        db.session.commit()
+        inserted += len(batch)
+    return inserted
+
+
+@app.cli.command('seed-load')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--posts', default=20000, show_default=True)
+@click.option('--replies', default=60000, show_default=True)
+@click.option('--votes', default=100000, show_default=True)
+@click.option('--tags', default=200, show_default=True)
+@click.option('--messages', default=30000, show_default=True)
+@click.option('--reports', default=500, show_default=True)
+@click.option('--days', default=90, show_default=True, help='Spread of generated dates.')
+@click.option('--batch-size', default=2000, show_default=True)
+@click.option('--prefix', default='load', show_default=True, help='Username prefix for generated users.')
+@click.option('--password', default='loadtest', show_default=True, help='Password shared by generated users.')
+@click.option('--seed', default=None, type=int, help='Random seed for reproducible datasets.')
+def seed_load(users, posts, replies, votes, tags, messages, reports, days, batch_size, prefix, password, seed):
+    """Заполнить базу синтетическими данными для нагрузочного тестирования"""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    db.create_all()
+    started = datetime.utcnow()
+
+    # Hashing is deliberately slow, so every generated user shares one hash
+    password_hash = generate_password_hash(password)
+    max_user_id = db.session.query(func.max(User.id)).scalar() or 0
+    user_rows = [{'username': f'{prefix}_{max_user_id + n + 1}', 'password_hash': password_hash,
+                  'about_me': '', 'is_admin': False, 'is_banned': rng.random() < 0.01}
+                 for n in range(users)]
+    _insert_in_batches(User.__table__, user_rows, batch_size)
+    user_ids = [user_id for (user_id,) in db.session.query(User.id).filter(User.id > max_user_id)]
+    rng.shuffle(user_ids)
+    user_weights = _skewed_cum_weights(len(user_ids))
+    click.echo(f'users: {len(user_ids)}')
+
+    existing_tag_names = {name for (name,) in db.session.query(Tag.name)}
+    tag_rows = [{'name': f'{prefix}-tag-{n}'} for n in range(tags) if f'{prefix}-tag-{n}' not in existing_tag_names]
+    _insert_in_batches(Tag.__table__, tag_rows, batch_size)
+    tag_ids = [tag_id for (tag_id,) in db.session.query(Tag.id).filter(Tag.name.like(f'{prefix}-tag-%'))]
+    tag_weights = _skewed_cum_weights(len(tag_ids), exponent=1.3)
+    click.echo(f'tags: {len(tag_rows)}')
+
+    max_post_id = db.session.query(func.max(Post.id)).scalar() or 0
+    post_rows = []
+    for _ in range(posts):
+        date = _random_past_date(rng, now, days)
+        edited = rng.random() < 0.05
+        post_rows.append({'content': _random_load_text(rng, max_words=rng.choice((40, 40, 40, 400))),
+                          'date': date, 'user_id': rng.choices(user_ids, cum_weights=user_weights)[0],
+                          'pinned': rng.random() < 0.0005,
+                          'last_edited_at': date + timedelta(minutes=rng.randint(1, 600)) if edited else None,
+                          'edit_count': rng.randint(1, 3) if edited else 0})
+    _insert_in_batches(Post.__table__, post_rows, batch_size)
+    post_ids = [post_id for (post_id,) in
+                db.session.query(Post.id).filter(Post.id > max_post_id).order_by(Post.id.asc())]
+    post_dates = {post_id: row['date'] for post_id, row in zip(post_ids, post_rows)}
+    # Newer posts attract more replies and votes
+    post_ids.sort(key=post_dates.get, reverse=True)
+    post_weights = _skewed_cum_weights(len(post_ids), exponent=0.8)
+    click.echo(f'posts: {len(post_ids)}')
+
+    post_tag_rows = []
+    if tag_ids:
+        for post_id in post_ids:
+            for tag_id in set(rng.choices(tag_ids, cum_weights=tag_weights, k=rng.choice((0, 1, 1, 2, 3)))):
+                post_tag_rows.append({'post_id': post_id, 'tag_id': tag_id})
+    _insert_in_batches(post_tags, post_tag_rows, batch_size)
+    db.session.execute(tag_count_update(tag_ids))
+    db.session.commit()
+    click.echo(f'post_tags: {len(post_tag_rows)}')
+
+    reply_rows = []
+    if post_ids:
+        for post_id in rng.choices(post_ids, cum_weights=post_weights, k=replies):
+            reply_rows.append({'content': _random_load_text(rng, 1, 30), 'post_id': post_id,
+                               'user_id': rng.choices(user_ids, cum_weights=user_weights)[0],
+                               'date': post_dates[post_id] + timedelta(seconds=rng.randint(1, 3 * 86400))})
+    _insert_in_batches(Reply.__table__, reply_rows, batch_size)
+    click.echo(f'replies: {len(reply_rows)}')
+
+    vote_pairs = set()
+    vote_rows = []
+    attempts = 0
+    while post_ids and len(vote_rows) < votes and attempts < votes * 5:
+        attempts += 1
+        pair = (rng.choices(user_ids, cum_weights=user_weights)[0],
+                rng.choices(post_ids, cum_weights=post_weights)[0])
+        if pair in vote_pairs:
+            continue
+        vote_pairs.add(pair)
+        vote_rows.append({'user_id': pair[0], 'post_id': pair[1], 'vote_type': 1 if rng.random() < 0.75 else -1,
+                          'date': post_dates[pair[1]] + timedelta(seconds=rng.randint(1, 86400))})
+    _insert_in_batches(Vote.__table__, vote_rows, batch_size)
+    db.session.execute(vote_score_update())
+    db.session.execute(post_activity_update())
+    refresh_hot_ranks()
+    db.session.commit()
+    rebuild_user_stats()
+    click.echo(f'votes: {len(vote_rows)}')
+
+    message_rows = []
+    if len(user_ids) > 1:
+        for _ in range(messages):
+            sender_id, receiver_id = rng.choices(user_ids, cum_weights=user_weights, k=2)
+            if sender_id == receiver_id:
+                continue
+            timestamp = _random_past_date(rng, now, days)
+            message_rows.append({'sender_id': sender_id, 'receiver_id': receiver_id,
+                                 'content': _random_load_text(rng, 1, 20), 'timestamp': timestamp,
+                                 'is_read': timestamp < now - timedelta(days=1) or rng.random() < 0.5})
+        message_rows.sort(key=lambda row: row['timestamp'])
+    _insert_in_batches(DirectMessage.__table__, message_rows, batch_size)
+    click.echo(f'direct messages: {len(message_rows)}')
+    click.echo(f'conversations: {rebuild_conversations()}')
+
+    report_rows = []
+    if len(user_ids) > 1:
+        for _ in range(reports):
+            reporter_id = rng.choice(user_ids)
+            reported_user_id = rng.choices(user_ids, cum_weights=user_weights)[0]
+            if reporter_id == reported_user_id:
+                continue
+            report_rows.append({'reporter_id': reporter_id, 'reported_user_id': reported_user_id,
+                                'reason': _random_load_text(rng, 1, 15) if rng.random() < 0.8 else None,
+                                'timestamp': _random_past_date(rng, now, days), 'is_resolved': rng.random() < 0.3})
+    _insert_in_batches(Report.__table__, report_rows, batch_size)
+    click.echo(f'reports: {len(report_rows)}')
+
+    bump_data_versions('feed')
+    db.session.commit()
+    elapsed = (datetime.utcnow() - started).total_seconds()
+    click.echo(f'Done in {elapsed:.1f}s. Generated users log in with password "{password}".')
+
+
+@app.cli.command('rebuild-conversations')
+def rebuild_conversations_command():
+    """Пересчитать сводки диалогов из личных сообщений"""
+    click.echo(f'Conversations rebuilt: {rebuild_conversations()}')
+
+
+def _foreign_key_actions(table, reflected_fks):
+    # {(column, referred table): ondelete} as declared on the model and as found in the database
+    declared = {(fk.parent.name, fk.column.table.name): (fk.ondelete or '').upper() for fk in table.foreign_keys}
+    existing = {(fk['constrained_columns'][0], fk['referred_table']):
+                (fk.get('options', {}).get('ondelete') or '').upper()
+                for fk in reflected_fks if len(fk['constrained_columns']) == 1}
+    return declared, existing
+
+
+def _delete_foreign_key_orphans(connection, table):
+    # Rows pointing at parents that no longer exist would make the new constraints fail
+    removed = 0
+    for fk in table.foreign_keys:
+        orphaned = and_(fk.parent != None, ~fk.parent.in_(select(fk.column).where(fk.column != None)))
+        if (fk.ondelete or '').upper() == 'SET NULL':
+            removed += connection.execute(table.update().where(orphaned).values({fk.parent.name: None})).rowcount
+        else:
+            removed += connection.execute(table.delete().where(orphaned)).rowcount
+    return removed
+
+
+def _lacks_sqlite_autoincrement(table):
+    if not table.dialect_options['sqlite']['autoincrement']:
+        return False
+    with db.engine.connect() as connection:
+        created = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                     {'name': table.name}).scalar()
+    return created is not None and 'AUTOINCREMENT' not in created.upper()
+
+
+def migrate_foreign_key_cascades():
+    # Databases created before the ON DELETE clauses were declared still have the old constraints.
+    # SQLite cannot alter a constraint, so those tables are rebuilt (create, copy, drop, rename);
+    # other databases get the constraints dropped and re-added. SQLite tables created before they were
+    # declared AUTOINCREMENT are rebuilt the same way. Returns the names of migrated tables.
+    inspector = sa_inspect(db.engine)
+    sqlite = db.engine.dialect.name == 'sqlite'
+    outdated = []
+    for table in db.metadata.sorted_tables:
+        declared, existing = _foreign_key_actions(table, inspector.get_foreign_keys(table.name))
+        if declared != existing or (sqlite and _lacks_sqlite_autoincrement(table)):
+            outdated.append(table)
+    if not outdated:
+        return []
+
+    if db.engine.dialect.name != 'sqlite':
+        with db.engine.begin() as connection:
+            for table in outdated:
+                for fk in sa_inspect(connection).get_foreign_keys(table.name):
+                    if fk.get('name'):
+                        connection.execute(text(f'ALTER TABLE {connection.dialect.identifier_preparer.quote(table.name)} '
+                                                f'DROP CONSTRAINT {connection.dialect.identifier_preparer.quote(fk["name"])}'))
+                _delete_foreign_key_orphans(connection, table)
+                for constraint in table.foreign_key_constraints:
+                    connection.execute(AddConstraint(constraint))
+        return [table.name for table in outdated]
+
+    raw_connection = db.engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=OFF')  # Has no effect inside a transaction, so before BEGIN
+        try:
+            cursor.execute('BEGIN')
+            scratch = MetaData()  # Copies the _new_ tables' foreign keys can resolve against
+            for table in db.metadata.sorted_tables:
+                table.to_metadata(scratch)
+            for table in outdated:
+                existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+                columns = ', '.join(f'"{column.name}"' for column in table.columns if column.name in existing_columns)
+                new_table = table.to_metadata(scratch, name=f'_new_{table.name}')
+                for index in list(new_table.indexes):
+                    new_table.indexes.discard(index)  # Index names are global; recreated after the rename
+                cursor.execute(str(CreateTable(new_table).compile(db.engine)))
+                cursor.execute(f'INSERT INTO "_new_{table.name}" ({columns}) SELECT {columns} FROM "{table.name}"')
+                cursor.execute(f'DROP TABLE "{table.name}"')
+                cursor.execute(f'ALTER TABLE "_new_{table.name}" RENAME TO "{table.name}"')
+                for index in table.indexes:
+                    cursor.execute(str(CreateIndex(index).compile(db.engine)))
+            raw_connection.commit()
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            cursor.execute('PRAGMA foreign_keys=ON')
+    finally:
+        raw_connection.close()
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            _delete_foreign_key_orphans(connection, table)
+        raise_sqlite_sequences(connection)  # The copies only set them to the live tables' highest ids
+    return [table.name for table in outdated]
+
+
+def add_missing_columns():
+    # create_all() never alters existing tables; columns added to a model since get ALTER TABLE ... ADD COLUMN
+    # (they all have a server default or are nullable). Returns the added 'table.column' names.
+    inspector = sa_inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    added = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_sql = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {quote(table.name)} ADD COLUMN {column_sql}'))
+                    added.append(f'{table.name}.{column.name}')
+    return added
+
+
+@app.cli.command('rebuild-vote-scores')
+def rebuild_vote_scores_command():
+    """Пересчитать post.vote_score по таблице голосов"""
+    updated = db.session.execute(vote_score_update()).rowcount
+    bump_data_versions('feed')
+    db.session.commit()
+    click.echo(f'Recomputed the score of {updated} posts.')
+
+
+def init_db():
+    print("Creating database tables...")
+    db.create_all()
+    migrated = migrate_foreign_key_cascades()
+    if migrated:
+        print(f"Tables rebuilt with their current constraints: {', '.join(migrated)}")
+    added = add_missing_columns()
+    if added:
+        print(f"Columns added: {', '.join(added)}")
+    if 'post.vote_score' in added or 'post' in migrated:  # A rebuilt table gets new columns at their defaults
+        db.session.execute(vote_score_update())
+        db.session.commit()
+    if 'post.reply_count' in added or 'post' in migrated:
+        db.session.execute(post_activity_update())
+        db.session.commit()
+        refresh_hot_ranks()  # Ranked from reply_count
+        db.session.commit()
+    if 'tag.post_count' in added or 'tag' in migrated:
+        db.session.execute(tag_count_update())
+        db.session.commit()
+    # create_all() only creates indexes together with their table; add the ones existing tables lack
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    print("Database tables checked/created.")
+    seed_achievements()
+    if User.query.first() and not UserStats.query.first():
+        print(f"User stats built: {rebuild_user_stats()} users")
+    if Post.query.first() and not PostRank.query.first():
+        refresh_hot_ranks()
+        db.session.commit()
+        print("Hot ranking built.")
+    if DirectMessage.query.first() and not Conversation.query.first():
+        print(f"Conversation summaries built: {rebuild_conversations()}")
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Создать недостающие таблицы и достижения"""
+    init_db()
+
 
 if __name__ == '__main__':
     with app.app_context():
-        print("Creating database tables...")
-        db.create_all()
-        print("Database tables checked/created.")
-        seed_achievements()
+        init_db()
 
         admin_username = os.environ.get('ADMIN_USER', 'admin')
         admin_password = os.environ.get('ADMIN_PASS', 'Play5212')  # Default password, should be changed